@@ -46,6 +46,11 @@ import asyncio
 import panoramisk
 
 
+# ---- Toolbox library imports (get those files and put them in the same folder as your app)
+
+from asyncio_toolbox import GetEventLoop
+
+
 ###############################################################################
 #                                                                             #
 #                          ASTERISK AMI INTERFACE                             #
@@ -62,7 +67,7 @@ class cPanoramiskManager ():
   
   def __init__ (self, loop, logger, taskname, host, port, username, secret):
     
-    self.loop = loop
+    self.loop = loop or GetEventLoop()    # None : loop from GetEventLoop()
     self.logger = logger
     self.taskname = taskname              # Namre of the task in AsyncIO
     self.host = host                      # MQTT broker
@@ -75,7 +80,8 @@ class cPanoramiskManager ():
     self.connected = 'DISCONNECTED'        # DISCONNECTED, CONNECTING, LOGGING, CONNECTED, FAILED
     self.canceled = False
     
-    self.manager = panoramisk.Manager (host=self.host,
+    self.manager = panoramisk.Manager (loop=self.loop,
+                                       host=self.host,
                                        port=self.port,
                                        username=self.username,
                                        secret=self.secret,
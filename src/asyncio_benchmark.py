@@ -0,0 +1,1301 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+# ===============================================================================
+#   Python3 Toolbox
+#   (c) 2011-2022 by Toussaint OTTAVI, bc-109 Soft, t.ottavi@medi.fr
+# ===============================================================================
+#
+#   Benchmarks for the AsyncIO network classes of the toolbox.
+#   Everything runs over loopback; results are printed as JSON.
+#
+#   Usage : python3 asyncio_benchmark.py <benchmark> [options]
+#           python3 asyncio_benchmark.py --help
+#
+# ===============================================================================
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+
+
+# ===============================================================================
+# Info & version Number
+# ===============================================================================
+
+__appname__     = "asyncio_benchmark"
+__description__ = "Loopback benchmarks for the AsyncIO network toolbox"
+__author__      = 'Toussaint OTTAVI, TK1BI, bc-109 Soft'
+__copyright__   = '(c) 2022 by Toussaint OTTAVI, TK1BI, bc-109 Soft'
+__license__     = 'GNU GPLv3'
+__maintainer__  = __author__
+__email__       = 't.ottavi@medi.fr'
+__version__     = '0.1'
+__versiondate__ = '20221230'
+
+
+# ===============================================================================
+# Imports
+# ===============================================================================
+
+# Python standard imports
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import struct
+import sys
+import time
+
+
+# Imports from my personal toolbox library
+
+from asyncio_toolbox import NewEventLoop, EventLoopName, uvloop
+from asyncio_tcp_toolbox import *
+from asyncio_udp_toolbox import *
+from network_toolbox import FindFreeLocalPortTCPUDP
+from metrics_toolbox import cHistogram
+
+
+###############################################################################
+#                                                                             #
+#                                   TOOLS                                     #
+#                                                                             #
+###############################################################################
+
+#==============================================================================
+# Percentiles of a list of values (in seconds), returned in milliseconds
+#==============================================================================
+
+def Percentiles (values):
+  if not values:
+    return {'count': 0}
+  values = sorted(values)
+  n = len(values)
+  return {'count' : n,
+          'min_ms': values[0] * 1000,
+          'p50_ms': values[n // 2] * 1000,
+          'p99_ms': values[min(n - 1, (n * 99) // 100)] * 1000,
+          'max_ms': values[-1] * 1000,
+          'avg_ms': statistics.mean(values) * 1000}
+
+
+#==============================================================================
+# Wait until condition() is true, or timeout
+#==============================================================================
+
+async def WaitFor (condition, timeout=30, step=0.01):
+  end = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > end:
+      raise TimeoutError('Benchmark : condition not reached in %d s' % timeout)
+    await asyncio.sleep(step)
+
+
+#==============================================================================
+# Start a toolbox TCP server on a free loopback port
+#==============================================================================
+
+async def StartServer (server_class=cTCPServer, **kwargs):
+  loop = asyncio.get_running_loop()
+  port = FindFreeLocalPortTCPUDP('127.0.0.1')
+  server = server_class(loop, 'BENCH', '127.0.0.1', port, **kwargs)
+  server.start_server()
+  await WaitFor(lambda: getattr(server, 'started', False))
+  return server
+
+
+#==============================================================================
+# Minimal client protocol counting received bytes
+#==============================================================================
+
+class cCountingProtocol(asyncio.Protocol):
+
+  def __init__(self):
+    self.received = 0
+
+  def data_received(self, data):
+    self.received = self.received + len(data)
+
+
+#==============================================================================
+# Open N plain AsyncIO connections to a server, by batches (listen backlog)
+#==============================================================================
+
+async def OpenCountingClients (server, count, batch=50):
+  loop = asyncio.get_running_loop()
+  protocols = []
+  for i in range(0, count, batch):
+    n = min(batch, count - i)
+    results = await asyncio.gather(*[loop.create_connection(cCountingProtocol, '127.0.0.1', server.tcp_local_port) for _ in range(n)])
+    protocols.extend(p for (t, p) in results)
+  await WaitFor(lambda: len(server.clients.Get()) >= count, timeout=60)
+  return protocols
+
+
+#==============================================================================
+# Hide the output of the toolbox classes (also for child processes)
+#==============================================================================
+
+@contextlib.contextmanager
+def QuietStdout (enabled=True):
+  if not enabled:
+    yield
+    return
+  sys.stdout.flush()
+  saved = os.dup(1)
+  with open(os.devnull, 'w') as devnull:
+    os.dup2(devnull.fileno(), 1)
+    try:
+      yield
+    finally:
+      sys.stdout.flush()
+      os.dup2(saved, 1)
+      os.close(saved)
+
+
+#==============================================================================
+# CPU and memory used by the process during a measurement
+#==============================================================================
+
+def CurrentRSS ():
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+  except (OSError, ValueError, IndexError):
+    return None                                                # (Not Linux : see max_rss_mb)
+
+
+class cResourceMeter():
+
+  def __init__(self):
+    self.Start()
+
+  def Start(self):
+    self.cpu = time.process_time()
+    self.wall = time.monotonic()
+
+  def Stop(self):
+    cpu = time.process_time() - self.cpu
+    wall = time.monotonic() - self.wall
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'cpu_s'      : cpu,
+            'cpu_percent': 100 * cpu / wall if wall else 0.0,
+            'rss_mb'     : CurrentRSS(),
+            'max_rss_mb' : maxrss / (1048576 if sys.platform == 'darwin' else 1024)}
+
+
+#==============================================================================
+# Comma separated list of integers (command line)
+#==============================================================================
+
+def IntList (text):
+  return [int(v) for v in text.split(',') if v]
+
+
+#==============================================================================
+# Cancel all other tasks (end of benchmark)
+#==============================================================================
+
+async def CancelAll ():
+  for t in [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]:
+    t.cancel()
+  await asyncio.sleep(0.1)
+
+
+###############################################################################
+#                                                                             #
+#                         TCP CONNECTION SUPERVISION                          #
+#                                                                             #
+###############################################################################
+
+#==============================================================================
+# TCP client recording the time of its last connection
+#==============================================================================
+
+class cBenchTCPClientProtocol(cTCPClientProtocol):
+
+  def connection_made(self, transport):
+    super().connection_made(transport)
+    self.parent.connected_at = time.monotonic()
+
+
+class cBenchTCPClient(cTCPClient):
+
+  async def create_connection(self):
+    self.transport, self.protocol = await self.loop.create_connection( lambda: cBenchTCPClientProtocol(parent=self), self.tcp_ip, self.tcp_port, local_addr=self.local_addr)
+
+
+#==============================================================================
+# N supervised clients connected to one server :
+#  - CPU used by the process while all connections are idle
+#  - Delay between a server-side disconnection and the client reconnection
+#==============================================================================
+
+async def BenchSupervision (clients=1000, idle=5.0):
+
+  loop = asyncio.get_running_loop()
+  server = await StartServer()
+  port = server.tcp_local_port
+
+  tcp_clients = [cBenchTCPClient(loop, 'C%d' % i, '127.0.0.1', port, source_address='127.0.0.1') for i in range(clients)]
+  for i, c in enumerate(tcp_clients):
+    c.connected_at = None
+    c.start_client()
+    if i % 50 == 49:                                           # Don't overflow the listen backlog
+      await WaitFor(lambda: len(server.clients.Get()) > i, timeout=60)
+  await WaitFor(lambda: len(server.clients.Get()) >= clients, timeout=60)
+
+  # ---- Idle CPU
+
+  cpu0, wall0 = time.process_time(), time.monotonic()
+  await asyncio.sleep(idle)
+  cpu = time.process_time() - cpu0
+  wall = time.monotonic() - wall0
+
+  # ---- Reconnect latency
+
+  lost_at = time.monotonic()
+  server.clients.DisconnectAll()
+  await WaitFor(lambda: all((c.connected_at or 0) > lost_at for c in tcp_clients), timeout=120)
+  latencies = [c.connected_at - lost_at for c in tcp_clients]
+
+  await CancelAll()
+
+  return {'benchmark'      : 'supervision',
+          'clients'        : clients,
+          'idle_seconds'   : wall,
+          'idle_cpu_percent': 100 * cpu / wall,
+          'reconnect'      : Percentiles(latencies)}
+
+
+###############################################################################
+#                                                                             #
+#                                 TCP FAN-OUT                                 #
+#                                                                             #
+###############################################################################
+
+#==============================================================================
+# Same status message sent to N clients, for a number of rounds :
+#  - naive : loop over send_data(), message encoded for each client
+#  - broadcast : cTCPConnectedClients.Broadcast(), message encoded once
+#==============================================================================
+
+async def BenchFanout (clients=5000, size=256, rounds=20):
+
+  server = await StartServer()
+  protocols = await OpenCountingClients(server, clients)
+  message = 'S' * size
+  results = {'benchmark': 'fanout', 'clients': clients, 'size': size, 'rounds': rounds}
+
+  for mode in ('naive', 'broadcast'):
+    expected = sum(p.received for p in protocols) + clients * size * rounds
+    skipped = 0
+    send_cpu = 0
+    wall0 = time.perf_counter()
+    for r in range(rounds):
+      cpu0 = time.process_time()
+      if mode == 'naive':
+        for client in server.clients.Get().values():
+          client.protocol.send_data(message.encode())
+      else:
+        skipped = skipped + server.clients.Broadcast(message)[1]
+      send_cpu = send_cpu + time.process_time() - cpu0
+      await asyncio.sleep(0)                                   # Let the clients read
+    await WaitFor(lambda: sum(p.received for p in protocols) >= expected - skipped * size, timeout=120)
+    wall = time.perf_counter() - wall0
+    results[mode] = {'send_cpu_s'          : send_cpu,
+                     'send_us_per_client'  : 1e6 * send_cpu / (clients * rounds),
+                     'delivered_s'         : wall,
+                     'messages_per_s'      : clients * rounds / wall,
+                     'skipped_backpressure': skipped}
+
+  await CancelAll()
+  return results
+
+
+###############################################################################
+#                                                                             #
+#                              CONNECTION CHURN                               #
+#                                                                             #
+###############################################################################
+
+#==============================================================================
+# Accept / close throughput :
+#  - registry : AddMember / IsMember / RemoveMember alone (the accept/close
+#    bookkeeping done by cTCPServerProtocol), with a fake protocol
+#  - loopback : real connections opened and closed by batches
+#==============================================================================
+
+class cFakeProtocol():
+  transport = None
+
+
+async def BenchChurn (connections=5000, batch=50):
+
+  # ---- Registry only
+
+  registry = cTCPConnectedClients()
+  protocol = cFakeProtocol()
+  ops = connections * 20
+  t0 = time.perf_counter()
+  for i in range(ops):
+    port = 1024 + (i % 60000)
+    if registry.IsMember('127.0.0.1', port) is None:
+      registry.AddMember('127.0.0.1', port, protocol)
+    registry.RemoveMember('127.0.0.1', port)
+  registry_time = time.perf_counter() - t0
+
+  # ---- Real connections
+
+  loop = asyncio.get_running_loop()
+  server = await StartServer()
+  accepted = 0
+  t0 = time.perf_counter()
+  for i in range(0, connections, batch):
+    n = min(batch, connections - i)
+    results = await asyncio.gather(*[loop.create_connection(asyncio.Protocol, '127.0.0.1', server.tcp_local_port) for _ in range(n)])
+    await WaitFor(lambda: len(server.clients.Get()) >= n, step=0.001)
+    accepted = accepted + n
+    for (transport, p) in results:
+      transport.close()
+    await WaitFor(lambda: len(server.clients.Get()) == 0, step=0.001)
+  loopback_time = time.perf_counter() - t0
+
+  await CancelAll()
+  return {'benchmark'                   : 'churn',
+          'registry_accept_close_per_s' : ops / registry_time,
+          'loopback_connections'        : accepted,
+          'loopback_accept_close_per_s' : accepted / loopback_time}
+
+
+###############################################################################
+#                                                                             #
+#                         MULTI-PROCESS TCP SERVER                            #
+#                                                                             #
+###############################################################################
+
+#==============================================================================
+# Echo server, run in each worker of the cluster
+#==============================================================================
+
+class cEchoServerProtocol(cTCPServerProtocol):
+
+  def frame_received(self, frame):
+    self.send_data(bytes(frame))
+
+
+class cEchoServer(cTCPServer):
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.protocol_class = cEchoServerProtocol
+
+
+#==============================================================================
+# Client sending a message, and the next one when the echo is back
+#==============================================================================
+
+class cPingPongProtocol(asyncio.Protocol):
+
+  def __init__(self, message):
+    self.message = message
+    self.received = 0
+    self.count = 0
+    self.running = True
+
+  def connection_made(self, transport):
+    self.transport = transport
+    transport.write(self.message)
+
+  def data_received(self, data):
+    self.received = self.received + len(data)
+    while self.received >= len(self.message):
+      self.received = self.received - len(self.message)
+      self.count = self.count + 1
+      if self.running:
+        self.transport.write(self.message)
+
+
+#==============================================================================
+# Load generator process : connection rate, then ping-pong message rate
+#==============================================================================
+
+async def ClusterLoad (port, clients, size, duration):
+
+  loop = asyncio.get_running_loop()
+
+  connections = 0
+  end = time.monotonic() + duration / 2
+  while time.monotonic() < end:
+    results = await asyncio.gather(*[loop.create_connection(asyncio.Protocol, '127.0.0.1', port) for _ in range(10)])
+    for (transport, p) in results:
+      transport.close()
+    connections = connections + len(results)
+
+  message = b'M' * size
+  protocols = []
+  for i in range(0, clients, 50):
+    results = await asyncio.gather(*[loop.create_connection(lambda: cPingPongProtocol(message), '127.0.0.1', port) for _ in range(min(50, clients - i))])
+    protocols.extend(p for (t, p) in results)
+  start = sum(p.count for p in protocols)
+  await asyncio.sleep(duration / 2)
+  messages = sum(p.count for p in protocols) - start
+  for p in protocols:
+    p.running = False
+    p.transport.close()
+
+  return connections, messages
+
+
+def ClusterLoadProcess (port, clients, size, duration, results):
+  results.put(asyncio.run(ClusterLoad(port, clients, size, duration)))
+
+
+#==============================================================================
+# Connections/s and messages/s with 1 to N worker processes
+#==============================================================================
+
+async def BenchCluster (workers=None, load_processes=None, clients=100, size=64, duration=4.0):
+
+  loop = asyncio.get_running_loop()
+  workers = workers or multiprocessing.cpu_count()
+  load_processes = load_processes or multiprocessing.cpu_count()
+  context = multiprocessing.get_context('spawn')
+  results = {'benchmark': 'cluster', 'cpus': multiprocessing.cpu_count(), 'load_processes': load_processes,
+             'clients_per_load_process': clients, 'size': size, 'runs': []}
+
+  for n in range(1, workers + 1):
+    port = FindFreeLocalPortTCPUDP('127.0.0.1')
+    cluster = cTCPServerCluster(loop, 'BENCH', '127.0.0.1', port, workers=n, server_class=cEchoServer, report_interval=0.2)
+    cluster.start_server()
+    await asyncio.sleep(1 + 0.3 * n)                           # Workers startup (spawn)
+
+    queue = context.Queue()
+    loads = [context.Process(target=ClusterLoadProcess, args=(port, clients, size, duration, queue)) for _ in range(load_processes)]
+    for p in loads:
+      p.start()
+    totals = [await loop.run_in_executor(None, queue.get) for _ in loads]
+    peak_clients = cluster.Stats()[1]
+    for p in loads:
+      p.join()
+
+    cluster.task.cancel()
+    await asyncio.gather(cluster.task, return_exceptions=True)
+    results['runs'].append({'workers'           : n,
+                            'connections_per_s' : sum(c for (c, m) in totals) / (duration / 2),
+                            'messages_per_s'    : sum(m for (c, m) in totals) / (duration / 2),
+                            'clients_per_worker': [w['clients'] for w in peak_clients]})
+  return results
+
+
+###############################################################################
+#                                                                             #
+#                             UDP RECEIVE PATHS                               #
+#                                                                             #
+###############################################################################
+
+#==============================================================================
+# Sender process : sends datagrams as fast as possible for <duration> s
+#==============================================================================
+
+def UDPSenderProcess (port, size, duration, started):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.connect(('127.0.0.1', port))
+  message = b'U' * size
+  started.set()
+  end = time.monotonic() + duration
+  while time.monotonic() < end:
+    for _ in range(100):
+      try:
+        sock.send(message)
+      except OSError:
+        pass
+  sock.close()
+
+
+#==============================================================================
+# Packets/s and CPU per packet : standard DatagramProtocol vs batched receive
+# (preallocated buffers, or pooled buffers released by the handler)
+# (CPU is the one of the receiving process only)
+#==============================================================================
+
+async def BenchUDPReceive (size=64, batch=64, duration=4.0):
+
+  loop = asyncio.get_running_loop()
+  context = multiprocessing.get_context('spawn')
+  results = {'benchmark': 'udp_receive', 'size': size, 'runs': []}
+
+  for (path, mode, pool) in (('standard', None, None),
+                             ('batched', batch, None),
+                             ('pooled', batch, cUDPBufferPool(2048, 1024))):
+    port = FindFreeLocalPortTCPUDP('127.0.0.1')
+    server = cUDPServer(loop, 'BENCH', '127.0.0.1', port, batch=mode, pool=pool, receive_buffer=4 * 1024 * 1024)
+    server.start_server()
+    await WaitFor(lambda: server.sock is not None)
+
+    started = context.Event()
+    sender = context.Process(target=UDPSenderProcess, args=(port, size, duration + 1, started))
+    sender.start()
+    await loop.run_in_executor(None, started.wait)
+    await asyncio.sleep(0.5)                                   # Warm up
+
+    packets, wakeups = server.packets_in, server.wakeups
+    cpu, start = time.process_time(), time.monotonic()
+    await asyncio.sleep(duration)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+    packets, wakeups = server.packets_in - packets, server.wakeups - wakeups
+
+    await loop.run_in_executor(None, sender.join)
+    server.cancel_server()
+    await asyncio.sleep(0.1)
+    results['runs'].append({'path'              : path,
+                            'batch'             : mode or 1,
+                            'packets_per_s'     : packets / elapsed,
+                            'cpu_us_per_packet' : cpu * 1000000 / packets if packets else None,
+                            'packets_per_wakeup': packets / wakeups if wakeups else 1.0})
+  return results
+
+
+###############################################################################
+#                                                                             #
+#                                UDP SEND PATHS                               #
+#                                                                             #
+###############################################################################
+
+#==============================================================================
+# Previous cUDPClient.send_server (print + sendto for each packet)
+#==============================================================================
+
+class cLegacyUDPClient(cUDPClient):
+
+  def send_server(self, _packet):
+    try:
+      print ("Send_Server")
+      self.transport.sendto(_packet, (self.server_ip, self.server_port))
+    except:
+      print('EXCEPTION sending UDP packet')
+
+
+#==============================================================================
+# N streams sending one frame every <interval> s, for <duration> s
+# (One ticker for all streams, like a mixer; CPU of the whole process)
+#==============================================================================
+
+async def UDPStreams (clients, streams, size, interval, duration):
+
+  loop = asyncio.get_running_loop()
+  frame = b'R' * size
+  per_client = streams // len(clients)
+  ticks = late = 0
+  cpu, start = time.process_time(), loop.time()
+  next_tick = start
+  while next_tick - start < duration:
+    for c in clients:
+      for _ in range(per_client):
+        c.send_server(frame)
+    ticks += 1
+    next_tick += interval
+    delay = next_tick - loop.time()
+    if delay < 0:
+      late += 1
+    await asyncio.sleep(max(0, delay))
+  elapsed = loop.time() - start
+  cpu = time.process_time() - cpu
+  return {'packets_per_s'    : ticks * streams / elapsed,
+          'cpu_percent'      : 100 * cpu / elapsed,
+          'cpu_us_per_packet': cpu * 1000000 / (ticks * streams),
+          'late_ticks'       : late}
+
+
+#==============================================================================
+# 500 streams of 20 ms frames : legacy / direct / queued send paths, with one
+# socket per stream, and with all streams on one socket (e.g. to a gateway)
+#==============================================================================
+
+async def BenchUDPSend (streams=500, size=172, interval=0.02, duration=4.0, batch=64):
+
+  loop = asyncio.get_running_loop()
+  sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)     # Never read : the kernel drops what does not fit
+  sink.bind(('127.0.0.1', 0))
+  port = sink.getsockname()[1]
+  logger = logging.getLogger('BENCH')
+  results = {'benchmark': 'udp_send', 'streams': streams, 'size': size, 'interval_ms': interval * 1000, 'runs': []}
+
+  runs = [('per_stream_socket', 'legacy', streams, cLegacyUDPClient, {}),
+          ('per_stream_socket', 'direct', streams, cUDPClient, {}),
+          ('per_stream_socket', 'queue',  streams, cUDPClient, {'send_batch': batch}),
+          ('shared_socket',     'direct', 1,       cUDPClient, {}),
+          ('shared_socket',     'queue',  1,       cUDPClient, {'send_batch': batch})]
+  for (topology, path, sockets, client_class, kwargs) in runs:
+    clients = []
+    for i in range(sockets):
+      transport, client = await loop.create_datagram_endpoint(lambda: client_class('S%d' % i, '127.0.0.1', port, loop, logger, **kwargs),
+                                                              local_addr=('127.0.0.1', 0))
+      clients.append(client)
+    result = await UDPStreams(clients, streams, size, interval, duration)
+    result.update({'topology': topology, 'path': path, 'sockets': sockets})
+    queues = [c.send_queue.stats() for c in clients if c.send_queue is not None]
+    for field in ('sent', 'dropped', 'eagain', 'errors', 'syscalls'):
+      if queues:
+        result[field] = sum(q[field] for q in queues)
+    for c in clients:
+      c.transport.close()
+    await asyncio.sleep(0.1)
+    results['runs'].append(result)
+  sink.close()
+  return results
+
+
+###############################################################################
+#                                                                             #
+#                        LOOPBACK LOAD (TCP / UDP ECHO)                       #
+#                                                                             #
+###############################################################################
+
+# N toolbox clients (cTCPClient / cUDPClient) send messages of <size> bytes to
+# a toolbox server (cTCPServer / cUDPServer) echoing them back :
+#  - rate > 0 : open loop, <rate> messages/s per connection
+#  - rate = 0 : closed loop, one message in flight per connection
+# Each message carries its send time : latency is the round trip time.
+# Clients and server run in this process : CPU and RSS are for both.
+
+#==============================================================================
+# Load statistics (shared by all the clients of a run)
+#==============================================================================
+
+class cLoadStats():
+
+  def __init__(self, size, closed_loop):
+    self.padding = b'L' * max(0, size - 8)
+    self.closed_loop = closed_loop
+    self.running = True
+    self.Reset()
+
+  def Reset(self):
+    self.sent = 0
+    self.received = 0
+    self.bytes = 0
+    self.latency = cHistogram()
+
+  def Message(self):
+    self.sent += 1
+    return struct.pack('d', time.perf_counter()) + self.padding
+
+  def Received(self, message):
+    self.received += 1
+    self.bytes += len(message)
+    self.latency.Record(time.perf_counter() - struct.unpack_from('d', message)[0])
+
+  def Result(self, elapsed):
+    latency = self.latency.Snapshot()
+    return {'messages_per_s': self.received / elapsed,
+            'mbytes_per_s'  : self.bytes / elapsed / 1048576,
+            'sent'          : self.sent,
+            'received'      : self.received,
+            'loss_percent'  : 100 * max(0, self.sent - self.received) / self.sent if self.sent else 0.0,
+            'latency_ms'    : {k: round(latency[k] * 1000, 3) for k in ('min', 'p50', 'p90', 'p99', 'max')}}
+
+
+#==============================================================================
+# Toolbox TCP echo server and clients
+#==============================================================================
+
+def LoadFramer ():
+  return cTCPFramerLengthPrefix(header_size=4, max_frame=16 * 1048576)
+
+
+class cEchoFramedServerProtocol(cTCPServerProtocol):
+
+  def frame_received(self, frame):
+    self.send_data(self.encode(bytes(frame)))
+
+
+class cLoadTCPClientProtocol(cTCPClientProtocol):
+
+  def frame_received(self, frame):
+    load = self.parent.load
+    load.Received(frame)
+    if load.closed_loop and load.running:
+      self.send_data(self.encode(load.Message()))
+
+
+class cLoadTCPClient(cTCPClient):
+
+  def __init__(self, *args, load=None, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.load = load
+
+  async def create_connection(self):
+    self.transport, self.protocol = await self.loop.create_connection( lambda: cLoadTCPClientProtocol(parent=self), self.tcp_ip, self.tcp_port, local_addr=self.local_addr)
+
+  def send_message(self):
+    self.protocol.send_data(self.protocol.encode(self.load.Message()))
+
+
+#==============================================================================
+# Toolbox UDP echo server and clients
+#==============================================================================
+
+class cLoadUDPClient(cUDPClient):
+
+  def __init__(self, *args, load=None, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.load = load
+
+  def datagram_received(self, data, addr):
+    load = self.load
+    load.Received(data)
+    if load.closed_loop and load.running:
+      self.send_server(load.Message())
+
+  def send_message(self):
+    self.send_server(self.load.Message())
+
+
+#==============================================================================
+# Drive the load, and measure during <duration> s (after a warm up)
+#==============================================================================
+
+async def DriveLoad (clients, load, rate, duration, warmup=0.5, tick=0.005):
+
+  loop = asyncio.get_running_loop()
+
+  if load.closed_loop:
+    for c in clients:
+      c.send_message()
+    await asyncio.sleep(warmup)
+    load.Reset()
+    meter = cResourceMeter()
+    await asyncio.sleep(duration)
+    elapsed = time.monotonic() - meter.wall
+    result = load.Result(elapsed)
+    result['process'] = meter.Stop()
+    load.running = False
+    return result
+
+  credit = 0.0                                                 # Messages due per connection (open loop)
+  start = last = loop.time()
+  meter = None
+  while True:
+    now = loop.time()
+    if (meter is None) and (now - start >= warmup):
+      load.Reset()
+      credit = 0.0
+      meter = cResourceMeter()
+    if (meter is not None) and (time.monotonic() - meter.wall >= duration):
+      break
+    credit += (now - last) * rate
+    last = now
+    for _ in range(int(credit)):
+      for c in clients:
+        c.send_message()
+    credit -= int(credit)
+    await asyncio.sleep(tick)
+  await asyncio.sleep(0.2)                                     # Answers in flight
+  elapsed = time.monotonic() - meter.wall - 0.2
+  result = load.Result(elapsed)
+  result['process'] = meter.Stop()
+  return result
+
+
+#==============================================================================
+# TCP : cTCPClient x N  ->  cTCPServer (echo)
+#==============================================================================
+
+async def BenchTCPLoad (connections=(1, 100), sizes=(64, 1024), rate=0, duration=4.0):
+
+  loop = asyncio.get_running_loop()
+  results = {'benchmark': 'tcp_load', 'rate_per_connection': rate or 'closed loop', 'runs': []}
+
+  for size in sizes:
+    for n in connections:
+      server = await StartServer(framer=LoadFramer)
+      server.protocol_class = cEchoFramedServerProtocol
+      load = cLoadStats(size, closed_loop=not rate)
+      clients = []
+      for i in range(0, n, 50):                                # (Listen backlog)
+        batch = [cLoadTCPClient(loop, 'LOAD%d' % (i + j), '127.0.0.1', server.tcp_local_port, source_address='127.0.0.1',
+                                framer=LoadFramer, load=load) for j in range(min(50, n - i))]
+        for c in batch:
+          c.start_client()
+        await WaitFor(lambda: all(c.connected for c in batch))
+        clients.extend(batch)
+
+      result = await DriveLoad(clients, load, rate, duration)
+      result.update({'connections': n, 'size': size})
+      results['runs'].append(result)
+
+      load.running = False
+      await CancelAll()
+  return results
+
+
+#==============================================================================
+# UDP : cUDPClient x N  ->  cUDPServer (echo, batched receive)
+#==============================================================================
+
+async def BenchUDPLoad (connections=(1, 100), sizes=(64, 1024), rate=0, duration=4.0, batch=64):
+
+  loop = asyncio.get_running_loop()
+  logger = logging.getLogger('BENCH')
+  results = {'benchmark': 'udp_load', 'rate_per_connection': rate or 'closed loop', 'runs': []}
+
+  for size in sizes:
+    for n in connections:
+      port = FindFreeLocalPortTCPUDP('127.0.0.1')
+      server = cUDPServer(loop, 'BENCH', '127.0.0.1', port, batch=batch, receive_buffer=4 * 1048576)
+      server.datagram_received = server.sendto
+      server.start_server()
+      await WaitFor(lambda: server.sock is not None)
+
+      load = cLoadStats(size, closed_loop=not rate)
+      clients = []
+      for i in range(n):
+        transport, client = await loop.create_datagram_endpoint(lambda: cLoadUDPClient('LOAD%d' % i, '127.0.0.1', port, loop, logger, load=load),
+                                                                local_addr=('127.0.0.1', 0))
+        clients.append(client)
+
+      result = await DriveLoad(clients, load, rate, duration)
+      result.update({'connections': n, 'size': size})
+      results['runs'].append(result)
+
+      load.running = False
+      for c in clients:
+        c.transport.close()
+      server.cancel_server()
+      await asyncio.sleep(0.1)
+  return results
+
+
+###############################################################################
+#                                                                             #
+#                            MQTT TOPIC ROUTER                                #
+#                                                                             #
+###############################################################################
+
+# Dispatch time of cMQTTTopicRouter (trie) vs a linear scan of the filters
+# (what an if/elif chain over topics does), with per-device subscriptions :
+# devices/<n>/state, devices/<n>/+/value, plus a few wildcards.
+
+#==============================================================================
+# Linear matching of a topic against a filter (reference)
+#==============================================================================
+
+def MatchFilterLinear (f, t):                                  # (Split filter and topic)
+  for i, level in enumerate(f):
+    if level == '#':
+      return True
+    if (i >= len(t)) or ((level != '+') and (level != t[i])):
+      return False
+  return len(f) == len(t)
+
+
+#==============================================================================
+# Benchmark
+#==============================================================================
+
+async def BenchMQTTRouter (subscriptions=(10, 100, 1000, 10000), messages=20000):
+
+  from asyncio_mqtt_toolbox import cMQTTTopicRouter           # (gmqtt required)
+  import random
+
+  loop = asyncio.get_running_loop()
+  results = {'benchmark': 'mqtt_router', 'messages': messages, 'runs': []}
+  handled = [0]
+  def Handler(topic, payload, qos, properties):
+    handled[0] += 1
+
+  for n in subscriptions:
+    devices = max(1, n // 2)
+    filters = ['devices/%d/state' % i for i in range(devices)] + ['devices/%d/+/value' % i for i in range(n - devices)]
+    filters += ['devices/+/alarm', 'site/#']
+    router = cMQTTTopicRouter(loop, logging.getLogger('BENCH'))
+    for topic_filter in filters:
+      router.Add(topic_filter, Handler)
+
+    rng = random.Random(n)
+    topics = [rng.choice(('devices/%d/state', 'devices/%d/temp/value', 'devices/%d/alarm')) % rng.randrange(devices)
+              for _ in range(1000)]
+
+    handled[0] = 0
+    start = time.perf_counter()
+    for i in range(messages):
+      router.Dispatch(topics[i % 1000], b'1', 0, None)
+    trie = (time.perf_counter() - start) / messages
+    routed = handled[0]
+
+    count = min(messages, max(200, 2000000 // len(filters)))   # (Linear scan is slow with many filters)
+    handled[0] = 0
+    start = time.perf_counter()
+    split_filters = [topic_filter.split('/') for topic_filter in filters]
+    for i in range(count):
+      topic = topics[i % 1000]
+      levels = topic.split('/')
+      for topic_filter in split_filters:
+        if MatchFilterLinear(topic_filter, levels):
+          Handler(topic, b'1', 0, None)
+    linear = (time.perf_counter() - start) / count
+
+    results['runs'].append({'filters': len(filters), 'trie_us_per_message': trie * 1e6, 'linear_us_per_message': linear * 1e6,
+                            'handlers_per_message': routed / messages})
+  return results
+
+
+###############################################################################
+#                                                                             #
+#                            MQTT PUBLISHING                                  #
+#                                                                             #
+###############################################################################
+
+# cGMQTTClient publishing to a broker stand-in built on cTCPServer : it answers
+# CONNECT and PINGREQ, acknowledges QoS 1, and only counts PUBLISH packets.
+# Client and stand-in share this process : messages/s include both.
+
+#==============================================================================
+# Broker stand-in
+#==============================================================================
+
+class cMQTTStandInProtocol(cTCPServerProtocol):
+
+  def connection_made(self, transport):
+    super().connection_made(transport)
+    self.parent.connections.add(transport)
+
+  def connection_lost(self, exc):
+    self.parent.connections.discard(self.transport)
+    super().connection_lost(exc)
+
+  def frame_received(self, frame):
+    kind = frame[0] >> 4
+    header = 2
+    while frame[header - 1] & 0x80:                            # (Remaining length bytes)
+      header += 1
+    if kind == 3:                                              # PUBLISH
+      self.parent.published += 1
+      if frame[0] & 0x06:
+        mid = header + 2 + int.from_bytes(frame[header:header + 2], 'big')
+        self.send_data(b'\x40\x02' + bytes(frame[mid:mid + 2]))
+    elif kind == 1:                                            # CONNECT (protocol level : 4 = 3.1.1, 5 = 5.0)
+      self.send_data(b'\x20\x03\x00\x00\x00' if frame[header + 6] == 5 else b'\x20\x02\x00\x00')
+    elif kind == 12:                                           # PINGREQ
+      self.send_data(b'\xd0\x00')
+    elif kind == 14:                                           # DISCONNECT
+      self.transport.close()
+
+
+class cMQTTStandIn(cTCPServer):
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, framer=cTCPFramerMQTT, **kwargs)
+    self.protocol_class = cMQTTStandInProtocol
+    self.published = 0
+    self.connections = set()
+
+
+#==============================================================================
+# Benchmark
+#==============================================================================
+
+async def BenchMQTTPublish (messages=20000, size=64, topics=100, batch=100, window=0.01):
+
+  from asyncio_mqtt_toolbox import cGMQTTClient               # (gmqtt required)
+
+  loop = asyncio.get_running_loop()
+  results = {'benchmark': 'mqtt_publish', 'messages': messages, 'size': size, 'topics': topics, 'batch': batch, 'runs': []}
+  server = await StartServer(cMQTTStandIn)
+
+  logger = logging.getLogger('BENCH.MQTT')                     # INFO to a file, as in applications
+  logger.propagate = False
+  logger.setLevel(logging.INFO)
+  handler = logging.FileHandler(os.devnull)
+  logger.addHandler(handler)
+
+  client = cGMQTTClient(loop, logger, '127.0.0.1', 'BENCH', port=server.tcp_local_port)
+  client.Start()
+  await client.wait_connected(timeout=10)
+
+  names = ['sensors/%d/value' % i for i in range(topics)]
+  payloads = [{'sensor': i, 'value': 'x' * max(0, size - 28)} for i in range(topics)]
+
+  def Legacy(i):                                               # Publish() before batching : INFO log of every payload
+    client.client.publish(names[i % topics], payloads[i % topics])
+    logger.info('%s > Published message : [%s] %s' % (client.client_id, names[i % topics], payloads[i % topics]))
+
+  def Single(i):
+    client.Publish(names[i % topics], payloads[i % topics])
+
+  def Many(i):
+    client.PublishMany([(names[j % topics], payloads[j % topics]) for j in range(i, i + batch)])
+
+  shared = payloads[0]
+  def ToMany(i):                                               # Same payload to <batch> topics : encoded once
+    client.PublishToMany([names[j % topics] for j in range(i, i + batch)], shared)
+
+  for path, function, step in (('legacy', Legacy, 1), ('publish', Single, 1), ('publish_many', Many, batch), ('publish_to_many', ToMany, batch)):
+    server.published = 0
+    start = time.perf_counter()
+    meter = cResourceMeter()
+    for i in range(0, messages, step):
+      function(i)
+      if i % batch == 0:
+        await asyncio.sleep(0)                                 # Let the stand-in read
+    await WaitFor(lambda: server.published >= messages, step=0.001)
+    elapsed = time.perf_counter() - start
+    results['runs'].append({'path': path, 'messages_per_s': messages / elapsed, 'us_per_message': elapsed / messages * 1e6,
+                            'process': meter.Stop()})
+
+  # ---- Coalescing : <messages> updates of <topics> topics, latest value sent every <window> s
+
+  client.coalesce = window
+  server.published = 0
+  superseded = client.superseded
+  start = time.perf_counter()
+  for i in range(messages):
+    client.Publish(names[i % topics], payloads[i % topics])
+    if i % batch == 0:
+      await asyncio.sleep(0)
+  submitted = time.perf_counter() - start
+  await asyncio.sleep(2 * window)
+  client.coalesce = None
+  results['runs'].append({'path': 'coalesce', 'window_ms': window * 1000, 'submitted_per_s': messages / submitted,
+                          'sent': server.published, 'superseded': client.superseded - superseded})
+
+  client.client.on_disconnect = lambda *args: None
+  await CancelAll()
+  logger.removeHandler(handler)
+  handler.close()
+  return results
+
+
+#==============================================================================
+# Reconnection : the stand-in drops the connection, time until connected again
+#==============================================================================
+
+async def BenchMQTTReconnect (rounds=20):
+
+  from asyncio_mqtt_toolbox import cGMQTTClient               # (gmqtt required)
+
+  loop = asyncio.get_running_loop()
+  server = await StartServer(cMQTTStandIn)
+  logger = logging.getLogger('BENCH.MQTT')
+  logger.propagate = False
+
+  client = cGMQTTClient(loop, logger, '127.0.0.1', 'BENCH', port=server.tcp_local_port)
+  client.reconnect_max = 0.1                                   # (Connections dropped every 0.2 s are stable)
+  client.Start()
+  await client.wait_connected(timeout=10)
+
+  times = []
+  for _ in range(rounds):
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    for transport in list(server.connections):
+      transport.abort()
+    await client.disconnected_event.wait()
+    if not await client.wait_connected(timeout=10):
+      raise TimeoutError('Benchmark : client not reconnected')
+    times.append(time.perf_counter() - start)
+
+  await CancelAll()
+  return {'benchmark': 'mqtt_reconnect', 'rounds': rounds, 'reconnections': client.reconnections,
+          'reconnect': Percentiles(times),
+          'previous_reconnect_ms': '>= 5000 (fixed 5 s sleep, then up to 1 s polling)'}
+
+
+#==============================================================================
+# Local broker (cMQTTBroker) : fan-in (N publishers -> 1 subscriber) and
+# fan-out (1 publisher -> N subscribers), cGMQTTClient on both sides
+#==============================================================================
+
+async def BenchMQTTBroker (messages=20000, size=64, fan=10, batch=100, qos_levels=(0, 1)):
+
+  from asyncio_mqtt_toolbox import cGMQTTClient, cMQTTBroker  # (gmqtt required)
+
+  loop = asyncio.get_running_loop()
+  logger = logging.getLogger('BENCH.MQTT')
+  logger.propagate = False
+  results = {'benchmark': 'mqtt_broker', 'messages': messages, 'size': size, 'batch': batch, 'runs': []}
+  payload = b'P' * size
+
+  for scenario, publishers, subscribers in (('fan_in', fan, 1), ('fan_out', 1, fan)):
+    for qos in qos_levels:
+      broker = await StartServer(cMQTTBroker)
+      port = broker.tcp_local_port
+      received = [0]
+      def Received(topic, payload, qos, properties):
+        received[0] += 1
+
+      subs = [cGMQTTClient(loop, logger, '127.0.0.1', 'SUB%d' % i, port=port) for i in range(subscribers)]
+      pubs = [cGMQTTClient(loop, logger, '127.0.0.1', 'PUB%d' % i, port=port) for i in range(publishers)]
+      for client in subs:
+        client.Route('bench/#', Received, qos=qos)
+      for client in subs + pubs:
+        client.Start()
+      for client in subs + pubs:
+        await client.wait_connected(timeout=10)
+      await WaitFor(lambda: sum(broker.router.filters.values()) == subscribers)
+
+      broker.Stats()
+      expected = messages * subscribers
+      max_backlog = max_inflight = 0
+      start = time.perf_counter()
+      meter = cResourceMeter()
+      for n, i in enumerate(range(0, messages, batch)):
+        index = n % publishers
+        pubs[index].PublishToMany(['bench/%d/value' % index] * min(batch, messages - i), payload, qos=qos)
+        await asyncio.sleep(0)
+        if n % 10 == 0:                                        # Subscriber lag, sampled
+          for stats in broker.Stats()['subscribers'].values():
+            max_backlog = max(max_backlog, stats['backlog_bytes'])
+            max_inflight = max(max_inflight, stats['inflight'])
+      await WaitFor(lambda: received[0] >= expected, timeout=60, step=0.001)
+      elapsed = time.perf_counter() - start
+      process = meter.Stop()
+
+      stats = broker.Stats()
+      acks = [s['ack_ms']['p99'] for s in stats['subscribers'].values()]
+      results['runs'].append({'scenario': scenario, 'publishers': publishers, 'subscribers': subscribers, 'qos': qos,
+                              'broker_in_per_s': stats['messages_in'] / elapsed, 'broker_out_per_s': stats['messages_out'] / elapsed,
+                              'delivered_per_s': received[0] / elapsed, 'max_backlog_bytes': max_backlog,
+                              'max_inflight': max_inflight, 'ack_p99_ms': max(acks) if (qos and acks) else None,
+                              'dropped': sum(s['dropped'] for s in stats['subscribers'].values()), 'process': process})
+      await CancelAll()
+  return results
+
+
+###############################################################################
+#                                                                             #
+#                        EVENT LOOPS : UVLOOP VS ASYNCIO                      #
+#                                                                             #
+###############################################################################
+
+# Runs tcp_load and udp_load once per event loop implementation, each in its own
+# process (clean RSS), and compares the throughputs.
+
+#==============================================================================
+# Run a benchmark of this file in a child process, and get its JSON result
+#==============================================================================
+
+async def RunChildBenchmark (*argv):
+  process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), *argv,
+                                                 stdout=asyncio.subprocess.PIPE)
+  out, _ = await process.communicate()
+  if process.returncode:
+    raise RuntimeError('Benchmark %s failed (exit code %d)' % (' '.join(argv), process.returncode))
+  return json.loads(out)
+
+
+#==============================================================================
+# Compare the loops
+#==============================================================================
+
+async def BenchLoops (connections=(1, 100), sizes=(64, 1024), rate=0, duration=4.0):
+
+  loops = ['asyncio', 'uvloop'] if uvloop is not None else ['asyncio']
+  options = ['--connections', ','.join(map(str, connections)), '--sizes', ','.join(map(str, sizes)),
+             '--rate', str(rate), '--duration', str(duration)]
+  results = {'benchmark': 'loops', 'loops': loops, 'runs': []}
+  if uvloop is None:
+    results['note'] = 'uvloop is not installed : asyncio only'
+
+  throughputs = {}
+  for benchmark in ('tcp_load', 'udp_load'):
+    for loop in loops:
+      result = await RunChildBenchmark(benchmark, '--loop', loop, *options)
+      for run in result['runs']:
+        run.update({'benchmark': benchmark, 'loop': loop})
+        results['runs'].append(run)
+        throughputs[(benchmark, run['connections'], run['size'], loop)] = run['messages_per_s']
+
+  if uvloop is not None:
+    results['uvloop_speedup'] = {'%s/%dx%dB' % key[:3]: throughputs[key[:3] + ('uvloop',)] / throughputs[key]
+                                 for key in throughputs if key[3] == 'asyncio'}
+  return results
+
+
+#==============================================================================
+# Run a benchmark on a new event loop
+#==============================================================================
+
+def RunBenchmark (bench, fast):
+  loop = NewEventLoop(fast)
+  asyncio.set_event_loop(loop)
+  try:
+    result = loop.run_until_complete(bench)
+    result.setdefault('event_loop', EventLoopName(loop))
+    return result
+  finally:
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+###############################################################################
+#                                                                             #
+#                                 M A I N                                     #
+#                                                                             #
+###############################################################################
+
+BENCHMARKS = {'supervision': lambda args: BenchSupervision(clients=args.clients or 1000, idle=args.idle),
+              'fanout'     : lambda args: BenchFanout(clients=args.clients or 5000, size=args.size, rounds=args.rounds),
+              'churn'      : lambda args: BenchChurn(connections=args.clients or 5000),
+              'cluster'    : lambda args: BenchCluster(workers=args.workers, clients=args.clients or 100, size=args.size, duration=args.duration),
+              'udp_receive': lambda args: BenchUDPReceive(size=args.size, batch=args.batch, duration=args.duration),
+              'udp_send'   : lambda args: BenchUDPSend(streams=args.clients or 500, size=args.size, duration=args.duration, batch=args.batch),
+              'tcp_load'   : lambda args: BenchTCPLoad(connections=args.connections, sizes=args.sizes, rate=args.rate, duration=args.duration),
+              'udp_load'   : lambda args: BenchUDPLoad(connections=args.connections, sizes=args.sizes, rate=args.rate, duration=args.duration, batch=args.batch),
+              'mqtt_router': lambda args: BenchMQTTRouter(),
+              'mqtt_publish': lambda args: BenchMQTTPublish(messages=args.rounds * 1000, size=args.size, batch=args.batch),
+              'mqtt_reconnect': lambda args: BenchMQTTReconnect(rounds=args.rounds),
+              'mqtt_broker': lambda args: BenchMQTTBroker(messages=args.rounds * 1000, size=args.size, fan=args.clients or 10, batch=args.batch),
+              'loops'      : lambda args: BenchLoops(connections=args.connections, sizes=args.sizes, rate=args.rate, duration=args.duration)}
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description=__description__)
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+  parser.add_argument('--clients', type=int, default=None, help='number of connections (default depends on benchmark)')
+  parser.add_argument('--idle', type=float, default=5.0, help='idle measurement time (s)')
+  parser.add_argument('--size', type=int, default=256, help='message size (bytes)')
+  parser.add_argument('--rounds', type=int, default=20, help='number of messages sent to each client')
+  parser.add_argument('--workers', type=int, default=None, help='max number of server processes (default : number of CPUs)')
+  parser.add_argument('--batch', type=int, default=64, help='max datagrams read per wakeup (UDP batched path)')
+  parser.add_argument('--duration', type=float, default=4.0, help='measurement time (s)')
+  parser.add_argument('--connections', type=IntList, default=[1, 100], help='tcp_load / udp_load : comma separated connection counts')
+  parser.add_argument('--sizes', type=IntList, default=[64, 1024], help='tcp_load / udp_load : comma separated message sizes (bytes)')
+  parser.add_argument('--rate', type=float, default=0, help='tcp_load / udp_load : messages/s per connection (0 = closed loop)')
+  parser.add_argument('--loop', choices=('auto', 'asyncio', 'uvloop'), default='auto', help='event loop (auto : uvloop if installed)')
+  parser.add_argument('--verbose', action='store_true', help='keep the output of the toolbox classes')
+  args = parser.parse_args()
+
+  if (args.loop == 'uvloop') and (uvloop is None):
+    parser.error('uvloop is not installed')
+
+  bench = BENCHMARKS[args.benchmark](args)
+  meter = cResourceMeter()
+  with QuietStdout(not args.verbose):
+    result = RunBenchmark(bench, fast={'auto': None, 'asyncio': False, 'uvloop': True}[args.loop])
+  result['total'] = meter.Stop()
+  print(json.dumps(result, indent=2))
@@ -9,6 +9,7 @@
 # MQTT AsyncIO library :
 #   Allows MQTT operations with AsyncIO
 #   using gmqtt library (https://github.com/wialon/gmqtt)
+#   Includes a minimal local broker for tests and benchmarks (cMQTTBroker)
 #
 # ===============================================================================
 
@@ -38,6 +39,12 @@ VersionDate = "30/12/2022"
 # ---- Python standard imports
 
 import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import struct
 
 
 # ---- Third-party module imports (install with pip)
@@ -45,50 +52,621 @@ import asyncio
 import gmqtt
 
 
+# ---- Toolbox library imports (get those files and put them in the same folder as your app)
+
+from asyncio_toolbox import GetEventLoop, cTokenBucket
+from asyncio_tcp_toolbox import cTCPServer, cTCPServerProtocol, cTCPFramerMQTT, MQTTEncodeLength
+from metrics_toolbox import cHistogram
+
+
+###############################################################################
+#                                                                             #
+#                               TOPIC ROUTER                                  #
+#                                                                             #
+###############################################################################
+
+# Handlers are registered against MQTT topic filters, with wildcards :
+#   '+' : exactly one level          'sensors/+/temperature'
+#   '#' : any number of levels       'sensors/#' (also matches 'sensors')
+#
+#   router.Add('devices/+/state', OnState)          # OnState(topic, payload, qos, properties)
+#   router.Dispatch('devices/42/state', b'ON', 0, {})
+#
+# Filters are stored in a trie, one node per level : matching a topic visits
+# at most one literal child and one '+' child per level, so the cost depends on
+# the topic depth, not on the number of filters. Topics are split once : split
+# levels are kept in a bounded cache (per-device topics come back constantly).
+#
+# Handlers may be plain functions or coroutine functions. Coroutines are run
+# as tasks on the router loop, so a slow handler never delays the others.
+# As in MQTT, wildcards at the first level do not match topics starting with
+# '$' ($SYS...). A handler registered on overlapping filters is called once
+# per matching filter.
+
+#==============================================================================
+# Trie node (one topic level)
+#==============================================================================
+
+class cMQTTTopicNode():
+
+  __slots__ = ('children', 'handlers', 'hash_handlers')
+
+  def __init__(self):
+    self.children = {}                     # Level -> cMQTTTopicNode ('+' for the single level wildcard)
+    self.handlers = []                     # (handler, is_async) of filters ending here
+    self.hash_handlers = []                # (handler, is_async) of filters ending here with '/#'
+
+
+#==============================================================================
+# Router
+#==============================================================================
+
+class cMQTTTopicRouter():
+
+  #----------------------------------------------------------------- Constructor
+
+  def __init__(self, loop, logger, name='MQTT', cache_size=4096):
+
+    self.loop = loop
+    self.logger = logger
+    self.name = name
+    self.root = cMQTTTopicNode()
+    self.filters = collections.Counter()   # Filter -> number of handlers
+    self.cache = {}                        # Topic -> split levels (tuple)
+    self.cache_size = cache_size
+    self.tasks = set()                     # Running async handlers (keep references)
+    self.dispatched = 0
+    self.unrouted = 0
+    self.errors = 0
+
+
+  #-------------------------------------------------- Split a topic in levels
+
+  def Levels(self, topic):
+
+    levels = self.cache.get(topic)
+    if levels is None:
+      levels = tuple(topic.split('/'))
+      if len(self.cache) >= self.cache_size:
+        del self.cache[next(iter(self.cache))]                 # Oldest entry
+      self.cache[topic] = levels
+    return levels
+
+
+  #----------------------------------------------------------- Check a filter
+
+  def CheckFilter(self, topic_filter):
+
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+      if ('#' in level) and ((level != '#') or (i != len(levels) - 1)):
+        raise ValueError("Invalid MQTT filter '%s' : '#' must be the last level" % topic_filter)
+      if ('+' in level) and (level != '+'):
+        raise ValueError("Invalid MQTT filter '%s' : '+' must be a whole level" % topic_filter)
+    return levels
+
+
+  #----------------------------------------------- Register a handler (filter)
+
+  def Add(self, topic_filter, handler):
+
+    levels = self.CheckFilter(topic_filter)
+    node = self.root
+    for level in levels[:-1] if levels[-1] == '#' else levels:
+      child = node.children.get(level)
+      if child is None:
+        child = node.children[level] = cMQTTTopicNode()
+      node = child
+    entry = (handler, asyncio.iscoroutinefunction(handler))
+    if levels[-1] == '#':
+      node.hash_handlers.append(entry)
+    else:
+      node.handlers.append(entry)
+    self.filters[topic_filter] += 1
+    return handler
+
+
+  #------------------- Unregister a handler (None : all the filter handlers)
+  # Returns the number of handlers left on the filter
+
+  def Remove(self, topic_filter, handler=None):
+
+    levels = self.CheckFilter(topic_filter)
+    hashed = levels[-1] == '#'
+    if hashed:
+      levels = levels[:-1]
+    path = [self.root]
+    for level in levels:
+      node = path[-1].children.get(level)
+      if node is None:
+        return 0
+      path.append(node)
+
+    node = path[-1]
+    entries = node.hash_handlers if hashed else node.handlers
+    kept = [e for e in entries if (handler is not None) and (e[0] != handler)]
+    removed = len(entries) - len(kept)
+    entries[:] = kept
+
+    for level, parent, child in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+      if child.children or child.handlers or child.hash_handlers:
+        break
+      del parent.children[level]                               # Prune empty branches
+
+    self.filters[topic_filter] -= removed
+    if self.filters[topic_filter] <= 0:
+      del self.filters[topic_filter]
+      return 0
+    return self.filters[topic_filter]
+
+
+  #--------------------------------------- Get the handlers matching a topic
+
+  def Match(self, topic):
+
+    levels = self.Levels(topic)
+    matched = []
+    nodes = (self.root,)
+    system = topic.startswith('$')         # No wildcard match at the first level
+
+    for level in levels:
+      following = []
+      for node in nodes:
+        if node.hash_handlers and not system:
+          matched.extend(node.hash_handlers)
+        child = node.children.get(level)
+        if child is not None:
+          following.append(child)
+        if not system:
+          child = node.children.get('+')
+          if child is not None:
+            following.append(child)
+      if not following:
+        return matched
+      nodes = following
+      system = False
+
+    for node in nodes:
+      matched.extend(node.handlers)
+      matched.extend(node.hash_handlers)   # 'a/#' matches 'a'
+    return matched
+
+
+  #--------------------------------- Call the handlers of a received message
+  # Returns the number of handlers called
+
+  def Dispatch(self, topic, payload, qos=0, properties=None):
+
+    matched = self.Match(topic)
+    if not matched:
+      self.unrouted += 1
+      return 0
+
+    self.dispatched += 1
+    for handler, is_async in matched:
+      try:
+        if is_async:
+          task = self.loop.create_task(handler(topic, payload, qos, properties), name=topic)
+          self.tasks.add(task)
+          task.add_done_callback(self.HandlerDone)
+        else:
+          handler(topic, payload, qos, properties)
+      except Exception:
+        self.errors += 1
+        self.logger.exception('%s > Handler error for topic [%s]', self.name, topic)
+    return len(matched)
+
+
+  #------------------------------------------------ End of an async handler
+
+  def HandlerDone(self, task):
+
+    self.tasks.discard(task)
+    if (not task.cancelled()) and (task.exception() is not None):
+      self.errors += 1
+      self.logger.error('%s > Handler error for topic [%s]', self.name, task.get_name(), exc_info=task.exception())
+
+
+  #---------------------------------------------------------------- Statistics
+
+  def Stats(self):
+    return {'filters'   : len(self.filters),
+            'handlers'  : sum(self.filters.values()),
+            'dispatched': self.dispatched,
+            'unrouted'  : self.unrouted,
+            'errors'    : self.errors,
+            'running'   : len(self.tasks),
+            'cached'    : len(self.cache)}
+
+
+###############################################################################
+#                                                                             #
+#                          OFFLINE PUBLISH QUEUE                              #
+#                                                                             #
+###############################################################################
+
+# Messages published while the client is not connected are kept in a bounded
+# queue, and sent again in order once connected (see cGMQTTClient.Replay).
+#
+# When the queue is full (max_messages or max_bytes), the drop policy decides :
+#   QUEUE_DROP_OLDEST : the oldest queued message is dropped
+#   QUEUE_DROP_NEWEST : the new message is dropped
+#   QUEUE_DROP_TOPIC  : the oldest queued message of the same topic is dropped
+#                       (each topic keeps its latest values), else the oldest
+#
+# With a spill file, every queued message is also appended to the file, which is
+# read back on startup : messages survive a restart. The file is truncated when
+# the queue is empty, and rewritten from memory when sent or dropped messages
+# make it more than twice the size of the queued records. Records : qos/retain (1 byte), topic length (2), payload
+# length (4), topic (UTF-8), payload.
+
+QUEUE_DROP_OLDEST = 'drop_oldest'
+QUEUE_DROP_NEWEST = 'drop_newest'
+QUEUE_DROP_TOPIC = 'drop_topic'
+
+SPILL_HEADER = struct.Struct('>BHI')
+
+class cMQTTPublishQueue():
+
+  #----------------------------------------------------------------- Constructor
+
+  def __init__(self, logger, name='MQTT', max_messages=10000, max_bytes=None, policy=QUEUE_DROP_OLDEST, spill_file=None):
+
+    self.logger = logger
+    self.name = name
+    self.max_messages = max_messages
+    self.max_bytes = max_bytes
+    self.policy = policy
+    self.messages = collections.OrderedDict()       # Sequence number -> (topic, payload, qos, retain)
+    self.topics = {}                                # Topic -> deque of sequence numbers (QUEUE_DROP_TOPIC)
+    self.sequence = 0
+    self.bytes = 0
+    self.record_bytes = 0                           # Size of the queued messages as spill file records
+    self.queued = 0
+    self.dropped = 0
+    self.spill_file = spill_file
+    self.spill = None
+    self.spill_bytes = 0
+    if spill_file is not None:
+      self.Load()
+
+
+  def __len__(self):
+    return len(self.messages)
+
+
+  #------------------------------------------------------------ Queue a message
+  # Returns False if the message was dropped
+
+  def Put(self, topic, payload, qos=0, retain=False, spill=True):
+
+    if isinstance(payload, str):
+      payload = payload.encode()
+    size = len(topic) + len(payload)
+
+    while self.messages and self.Full(size):
+      if self.policy == QUEUE_DROP_NEWEST:
+        self.dropped += 1
+        return False
+      if (self.policy == QUEUE_DROP_TOPIC) and self.topics.get(topic):
+        self.Drop(self.topics[topic][0])
+      else:
+        self.Drop(next(iter(self.messages)))
+
+    self.sequence += 1
+    self.messages[self.sequence] = (topic, payload, qos, retain)
+    self.topics.setdefault(topic, collections.deque()).append(self.sequence)
+    self.bytes += size
+    self.record_bytes += self.RecordSize(topic, payload)
+    self.queued += 1
+    if spill and (self.spill_file is not None):
+      self.Spill(topic, payload, qos, retain)
+      self.CheckSpill()                             # Dropped messages are still in the file
+    return True
+
+
+  def Full(self, size):
+    return ((self.max_messages is not None) and (len(self.messages) >= self.max_messages)) or \
+           ((self.max_bytes is not None) and (self.bytes + size > self.max_bytes))
+
+
+  #----------------------------------------------- Drop a queued message
+
+  def Drop(self, sequence):
+    self.Remove(sequence)
+    self.dropped += 1
+
+
+  def Remove(self, sequence):
+    topic, payload, qos, retain = self.messages.pop(sequence)
+    sequences = self.topics[topic]
+    sequences.popleft()                             # (Always the oldest message of its topic)
+    if not sequences:
+      del self.topics[topic]
+    self.bytes -= len(topic) + len(payload)
+    self.record_bytes -= self.RecordSize(topic, payload)
+
+
+  #------------------------------------------ Oldest message (None : empty)
+
+  def Peek(self):
+    if not self.messages:
+      return None
+    return next(iter(self.messages.items()))
+
+
+  #---------------------------------------- Remove the oldest (sent) message
+
+  def Pop(self):
+    sequence = next(iter(self.messages))
+    self.Remove(sequence)
+    if not self.messages:
+      self.Truncate()
+    else:
+      self.CheckSpill()
+
+
+  #----------------------------------------------------- Spill file : append
+
+  def Record(self, topic, payload, qos, retain):
+    topic = topic.encode()
+    return SPILL_HEADER.pack(qos | (0x80 if retain else 0), len(topic), len(payload)) + topic + payload
+
+
+  def RecordSize(self, topic, payload):
+    return SPILL_HEADER.size + len(topic.encode()) + len(payload)
+
+
+  def Spill(self, topic, payload, qos, retain):
+    try:
+      if self.spill is None:
+        self.spill = open(self.spill_file, 'ab')
+      record = self.Record(topic, payload, qos, retain)
+      self.spill.write(record)
+      self.spill.flush()
+      self.spill_bytes += len(record)
+    except OSError as e:
+      self.SpillError(e)
+
+
+  def SpillError(self, e):
+    self.logger.error('%s > Spill file %s : %s (no more persistence)', self.name, self.spill_file, e)
+    self.Close()
+    self.spill_file = None
+
+
+  #--------------------------------- Spill file : empty (queue sent to broker)
+
+  def Truncate(self):
+    if self.spill_file is not None:
+      self.Close()
+      try:
+        open(self.spill_file, 'wb').close()
+        self.spill_bytes = 0
+      except OSError as e:
+        self.SpillError(e)
+
+
+  #---------------------- Spill file : rewrite it when mostly removed messages
+
+  def CheckSpill(self):
+    if (self.spill_file is not None) and (self.spill_bytes > 2 * self.record_bytes + 65536):
+      self.Compact()
+
+
+  #----------------------------- Spill file : rewrite from the queue content
+
+  def Compact(self):
+    if self.spill_file is not None:
+      self.Close()
+      temporary = self.spill_file + '.tmp'
+      try:
+        with open(temporary, 'wb') as f:
+          for message in self.messages.values():
+            f.write(self.Record(*message))
+        os.replace(temporary, self.spill_file)
+        self.spill_bytes = os.path.getsize(self.spill_file)
+      except OSError as e:
+        self.SpillError(e)
+
+
+  #------------------------------------- Spill file : read back (startup)
+
+  # (One record at a time : the file may be much bigger than the queue)
+
+  def Load(self):
+    try:
+      with open(self.spill_file, 'rb') as f:
+        while True:
+          header = f.read(SPILL_HEADER.size)
+          if len(header) < SPILL_HEADER.size:
+            break
+          flags, topic_length, payload_length = SPILL_HEADER.unpack(header)
+          data = f.read(topic_length + payload_length)
+          if len(data) < topic_length + payload_length:
+            break                                   # Truncated record (crash while writing)
+          self.Put(data[:topic_length].decode(), data[topic_length:], flags & 0x7F, bool(flags & 0x80), spill=False)
+    except FileNotFoundError:
+      return
+    except OSError as e:
+      self.logger.error('%s > Spill file %s : %s', self.name, self.spill_file, e)
+      return
+
+    self.logger.info('%s > %d queued messages read from %s', self.name, len(self.messages), self.spill_file)
+    self.Compact()
+
+
+  #------------------------------------------------------------------ Close
+
+  def Close(self):
+    if self.spill is not None:
+      self.spill.close()
+      self.spill = None
+
+
+  #---------------------------------------------------------------- Statistics
+
+  def Stats(self):
+    return {'messages': len(self.messages),
+            'bytes'   : self.bytes,
+            'queued'  : self.queued,
+            'dropped' : self.dropped,
+            'spilled' : self.spill_bytes}
+
+
+###############################################################################
+#                                                                             #
+#                           PAYLOAD ENCODING                                  #
+#                                                                             #
+###############################################################################
+
+# cGMQTTClient encodes payloads to bytes before giving them to gmqtt, with a
+# pluggable serializer (serializer=...), e.g. msgpack.packb. The default one :
+# bytes unchanged, str in UTF-8, None empty, anything else in compact JSON.
+# In a batch (PublishMany, PublishToMany), a payload object sent to several
+# topics is encoded once.
+
+def EncodePayload(payload):
+  if isinstance(payload, (bytes, bytearray, memoryview)):
+    return payload
+  if isinstance(payload, str):
+    return payload.encode()
+  if payload is None:
+    return b''
+  return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+#==============================================================================
+# Collects the transport writes of gmqtt, to send many packets at once
+#==============================================================================
+
+class cWriteCollector():
+
+  __slots__ = ('chunks',)
+
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, data):
+    self.chunks.append(data)
+
+  def is_closing(self):
+    return False
+
+
 ###############################################################################
 #                                                                             #
 #                                MQTT CLASS                                   #
 #                                                                             #
 ###############################################################################
 
+# ==============================================================================
+# Connection states
+# ==============================================================================
+
+# The state is changed by SetState() only, which checks the transition and sets
+# the events tasks wait on (wait_connected(), MainLoop) : no polling.
+#
+#   DISCONNECTED -> CONNECTING -> CONNECTED -> DISCONNECTED -> (backoff) -> CONNECTING ...
+#                              -> FAILED -> (backoff) -> CONNECTING ...
+#                              -> DISCONNECTED (closed by the broker) -> FAILED ...
+#   any state -> STOPPED (task canceled)
+#
+# Reconnection uses exponential backoff with jitter : first retry after
+# reconnect_min (a few ms), doubled on each failure up to reconnect_max. The
+# delay goes back to reconnect_min once a connection stayed up reconnect_max s.
+
+MQTT_DISCONNECTED = 'DISCONNECTED'
+MQTT_CONNECTING = 'CONNECTING'
+MQTT_CONNECTED = 'CONNECTED'
+MQTT_FAILED = 'FAILED'
+MQTT_STOPPED = 'STOPPED'
+
+MQTT_TRANSITIONS = {MQTT_DISCONNECTED: (MQTT_CONNECTING, MQTT_FAILED, MQTT_STOPPED),
+                    MQTT_CONNECTING  : (MQTT_CONNECTED, MQTT_FAILED, MQTT_DISCONNECTED, MQTT_STOPPED),
+                    MQTT_CONNECTED   : (MQTT_DISCONNECTED, MQTT_STOPPED),
+                    MQTT_FAILED      : (MQTT_CONNECTING, MQTT_STOPPED),
+                    MQTT_STOPPED     : ()}
+
+
+# ==============================================================================
+# gmqtt client without its own reconnection : cGMQTTClient.MainLoop reconnects
+# (gmqtt reconnects once even with 'reconnect_retries' = 0, racing MainLoop)
+# ==============================================================================
+
+class cGMQTTNoReconnect (gmqtt.Client):
+  
+  async def reconnect (self, delay=False):
+    pass
+
+
 # ==============================================================================
 # Main MQTT client class using gmqtt
 # ==============================================================================
 
 # KNOWN PROBLEMS :
 #
-#  - GMQTT methods such as 'connect' run on the default running loop.
-#    I didn't find how to specify the event loop to use.
-#    If you created your own event loop, 'connect' does crash because
-#    it awaits on a different loop !
-#      -> Initialize your loop with get_event_loop() and not new_event_loop()
+#  - GMQTT methods such as 'connect' run on the current event loop of the thread
+#    (asyncio.get_event_loop()). I didn't find how to specify the event loop to use.
+#    If you created your own loop without setting it as the current one,
+#    'connect' does crash because it awaits on a different loop !
+#      -> Create your loop with asyncio_toolbox.GetEventLoop() (uvloop or
+#         asyncio, set as the current loop), not with new_event_loop()
 #
 #  - If connection is closed by peer, we receive the callback "OnDisconnect",
 #    but GMQTT still tries to write on socket, and generates
 #    [TRYING WRITE TO CLOSED SOCKET]
 #
+#  - GMQTT writes every packet to the transport separately (one send() each).
+#    PublishMany() swaps the transport of the GMQTT protocol (private attribute)
+#    for a cWriteCollector during the batch, then writes all the packets at once.
+#    If GMQTT internals change, it falls back to separate writes.
+#
 
 class cGMQTTClient ():
   
   #----------------------------------------------------------------- Constructor
   
-  def __init__ (self, loop, logger, hostname='127.0.0.1', client_id="default-mqtt-client"):
+  def __init__ (self, loop, logger, hostname='127.0.0.1', client_id="default-mqtt-client",
+                queue_size=10000, queue_bytes=None, queue_policy=QUEUE_DROP_OLDEST, spill_file=None, replay_rate=200,
+                port=1883, serializer=EncodePayload, coalesce=None,
+                reconnect_min=0.005, reconnect_max=5.0, connect_timeout=10.0):
     
-    self.loop = loop
+    self.loop = loop or GetEventLoop()     # None : loop from GetEventLoop()
     self.logger = logger
     self.hostname = hostname               # MQTT broker hostname or IP
     self.client_id = client_id             # used both as instance name and MQTT client_id
-    self.port = 1883
+    self.port = port
     
-    self.connected = 'DISCONNECTED'        # DISCONNECTED, CONNECTING, CONNECTED, FAILED
+    self.state = MQTT_DISCONNECTED         # See MQTT_TRANSITIONS, changed by SetState()
+    self.connected_event = asyncio.Event ()    # Set while CONNECTED
+    self.disconnected_event = asyncio.Event () # Set while not CONNECTED
+    self.disconnected_event.set ()
     self.canceled = False
+    self.reconnect_min = reconnect_min     # Reconnection backoff (s)
+    self.reconnect_max = reconnect_max
+    self.connect_timeout = connect_timeout
+    self.reconnections = 0
+    
+    self.router = cMQTTTopicRouter (self.loop, self.logger, self.client_id)   # Received messages -> handlers
+    self.subscriptions = {}                # Filter -> QoS (subscribed again on each connection)
+    
+    self.queue = cMQTTPublishQueue (self.logger, self.client_id, queue_size, queue_bytes, queue_policy, spill_file)
+    self.replay_rate = replay_rate         # Queued messages sent per second after (re)connection
+    self.replay = None                     # Replay task
+    
+    self.serializer = serializer           # Payload object -> bytes
+    self.coalesce = coalesce               # Coalescing window (s), None = disabled
+    self.coalesced = {}                    # Topic -> (payload, qos, retain) waiting for the end of the window
+    self.coalesce_timer = None
+    self.published = 0
+    self.superseded = 0                    # Coalesced messages replaced by a newer value
     
     self.logger.info ("MQTT initializing client %s " % (self.client_id))
-    self.client = gmqtt.Client (self.client_id)
+    self.client = cGMQTTNoReconnect (self.client_id)
     if self.client is None:
       self.logger.info ("  Error initializing client %s " % (self.client_id))
     else:
-      self.client.set_config ({'reconnect_retries': 0, 'reconnect_delay': 0})    # does not seem to work
       self.client.on_connect = self.OnConnect
       self.client.on_message = self.OnMessage
       self.client.on_disconnect = self.OnDisconnect
@@ -103,30 +681,79 @@ class cGMQTTClient ():
     self.loop.create_task (self.MainLoop (), name = "%s MainLoop" % self.client_id)
   
   
+  #--------------------------------------------------------- Connection state
+  # (Kept as 'connected' for applications testing client.connected == 'CONNECTED')
+  
+  @property
+  def connected (self):
+    return self.state
+  
+  
+  def SetState (self, state):
+    
+    if state == self.state:
+      return
+    if state not in MQTT_TRANSITIONS[self.state]:
+      self.logger.warning ('%s > Unexpected state change %s -> %s', self.client_id, self.state, state)
+    self.state = state
+    if state == MQTT_CONNECTED:
+      self.disconnected_event.clear ()
+      self.connected_event.set ()
+    else:
+      self.connected_event.clear ()
+      self.disconnected_event.set ()
+  
+  
+  #---------------------------------------- Wait until connected to the broker
+  # Returns False on timeout (s)
+  
+  async def wait_connected (self, timeout=None):
+    
+    try:
+      await asyncio.wait_for (self.connected_event.wait (), timeout)
+      return True
+    except asyncio.TimeoutError:
+      return False
+  
+  
   #------------------------------------------------ Main asynchronous process
   
   async def MainLoop (self):
 
-    self.connected = 'CONNECTING'
+    delay = 0                              # Reconnection delay (0 : first connection)
     while not self.canceled:
       
       try:
 
-        # ---- Start / Try to connect to server
+        # ---- Wait before reconnecting (exponential backoff, with jitter)
+        
+        if delay:
+          wait = delay / 2 + random.uniform (0, delay / 2)
+          self.logger.info ("%s (Main Loop) Will retry in %.3f s..." % (self.client_id, wait))
+          await asyncio.sleep (wait)
+          self.reconnections += 1
+        
+        # ---- Try to connect to server
         
-        if (self.connected == 'FAILED') or (self.connected == "DISCONNECTED"):
-          self.logger.info ("%s (Main Loop) Previous MQTT connection failed. Will retry in 5s..." % self.client_id)
-          await asyncio.sleep(5)
-          
+        self.SetState (MQTT_CONNECTING)
         self.logger.info ("%s (Main Loop) MQTT connecting to broker..." % self.client_id)
-        await self.client.connect (self.hostname)
-        self.logger.info ("%s (Main Loop) MQTT connected to broker." % self.client_id)
-    
-        while self.connected == 'CONNECTED' :
-          # We are connected
-          # print("...MQTT connected")
-          await asyncio.sleep(1)
+        await asyncio.wait_for (self.client.connect (self.hostname, self.port), self.connect_timeout)
         
+        if self.state != MQTT_CONNECTED:
+          self.logger.info ("%s (Main Loop) Connection closed by broker." % self.client_id)
+          self.SetState (MQTT_FAILED)
+          delay = min (max (2 * delay, self.reconnect_min), self.reconnect_max)
+          continue
+        
+        # ---- Connected : wait for disconnection
+        
+        self.logger.info ("%s (Main Loop) MQTT connected to broker." % self.client_id)
+        since = self.loop.time ()
+        await self.disconnected_event.wait ()
+        if self.loop.time () - since >= self.reconnect_max:
+          delay = self.reconnect_min         # Stable connection : reconnect fast
+        else:
+          delay = min (max (2 * delay, self.reconnect_min), self.reconnect_max)
       
       # ---- Task canceled (receiving Ctrl+C or termination signal)
       
@@ -135,10 +762,13 @@ class cGMQTTClient ():
         
         # Clean up things here
         
-        if self.connected == 'CONNECTED' :
+        if self.state == MQTT_CONNECTED :
           self.logger.info ("%s (Main Loop) Disconnecting from MQTT broker..." % self.client_id)
+          self.SetState (MQTT_STOPPED)
           await self.client.disconnect ()
           self.logger.info ("%s (Main Loop) MQTT broker disconnected." % self.client_id)
+        self.SetState (MQTT_STOPPED)
+        self.queue.Close ()                # (Messages not sent stay in the spill file)
   
         self.logger.info ("%s (Main Loop) Task stopped gracefully." % self.client_id)
         self.canceled = True
@@ -147,17 +777,28 @@ class cGMQTTClient ():
       
       except ConnectionRefusedError :
         self.logger.info ("%s (Main Loop) Connection refused." % self.client_id)
-        self.connected = 'FAILED'
+        self.SetState (MQTT_FAILED)
+        delay = min (max (2 * delay, self.reconnect_min), self.reconnect_max)
         
-      except TimeoutError :
+      except (asyncio.TimeoutError, TimeoutError) :
         self.logger.info ("%s (Main Loop) Connection timeout." % self.client_id)
-        self.connected = 'FAILED'
+        self.SetState (MQTT_FAILED)
+        delay = min (max (2 * delay, self.reconnect_min), self.reconnect_max)
+        try:
+          await self.client.disconnect ()  # (Half-open connection)
+        except Exception:
+          pass
+        
+      except (OSError, gmqtt.MQTTConnectError) as e :
+        self.logger.info ("%s (Main Loop) Connection error : %s" % (self.client_id, e))
+        self.SetState (MQTT_FAILED)
+        delay = min (max (2 * delay, self.reconnect_min), self.reconnect_max)
   
       # ---- Unhandled exception
       
       except:
         self.logger.info ("%s (Main Loop) Unhandled exception." % self.client_id)
-        self.connected = 'FAILED'
+        self.SetState (MQTT_FAILED)
         raise
 
 
@@ -166,21 +807,45 @@ class cGMQTTClient ():
   
   def OnConnect (self, client, flags, rc, properties):
     self.logger.info ('%s > Client connected to broker.' % self.client_id)
-    self.connected = 'CONNECTED'
-    # client.subscribe ('TEST/#', qos=0)
+    self.SetState (MQTT_CONNECTED)
+    self.Resubscribe (client)
+    if len(self.queue) and ((self.replay is None) or self.replay.done()):
+      self.replay = self.loop.create_task (self.Replay (), name = "%s Replay" % self.client_id)
+
+
+  #----------------------------------------- Subscribe again after connecting
+  # gmqtt keeps the Subscription objects of subscribe() : they are sent again
+  # with resubscribe(), so that only Route() adds one (gmqtt scans that list on
+  # each SUBACK). Filters routed while disconnected are subscribed now.
+  
+  def Resubscribe (self, client):
+    held = {}
+    for sub in client.subscriptions:
+      if (sub.topic in self.subscriptions) and (sub.topic not in held):
+        held[sub.topic] = sub
+    client.subscriptions = list (held.values ())     # (Unrouted while disconnected : dropped)
+    for topic_filter, qos in self.subscriptions.items():
+      sub = held.get (topic_filter)
+      if sub is None:
+        client.subscribe (topic_filter, qos=qos)
+      else:
+        sub.qos = qos                      # (Replaced by the granted QoS on SUBACK)
+        client.resubscribe (sub)
 
 
   #------------------------------------------------------------ On Disconnect
 
   def OnDisconnect (self, client, packet, exc=None):
     self.logger.info ('%s > Disconnected from broker.' % self.client_id)
-    self.connected = 'DISCONNECTED'
+    if self.state != MQTT_STOPPED:
+      self.SetState (MQTT_DISCONNECTED)
 
 
   #------------------------------------------------------ On received message
   
   def OnMessage (self, client, topic, payload, qos, properties):
-    self.logger.info ('%s > Received MQTT message [%s] %s:', self.client_id, topic, payload)
+    if not self.router.Dispatch (topic, payload, qos, properties):
+      self.logger.info ('%s > Received MQTT message [%s] %s:', self.client_id, topic, payload)
   
     
   #---------------------------------------------------------- On Subscription
@@ -189,14 +854,496 @@ class cGMQTTClient ():
     print ('%s MQTT Subscribed' % self.client_id)
   
 
+  #------------------------------ Route messages matching a filter to a handler
+  # handler(topic, payload, qos, properties), plain function or coroutine function
+  
+  def Route (self, topic_filter, handler, qos=0):
+    
+    self.router.Add (topic_filter, handler)
+    if topic_filter not in self.subscriptions:
+      self.subscriptions[topic_filter] = qos
+      if (self.client is not None) and (self.state == MQTT_CONNECTED):
+        self.client.subscribe (topic_filter, qos=qos)
+    return handler
+  
+  
+  #------------------------- Remove a route (handler None : all its handlers)
+  
+  def Unroute (self, topic_filter, handler=None):
+    
+    if self.router.Remove (topic_filter, handler) == 0:
+      if self.subscriptions.pop (topic_filter, None) is not None:
+        if (self.client is not None) and (self.state == MQTT_CONNECTED):
+          self.client.unsubscribe (topic_filter)
+  
+  
   #------------------------------------------------------- Publishing messages
-
-  def Publish(self, topic, message):
-    if (self.client is not None) and (self.connected == 'CONNECTED'):
-      self.client.publish (topic, message)
-      self.logger.info ('%s > Published message : [%s] %s' % (self.client_id, topic, message))
+  # Queued when not connected, or when older messages are still queued (order).
+  # coalesce : True / False overrides the client default (coalesce window set)
+  
+  def Publish(self, topic, message, qos=0, retain=False, coalesce=None):
+    if self.coalesce and (coalesce is not False):
+      self.Coalesce (topic, message, qos, retain)
+      return
+    payload = self.serializer (message)
+    if (self.client is not None) and (self.state == MQTT_CONNECTED) and not len(self.queue):
+      self.client.publish (topic, payload, qos=qos, retain=retain)
+      self.published += 1
+      if self.logger.isEnabledFor (logging.DEBUG):
+        self.logger.debug ('%s > Published message : [%s] %d bytes', self.client_id, topic, len(payload))
+    elif not self.queue.Put (topic, payload, qos, retain):
+      self.logger.debug ('%s > Queue full, message dropped : [%s]', self.client_id, topic)
+  
+  
+  #------------------------------------------------ Publish a batch of messages
+  # messages : iterable of (topic, payload), or dict {topic: payload}
+  # The packets are written to the socket at once (see KNOWN PROBLEMS)
+  
+  def PublishMany(self, messages, qos=0, retain=False):
+    
+    if isinstance(messages, dict):
+      messages = messages.items()
+    last_message = last_payload = None
+    def Encode(message):                               # (Same object as previous message : encoded once)
+      nonlocal last_message, last_payload
+      if (message is not last_message) or (last_payload is None):
+        last_message, last_payload = message, self.serializer (message)
+      return last_payload
+    
+    if (self.client is None) or (self.state != MQTT_CONNECTED) or len(self.queue):
+      for topic, message in messages:
+        if not self.queue.Put (topic, Encode (message), qos, retain):
+          self.logger.debug ('%s > Queue full, message dropped : [%s]', self.client_id, topic)
+      return
+    
+    protocol = getattr (getattr (self.client, '_connection', None), '_protocol', None)
+    transport = getattr (protocol, '_transport', None)
+    if transport is not None:
+      collector = protocol._transport = cWriteCollector ()
+    count = 0
+    try:
+      publish = self.client.publish
+      for topic, message in messages:
+        publish (topic, Encode (message), qos=qos, retain=retain)
+        count += 1
+    finally:
+      if transport is not None:
+        protocol._transport = transport
+        if collector.chunks and not transport.is_closing ():
+          transport.write (b''.join (collector.chunks))
+    self.published += count
+    if self.logger.isEnabledFor (logging.DEBUG):
+      self.logger.debug ('%s > Published %d messages', self.client_id, count)
+  
+  
+  #------------------------------ Publish the same payload to many topics (batch)
+  
+  def PublishToMany(self, topics, message, qos=0, retain=False):
+    self.PublishMany (((topic, message) for topic in topics), qos, retain)
+  
+  
+  #------------------------------ Coalescing : keep only the latest value per topic
+  # Messages are sent at the end of the window, in a single batch
+  
+  def Coalesce(self, topic, message, qos=0, retain=False):
+    if topic in self.coalesced:
+      self.superseded += 1
+    self.coalesced[topic] = (message, qos, retain)
+    if self.coalesce_timer is None:
+      self.coalesce_timer = self.loop.call_later (self.coalesce, self.FlushCoalesced)
+  
+  
+  def FlushCoalesced(self):
+    self.coalesce_timer = None
+    pending, self.coalesced = self.coalesced, {}
+    batches = collections.defaultdict (list)           # (qos, retain) -> [(topic, payload)]
+    for topic, (message, qos, retain) in pending.items():
+      batches[(qos, retain)].append ((topic, message))
+    for (qos, retain), messages in batches.items():
+      self.PublishMany (messages, qos, retain)
+  
+  
+  #----------------------------------- Send the queued messages, in order
+  # Rate limited (replay_rate messages/s) so that a reconnection does not flood
+  # the broker. Stops when disconnected : the remaining messages stay queued.
+  
+  async def Replay(self):
+    
+    count = len(self.queue)
+    self.logger.info ('%s > Sending %d queued messages...', self.client_id, count)
+    bucket = cTokenBucket (self.replay_rate, max(1, self.replay_rate // 10)) if self.replay_rate else None
+    sent = 0
+    while len(self.queue) and (self.state == MQTT_CONNECTED):
+      if (bucket is not None) and not bucket.Take ():
+        await asyncio.sleep (1 / self.replay_rate)
+        continue
+      sequence, (topic, payload, qos, retain) = self.queue.Peek ()
+      self.client.publish (topic, payload, qos=qos, retain=retain)
+      self.queue.Pop ()
+      sent += 1
+      if (bucket is None) and (sent % 100 == 0):
+        await asyncio.sleep (0)          # Let the transport write
+    self.logger.info ('%s > %d queued messages sent, %d left.', self.client_id, sent, len(self.queue))
       
 
+###############################################################################
+#                                                                             #
+#                          LOCAL MQTT BROKER                                  #
+#                                                                             #
+###############################################################################
+
+# Minimal in-process MQTT 3.1.1 / 5.0 broker on cTCPServer, to test and
+# benchmark cGMQTTClient without external infrastructure :
+#
+#   broker = cMQTTBroker (loop, 'BROKER', '127.0.0.1', 1883)
+#   broker.start_server ()
+#   ...
+#   broker.Stats ()        # Throughput since last call, lag of each subscriber
+#
+# Supported : CONNECT, SUBSCRIBE / UNSUBSCRIBE (wildcards, through the topic
+# router), PUBLISH QoS 0 and 1, PINGREQ, DISCONNECT. Not supported : QoS 2
+# (MQTT 5 clients are told Maximum QoS = 1), retained messages, wills,
+# authentication, persistent sessions. v5 properties are skipped.
+#
+# Subscriber lag : bytes waiting in its write buffer (backlog), QoS 1 messages
+# not acknowledged yet (in flight), and QoS 1 acknowledgement delay (time from
+# the PUBLISH received by the broker to the PUBACK of the subscriber).
+
+MQTT_PACKET_CONNECT = 1
+MQTT_PACKET_PUBLISH = 3
+MQTT_PACKET_PUBACK = 4
+MQTT_PACKET_SUBSCRIBE = 8
+MQTT_PACKET_UNSUBSCRIBE = 10
+MQTT_PACKET_PINGREQ = 12
+MQTT_PACKET_DISCONNECT = 14
+
+MQTT_CONNACK_V3 = b'\x20\x02\x00\x00'
+MQTT_CONNACK_V5 = b'\x20\x07\x00\x00\x04\x24\x01\x25\x00'          # Maximum QoS 1, no retain
+MQTT_CONNACK_BAD_VERSION = b'\x20\x02\x00\x01'
+MQTT_PINGRESP = b'\xd0\x00'
+MQTT_DISCONNECT_QOS_NOT_SUPPORTED = b'\xe0\x01\x9b'
+
+
+#==============================================================================
+# MQTT variable byte integers
+#==============================================================================
+
+# (MQTTEncodeLength : from asyncio_tcp_toolbox, also used by cTCPFramerMQTT)
+
+def MQTTDecodeLength(buf, pos):                      # Returns (value, next position)
+  value = 0
+  shift = 0
+  while True:
+    byte = buf[pos]
+    pos += 1
+    value |= (byte & 0x7F) << shift
+    if not byte & 0x80:
+      return value, pos
+    shift += 7
+
+
+#==============================================================================
+# Subscription of a session (handler of the broker topic router)
+#==============================================================================
+
+class cMQTTBrokerSubscription():
+
+  __slots__ = ('session', 'qos', 'no_local')
+
+  def __init__(self, session, qos, no_local=False):
+    self.session = session
+    self.qos = qos
+    self.no_local = no_local                         # (MQTT 5) Not sent back to the publisher
+
+
+#==============================================================================
+# Broker protocol : one client session
+#==============================================================================
+
+class cMQTTBrokerProtocol(cTCPServerProtocol):
+
+  #----------------------------------------------------------------- Constructor
+
+  def __init__(self, parent):
+    super().__init__(parent=parent)
+    self.broker = parent
+    self.client_id = None                            # Set by CONNECT
+    self.level = 4                                   # Protocol level : 4 = 3.1.1, 5 = 5.0
+    self.subscriptions = {}                          # Filter -> cMQTTBrokerSubscription
+    self.next_mid = 0
+    self.inflight = {}                               # Packet id -> time received by the broker (QoS 1 sent)
+    self.lag = cHistogram()                          # QoS 1 acknowledgement delay
+    self.messages_out = 0
+    self.bytes_out = 0
+    self.dropped = 0
+    self.unacked = 0                                 # In flight messages forgotten (max_inflight)
+
+
+  #------------------------------------------------------------ Received packet
+
+  def frame_received(self, frame):
+
+    kind = frame[0] >> 4
+    length, pos = MQTTDecodeLength(frame, 1)
+    if self.client_id is None:
+      if kind == MQTT_PACKET_CONNECT:
+        self.on_connect(frame, pos)
+      else:
+        self.transport.close()                       # (First packet must be CONNECT)
+    elif kind == MQTT_PACKET_PUBLISH:
+      self.on_publish(frame, pos)
+    elif kind == MQTT_PACKET_PUBACK:
+      self.on_puback(frame, pos)
+    elif kind == MQTT_PACKET_SUBSCRIBE:
+      self.on_subscribe(frame, pos)
+    elif kind == MQTT_PACKET_UNSUBSCRIBE:
+      self.on_unsubscribe(frame, pos)
+    elif kind == MQTT_PACKET_PINGREQ:
+      self.send_data(MQTT_PINGRESP)
+    elif kind == MQTT_PACKET_DISCONNECT:
+      self.transport.close()
+
+
+  #----------------------------------------------------------------- CONNECT
+
+  def on_connect(self, frame, pos):
+
+    name_length = int.from_bytes(frame[pos:pos + 2], 'big')
+    pos += 2 + name_length
+    self.level = frame[pos]
+    if self.level not in (4, 5):
+      self.send_data(MQTT_CONNACK_BAD_VERSION)
+      self.transport.close()
+      return
+    pos += 4                                         # Level, flags, keepalive
+    if self.level == 5:
+      length, pos = MQTTDecodeLength(frame, pos)
+      pos += length
+    id_length = int.from_bytes(frame[pos:pos + 2], 'big')
+    client_id = bytes(frame[pos + 2:pos + 2 + id_length]).decode(errors='replace')
+    if not client_id:
+      self.broker.anonymous += 1
+      client_id = '%s-%d' % (self.broker.server_name, self.broker.anonymous)
+
+    previous = self.broker.sessions.get(client_id)
+    if previous is not None:                         # Session takeover
+      previous.close_session()
+      previous.transport.close()
+    self.client_id = client_id
+    self.broker.sessions[client_id] = self
+    self.send_data(MQTT_CONNACK_V5 if self.level == 5 else MQTT_CONNACK_V3)
+
+
+  #----------------------------------------------------------------- PUBLISH
+
+  def on_publish(self, frame, pos):
+
+    qos = (frame[0] >> 1) & 0x03
+    topic_length = int.from_bytes(frame[pos:pos + 2], 'big')
+    topic = bytes(frame[pos + 2:pos + 2 + topic_length])
+    pos += 2 + topic_length
+    if qos:
+      if qos > 1:
+        if self.level == 5:
+          self.send_data(MQTT_DISCONNECT_QOS_NOT_SUPPORTED)
+        self.transport.close()
+        return
+      self.send_data(b'\x40\x02' + bytes(frame[pos:pos + 2]))        # PUBACK
+      pos += 2
+    if self.level == 5:
+      length, pos = MQTTDecodeLength(frame, pos)
+      pos += length
+    self.broker.Route(topic, bytes(frame[pos:]), qos, self)
+
+
+  #----------------------------------------------- PUBACK (from a subscriber)
+
+  def on_puback(self, frame, pos):
+    received = self.inflight.pop(int.from_bytes(frame[pos:pos + 2], 'big'), None)
+    if received is not None:
+      self.lag.Record(self.loop.time() - received)
+
+
+  #--------------------------------------------------------------- SUBSCRIBE
+
+  def on_subscribe(self, frame, pos):
+
+    mid = bytes(frame[pos:pos + 2])
+    pos += 2
+    if self.level == 5:
+      length, pos = MQTTDecodeLength(frame, pos)
+      pos += length
+    codes = bytearray()
+    while pos < len(frame):
+      length = int.from_bytes(frame[pos:pos + 2], 'big')
+      topic_filter = bytes(frame[pos + 2:pos + 2 + length]).decode(errors='replace')
+      options = frame[pos + 2 + length]
+      pos += 3 + length
+      qos = min(options & 0x03, 1)
+      try:
+        if topic_filter in self.subscriptions:
+          self.broker.router.Remove(topic_filter, self.subscriptions.pop(topic_filter))
+        subscription = cMQTTBrokerSubscription(self, qos, (self.level == 5) and bool(options & 0x04))
+        self.broker.router.Add(topic_filter, subscription)
+        self.subscriptions[topic_filter] = subscription
+        codes.append(qos)
+      except ValueError:
+        codes.append(0x80)                           # Invalid filter
+    body = mid + (b'\x00' if self.level == 5 else b'') + bytes(codes)
+    self.send_data(b'\x90' + MQTTEncodeLength(len(body)) + body)
+
+
+  #------------------------------------------------------------- UNSUBSCRIBE
+
+  def on_unsubscribe(self, frame, pos):
+
+    mid = bytes(frame[pos:pos + 2])
+    pos += 2
+    if self.level == 5:
+      length, pos = MQTTDecodeLength(frame, pos)
+      pos += length
+    count = 0
+    while pos < len(frame):
+      length = int.from_bytes(frame[pos:pos + 2], 'big')
+      topic_filter = bytes(frame[pos + 2:pos + 2 + length]).decode(errors='replace')
+      pos += 2 + length
+      subscription = self.subscriptions.pop(topic_filter, None)
+      if subscription is not None:
+        self.broker.router.Remove(topic_filter, subscription)
+      count += 1
+    body = mid + (b'\x00' + b'\x00' * count if self.level == 5 else b'')
+    self.send_data(b'\xb0' + MQTTEncodeLength(len(body)) + body)
+
+
+  #----------------------------------------- Send a message to this subscriber
+  # encoded : QoS 0 packets already built for this message, per protocol level
+
+  def deliver(self, topic, payload, qos, received, encoded):
+
+    if qos == 0:
+      packet = encoded.get(self.level)
+      if packet is None:
+        properties = b'\x00' if self.level == 5 else b''
+        length = 2 + len(topic) + len(properties) + len(payload)
+        packet = encoded[self.level] = b''.join((b'\x30', MQTTEncodeLength(length), len(topic).to_bytes(2, 'big'), topic, properties, payload))
+    else:
+      self.next_mid = self.next_mid % 65535 + 1
+      if len(self.inflight) >= self.broker.max_inflight:
+        del self.inflight[next(iter(self.inflight))]
+        self.unacked += 1
+      self.inflight[self.next_mid] = received
+      properties = b'\x00' if self.level == 5 else b''
+      length = 4 + len(topic) + len(properties) + len(payload)
+      packet = b''.join((b'\x32', MQTTEncodeLength(length), len(topic).to_bytes(2, 'big'), topic,
+                         self.next_mid.to_bytes(2, 'big'), properties, payload))
+
+    if self.send_data(packet):
+      self.messages_out += 1
+      self.bytes_out += len(packet)
+      return True
+    self.dropped += 1
+    return False
+
+
+  #---------------------------------------------------- Remove the subscriptions
+
+  def close_session(self):
+    for topic_filter, subscription in self.subscriptions.items():
+      self.broker.router.Remove(topic_filter, subscription)
+    self.subscriptions = {}
+    if self.broker.sessions.get(self.client_id) is self:
+      del self.broker.sessions[self.client_id]
+
+
+  def connection_lost(self, exc):
+    self.close_session()
+    super().connection_lost(exc)
+
+
+  #---------------------------------------------------------- Subscriber stats
+
+  def SubscriberStats(self):
+    lag = self.lag.Snapshot()
+    transport = self.transport
+    return {'messages'     : self.messages_out,
+            'bytes'        : self.bytes_out,
+            'dropped'      : self.dropped,
+            'backlog_bytes': (transport.get_write_buffer_size() if transport is not None else 0) + self.pending_bytes,
+            'inflight'     : len(self.inflight),
+            'unacked'      : self.unacked,
+            'ack_ms'       : {k: lag[k] * 1000 for k in ('p50', 'p99', 'max')}}
+
+
+#==============================================================================
+# Broker
+#==============================================================================
+
+class cMQTTBroker(cTCPServer):
+
+  #----------------------------------------------------------------- Constructor
+
+  def __init__(self, loop, name='MQTT broker', local_address='127.0.0.1', local_port=1883, max_packet=1048576, max_inflight=10000, **kwargs):
+
+    super().__init__(loop, name, local_address, local_port, framer=lambda: cTCPFramerMQTT(max_packet), **kwargs)
+    self.protocol_class = cMQTTBrokerProtocol
+    self.router = cMQTTTopicRouter(self.loop, self.logger, name)
+    self.sessions = {}                               # Client id -> cMQTTBrokerProtocol
+    self.max_inflight = max_inflight                 # QoS 1 messages tracked per subscriber
+    self.anonymous = 0
+    self.messages_in = 0
+    self.bytes_in = 0                                # (Payloads)
+    self.messages_out = 0
+    self.unrouted = 0                                # Messages without subscriber
+    self.last_stats = (self.loop.time(), 0, 0)
+
+
+  #------------------------------------------ Send a message to its subscribers
+  # (Also used to publish from the broker itself : publisher None)
+
+  def Route(self, topic, payload, qos=0, publisher=None):
+
+    if isinstance(topic, str):
+      topic = topic.encode()
+    self.messages_in += 1
+    self.bytes_in += len(payload)
+    matched = self.router.Match(topic.decode(errors='replace'))
+    if not matched:
+      self.unrouted += 1
+      return 0
+
+    sessions = {}                                    # Session -> QoS (once per session, max QoS of its subscriptions)
+    for subscription, is_async in matched:
+      if subscription.no_local and (subscription.session is publisher):
+        continue
+      sessions[subscription.session] = max(sessions.get(subscription.session, 0), subscription.qos)
+
+    received = self.loop.time()
+    encoded = {}
+    for session, subscription_qos in sessions.items():
+      session.deliver(topic, payload, min(qos, subscription_qos), received, encoded)
+    self.messages_out += len(sessions)
+    return len(sessions)
+
+
+  #---------------------------------------------------------------- Statistics
+  # Rates are computed since the previous call
+
+  def Stats(self):
+    now = self.loop.time()
+    since, messages_in, messages_out = self.last_stats
+    elapsed = max(now - since, 1e-9)
+    self.last_stats = (now, self.messages_in, self.messages_out)
+    return {'clients'        : len(self.sessions),
+            'subscriptions'  : sum(self.router.filters.values()),
+            'messages_in'    : self.messages_in,
+            'messages_out'   : self.messages_out,
+            'bytes_in'       : self.bytes_in,
+            'unrouted'       : self.unrouted,
+            'in_per_s'       : (self.messages_in - messages_in) / elapsed,
+            'out_per_s'      : (self.messages_out - messages_out) / elapsed,
+            'subscribers'    : {client_id: session.SubscriberStats() for client_id, session in self.sessions.items() if session.subscriptions}}
+
+
 ################################################################################
 #                                                                              #
 #                                 M A I N                                      #
@@ -35,6 +35,655 @@ VersionDate = "23/05/2020"
 #===============================================================================
 
 import asyncio
+import collections
+import json
+import logging
+import multiprocessing
+import random
+import socket
+
+
+# Toolbox library imports (get those files and put them in the same folder as your app)
+
+from asyncio_toolbox import cTokenBucket, SetShutdownSignals, GetSharedTimer, GetEventLoop, NewEventLoop
+from metrics_toolbox import cMetrics
+from network_toolbox import SharedDNSCache
+
+
+#===============================================================================
+# Logging
+#===============================================================================
+
+# Servers and clients take a standard logging.Logger (like cGMQTTClient), and
+# use this module logger when none is given. Messages use lazy %-style
+# arguments, and per-client / per-frame messages are DEBUG only, guarded by
+# isEnabledFor() : with DEBUG disabled, the hot path formats nothing.
+
+Logger = logging.getLogger('asyncio_tcp_toolbox')
+
+
+################################################################################
+#                                                                              #
+#                               TCP FRAMING                                    #
+#                                                                              # 
+################################################################################
+
+# A framer splits the incoming TCP byte stream into complete messages (frames).
+# Each connection owns its own framer instance : received data is appended to a
+# growable bytearray, and every complete frame is handed to the callback as a
+# memoryview slice of that buffer (no copy).
+#
+# IMPORTANT : the memoryview given to the callback is only valid during the
+# callback. It is released just after. Use bytes(frame) if you need to keep it.
+#
+# The server / client classes take a framer *factory* (usually the class itself,
+# or a lambda with parameters), because a new framer is needed per connection :
+#
+#   cTCPServer (loop, 'AMI', '0.0.0.0', 5038, framer=cTCPFramerAMI)
+#   cTCPClient (loop, 'TLM', host, port, framer=lambda: cTCPFramerLengthPrefix(header_size=4))
+
+
+#===============================================================================
+# Exception raised when the stream can't be framed (corrupted / oversized)
+#===============================================================================
+
+class cTCPFramingError(Exception):
+  pass
+
+
+#===============================================================================
+# Base framer class
+# (Derive it and override NextFrame() for your own framing)
+#===============================================================================
+
+class cTCPFramer():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, max_frame=1048576):
+    self.buffer = bytearray()                    # Received data not yet framed
+    self.max_frame = max_frame                   # Max size of a frame (protection against garbage)
+    
+
+  #----------------------------------------------- Add data and extract frames
+  # Returns the number of frames given to callback
+  
+  def Feed(self, data, callback):
+    
+    buf = self.buffer
+    buf += data                                  # Amortized O(len(data)), no full buffer copy
+    
+    consumed = 0
+    frames = 0
+    with memoryview(buf) as view:
+      while True:
+        bounds = self.NextFrame(buf, consumed)   # (frame_start, frame_end, next_position) or None
+        if bounds is None:
+          break
+        start, end, consumed = bounds
+        frames = frames + 1
+        frame = view[start:end]
+        try:
+          callback(frame)
+        finally:
+          frame.release()
+    
+    if consumed:
+      del buf[:consumed]                         # Deleting from the head of a bytearray is cheap in CPython
+      self.Consumed(consumed)
+    return frames
+     
+
+  #------------------------------------------------- Find next complete frame
+  # Returns (frame_start, frame_end, next_position) or None if incomplete
+  
+  def NextFrame(self, buf, pos):
+    end = len(buf)
+    if end > pos:
+      return (pos, end, end)                     # Base class : no framing, deliver everything
+    return None
+  
+  
+  #------------------------------- Called when bytes are removed from the buffer
+  # (Override if your framer keeps positions in the buffer)
+  
+  def Consumed(self, count):
+    pass
+  
+  
+  #-------------------------------------------------- Clear the pending data
+  
+  def Reset(self):
+    self.buffer.clear()
+
+    
+  #------------------------------------------------ Build a frame for sending
+  
+  def Encode(self, payload):
+    return payload
+  
+  
+#===============================================================================
+# Length-prefixed frames : <length><payload>
+# (length is an unsigned integer of header_size bytes, not including itself)
+#===============================================================================
+
+class cTCPFramerLengthPrefix(cTCPFramer):
+  
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, header_size=2, byteorder='big', max_frame=1048576):
+    super().__init__(max_frame)
+    self.header_size = header_size
+    self.byteorder = byteorder
+    
+    
+  #------------------------------------------------- Find next complete frame
+  
+  def NextFrame(self, buf, pos):
+    start = pos + self.header_size
+    if len(buf) < start:
+      return None
+    length = int.from_bytes(buf[pos:start], self.byteorder)
+    if length > self.max_frame:
+      raise cTCPFramingError('Frame length %d exceeds maximum of %d bytes' % (length, self.max_frame))
+    end = start + length
+    if len(buf) < end:
+      return None
+    return (start, end, end)
+  
+  
+  #------------------------------------------------ Build a frame for sending
+  
+  def Encode(self, payload):
+    return len(payload).to_bytes(self.header_size, self.byteorder) + payload
+
+
+#===============================================================================
+# Fixed-size frames
+#===============================================================================
+
+class cTCPFramerFixedSize(cTCPFramer):
+  
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, frame_size):
+    super().__init__(frame_size)
+    self.frame_size = frame_size
+    
+    
+  #------------------------------------------------- Find next complete frame
+  
+  def NextFrame(self, buf, pos):
+    end = pos + self.frame_size
+    if len(buf) < end:
+      return None
+    return (pos, end, end)
+
+
+#===============================================================================
+# Delimiter-terminated frames (default : newline)
+# The delimiter is not included in the delivered frame.
+#===============================================================================
+
+class cTCPFramerDelimiter(cTCPFramer):
+  
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, delimiter=b'\n', max_frame=1048576):
+    super().__init__(max_frame)
+    self.delimiter = delimiter
+    self.scan = 0                                # Where to resume searching, so we never rescan old data
+    
+    
+  #------------------------------------------------- Find next complete frame
+  
+  def NextFrame(self, buf, pos):
+    found = buf.find(self.delimiter, max(pos, self.scan))
+    if found < 0:
+      if len(buf) - pos > self.max_frame:
+        raise cTCPFramingError('No delimiter found in the last %d bytes' % self.max_frame)
+      self.scan = max(pos, len(buf) - len(self.delimiter) + 1)
+      return None
+    end = found + len(self.delimiter)
+    self.scan = end
+    return (pos, found, end)
+    
+  
+  #------------------------------- Called when bytes are removed from the buffer
+  
+  def Consumed(self, count):
+    self.scan = max(0, self.scan - count)
+    
+  
+  #-------------------------------------------------- Clear the pending data
+  
+  def Reset(self):
+    super().Reset()
+    self.scan = 0
+    
+    
+  #------------------------------------------------ Build a frame for sending
+  
+  def Encode(self, payload):
+    return payload + self.delimiter
+
+
+#===============================================================================
+# Line frames, terminated by CR+LF
+#===============================================================================
+
+class cTCPFramerCRLF(cTCPFramerDelimiter):
+  
+  def __init__(self, max_frame=1048576):
+    super().__init__(b'\r\n', max_frame)
+
+
+#===============================================================================
+# Asterisk AMI frames : blocks of lines terminated by an empty line
+# (The greeting "Asterisk Call Manager/x.y" is a single line, sent once by the
+# server : use greeting=False on the server side)
+#===============================================================================
+
+class cTCPFramerAMI(cTCPFramerDelimiter):
+  
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, greeting=True, max_frame=1048576):
+    super().__init__(b'\r\n\r\n', max_frame)
+    self.expect_greeting = greeting
+    self.greeting = greeting                     # First line received is the greeting
+    
+    
+  #------------------------------------------------- Find next complete frame
+  
+  def NextFrame(self, buf, pos):
+    if self.greeting:
+      found = buf.find(b'\r\n', pos)
+      if found < 0:
+        return None
+      self.greeting = False
+      self.scan = found + 2
+      return (pos, found, found + 2)
+    return super().NextFrame(buf, pos)
+    
+  
+  #-------------------------------------------------- Clear the pending data
+  
+  def Reset(self):
+    super().Reset()
+    self.greeting = self.expect_greeting
+    
+
+#===============================================================================
+# MQTT control packets : fixed header (packet type + flags, then remaining
+# length on 1 to 4 bytes, 7 bits each). The frame is the whole packet.
+#===============================================================================
+
+def MQTTEncodeLength(value):                       # Remaining length (variable byte integer)
+  encoded = bytearray()
+  while True:
+    byte = value & 0x7F
+    value >>= 7
+    if value:
+      encoded.append(byte | 0x80)
+    else:
+      encoded.append(byte)
+      return bytes(encoded)
+
+
+class cTCPFramerMQTT(cTCPFramer):
+  
+  #------------------------------------------------- Find next complete frame
+  
+  def NextFrame(self, buf, pos):
+    length = 0
+    shift = 0
+    i = pos + 1
+    while True:
+      if i >= len(buf):
+        return None
+      byte = buf[i]
+      length |= (byte & 0x7F) << shift
+      i += 1
+      if not byte & 0x80:
+        break
+      shift += 7
+      if shift > 21:
+        raise cTCPFramingError('Invalid MQTT remaining length')
+    if length > self.max_frame:
+      raise cTCPFramingError('Frame length %d exceeds maximum of %d bytes' % (length, self.max_frame))
+    end = i + length
+    if len(buf) < end:
+      return None
+    return (pos, end, end)
+  
+  
+  #------------------------------- Build a packet (type + flags, then content)
+  
+  def Encode(self, payload, header=0x30):
+    return bytes((header,)) + MQTTEncodeLength(len(payload)) + payload
+
+
+################################################################################
+#                                                                              #
+#                               TCP METRICS                                    #
+#                                                                              # 
+################################################################################
+
+# cTCPServer / cTCPClient take an optional metrics registry (cMetrics, see
+# metrics_toolbox). Metrics are labeled with the server / client name.
+# Without registry (default), protocols only test self.metrics against None.
+
+#===============================================================================
+# Metrics of a server or client, shared by all its connections
+#===============================================================================
+
+class cTCPMetrics():
+
+  __slots__ = ('bytes_in', 'bytes_out', 'frames_in', 'frames_out', 'accepts', 'rejects',
+               'connects', 'reconnects', 'connect_failures', 'connect_time', 'drain_time')
+
+  def __init__(self, registry, server=None, client=None):
+    
+    labels = {'server': server} if server is not None else {'client': client}
+    self.bytes_in = registry.Counter('tcp_bytes_in_total', **labels)
+    self.bytes_out = registry.Counter('tcp_bytes_out_total', **labels)
+    self.frames_in = registry.Counter('tcp_frames_in_total', **labels)
+    self.frames_out = registry.Counter('tcp_frames_out_total', **labels)
+    self.drain_time = registry.Histogram('tcp_drain_seconds', **labels)      # Time spent with writing paused
+    
+    if server is not None:
+      self.accepts = registry.Counter('tcp_accepts_total', **labels)
+      self.rejects = {}
+      for reason in ('max_clients', 'max_per_ip', 'accept_rate'):
+        self.rejects[reason] = registry.Counter('tcp_rejects_total', reason=reason, **labels)
+    else:
+      self.connects = registry.Counter('tcp_connects_total', **labels)
+      self.reconnects = registry.Counter('tcp_reconnects_total', **labels)
+      self.connect_failures = registry.Counter('tcp_connect_failures_total', **labels)
+      self.connect_time = registry.Histogram('tcp_connect_seconds', **labels)
+
+
+################################################################################
+#                                                                              #
+#                          TCP PROTOCOL BASE CLASS                             #
+#                                                                              # 
+################################################################################
+
+# When the peer does not read fast enough, the transport write buffer grows.
+# Above the high water mark, AsyncIO calls pause_writing(), and resume_writing()
+# when the buffer drains below the low water mark. While paused, the overflow
+# policy of the connection decides what happens to new data :
+#
+#   OVERFLOW_BLOCK       : await send() waits until the peer reads again.
+#                          (send_data() can't wait : it queues, like DROP_OLDEST)
+#   OVERFLOW_DROP_OLDEST : data is queued (max_pending bytes), oldest is dropped
+#   OVERFLOW_DISCONNECT  : the connection is aborted
+#
+# Memory used per connection is then capped to high water mark + max_pending.
+#
+# Dead peers (e.g. a NAT mapping silently dropped) are detected by :
+#
+#   keepalive     : (idle, interval, count) TCP keepalive socket options
+#   idle_timeout  : connection aborted when nothing is received for that time
+#   ping_frame    : received ping_frame are answered with pong_frame; both are
+#                   not given to frame_received(). Use it with a framer.
+#   ping_interval : ping_frame is sent when nothing is received for that time.
+#
+# All connections of a loop share the same timer heap (see asyncio_toolbox) :
+# receiving data only updates a timestamp, no timer is rescheduled.
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DISCONNECT = 'disconnect'
+
+
+#===============================================================================
+# Base protocol class for TCP server and client protocols
+#===============================================================================
+
+class cTCPProtocol(asyncio.Protocol):
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, parent):
+    self.parent = parent                           # Parent cTCPServer / cTCPClient object
+    self.loop = parent.loop
+    self.logger = parent.logger
+    self.transport = None
+    self.framer = None                             # Created when connection is made
+    self.on_frame = self.frame_received            # Frame callback given to the framer
+    
+    self.last_activity = 0                         # loop.time() of last received data
+    self.last_ping = 0                             # loop.time() of last ping sent
+    self.idle_timer = None                         # Entry in the shared timer heap
+    
+    self.overflow_policy = parent.overflow_policy  # Can be changed for each connection
+    self.max_pending = parent.max_pending          # Max bytes queued while writing is paused
+    self.paused = False                            # Transport write buffer is above high water mark
+    self.can_write = None                          # asyncio.Event, only created when a send() has to wait
+    self.pending = collections.deque()             # Data queued while paused
+    self.pending_bytes = 0
+    self.dropped_frames = 0                        # Data dropped because of overflow
+    self.dropped_bytes = 0
+    
+    self.metrics = parent.tcp_metrics              # cTCPMetrics of the parent, or None
+    self.bytes_in = 0                              # Counters of this connection (only if metrics enabled)
+    self.bytes_out = 0
+    self.frames_in = 0
+    self.frames_out = 0
+    self.paused_at = 0
+
+
+  #------------------------------------------------------------- Connection Made
+  
+  def connection_made(self, transport):
+    self.transport = transport
+    if self.parent.framer is not None:
+      self.framer = self.parent.framer()
+    if self.parent.write_high_water is not None:
+      transport.set_write_buffer_limits(high=self.parent.write_high_water, low=self.parent.write_low_water)
+    if self.parent.keepalive is not None:
+      self.set_keepalive(transport.get_extra_info('socket'), *self.parent.keepalive)
+    if self.parent.ping_frame is not None:
+      self.on_frame = self.filter_ping
+    if self.parent.idle_timeout or self.parent.ping_interval:
+      self.last_activity = self.loop.time()
+      self.schedule_idle_check()
+      
+
+  #-------------------------------------------- Callback when connection is lost
+  
+  def connection_lost(self, exc):
+    if self.idle_timer is not None:
+      GetSharedTimer(self.loop).Cancel(self.idle_timer)
+      self.idle_timer = None
+    self.pending.clear()
+    self.pending_bytes = 0
+    if self.can_write is not None:
+      self.can_write.set()                         # Wakes up blocked send(), they will see the closed transport
+
+
+  #----------------------------------------- Transport buffer above high water
+
+  def pause_writing(self):
+    self.paused = True
+    self.paused_at = self.loop.time()
+    if self.can_write is not None:
+      self.can_write.clear()
+
+
+  #-------------------------------------- Transport buffer drained to low water
+
+  def resume_writing(self):
+    self.paused = False
+    if self.metrics is not None:
+      self.metrics.drain_time.Record(self.loop.time() - self.paused_at)
+    while self.pending and not self.paused:        # transport.write() may pause us again
+      data = self.pending.popleft()
+      self.pending_bytes = self.pending_bytes - len(data)
+      self.transport.write(data)
+    if (not self.paused) and (self.can_write is not None):
+      self.can_write.set()
+      
+      
+  #------------------------------------------------------------------ Send data
+  # Returns True if data was written or queued, False if dropped
+  
+  def send_data(self, data):
+    
+    if (self.transport is None) or self.transport.is_closing():
+      return False
+    
+    metrics = self.metrics
+    if metrics is not None:
+      self.bytes_out += len(data)
+      self.frames_out += 1
+      metrics.bytes_out.value += len(data)
+      metrics.frames_out.value += 1
+      
+    if not self.paused:
+      self.transport.write(data)
+      return True
+    
+    if self.overflow_policy == OVERFLOW_DISCONNECT:
+      self.logger.warning('%s : Peer %s does not read data, write buffer full. Aborting connection.', self.parent_name(), self.peer_name())
+      self.transport.abort()
+      return False
+    
+    self.pending.append(data)
+    self.pending_bytes = self.pending_bytes + len(data)
+    while self.pending_bytes > self.max_pending:
+      dropped = self.pending.popleft()
+      self.pending_bytes = self.pending_bytes - len(dropped)
+      self.dropped_frames = self.dropped_frames + 1
+      self.dropped_bytes = self.dropped_bytes + len(dropped)
+      if not self.pending:                          # The new data itself (last in the queue) : by position, as
+        return False                                # broadcasts queue the same bytes object several times
+    return True
+    
+    
+  #------------------------------------------- Send data, waiting if needed
+  # With OVERFLOW_BLOCK policy, waits until the peer has read enough data.
+  
+  async def send(self, data):
+    
+    while self.paused and (self.overflow_policy == OVERFLOW_BLOCK) and not self.transport.is_closing():
+      if self.can_write is None:
+        self.can_write = asyncio.Event()
+      await self.can_write.wait()
+    return self.send_data(data)
+    
+
+  #------------------------------------------------- Callback when data is received
+  
+  def data_received(self, data):
+    
+    self.last_activity = self.loop.time()
+    
+    if self.framer is None:
+      frames = 1
+      self.on_frame(data)
+    else:
+      try:
+        frames = self.framer.Feed(data, self.on_frame)      # Incomplete message is kept by the framer until next call
+      except cTCPFramingError as e:
+        self.logger.warning('%s : Framing error from %s (%s). Closing connection.', self.parent_name(), self.peer_name(), e)
+        self.transport.close()
+        return
+    
+    metrics = self.metrics
+    if metrics is not None:
+      self.bytes_in += len(data)
+      self.frames_in += frames
+      metrics.bytes_in.value += len(data)
+      metrics.frames_in.value += frames
+
+
+  #------------------------------------- Callback when a full frame is received
+  # (Override with your own method)
+  # frame is a memoryview, only valid during the call : use bytes(frame) to keep it.
+  # Without framer, frame is the raw data chunk received.
+
+  def frame_received(self, frame):
+    pass
+  
+
+  #--------------------------------- Answer pings, hide pings / pongs from app
+  
+  def filter_ping(self, frame):
+    if frame == self.parent.ping_frame:
+      self.send_data(self.encode(self.parent.pong_frame))
+    elif frame != self.parent.pong_frame:
+      self.frame_received(frame)
+
+
+  #---------------------------------------------- Encode a frame for sending
+  
+  def encode(self, payload):
+    if self.framer is None:
+      return payload
+    return self.framer.Encode(payload)
+
+
+  #---------------------------------------------------- TCP keepalive options
+  # (TCP_KEEPIDLE / TCP_KEEPINTVL / TCP_KEEPCNT are not available everywhere)
+  
+  def set_keepalive(self, sock, idle, interval, count):
+    if sock is None:
+      return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+      if hasattr(socket, option):
+        sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+  #---------------------------------------------- Schedule next idle check
+  
+  def schedule_idle_check(self):
+    
+    deadlines = []
+    if self.parent.idle_timeout:
+      deadlines.append(self.last_activity + self.parent.idle_timeout)
+    if self.parent.ping_interval:
+      deadlines.append(max(self.last_activity, self.last_ping) + self.parent.ping_interval)
+    self.idle_timer = GetSharedTimer(self.loop).Schedule(min(deadlines), self.check_idle)
+  
+  
+  #------------------------------------------- Check idle connection (timer)
+  
+  def check_idle(self):
+    
+    self.idle_timer = None
+    if (self.transport is None) or self.transport.is_closing():
+      return
+    
+    now = self.loop.time()
+    idle = now - self.last_activity
+    if self.parent.idle_timeout and (idle >= self.parent.idle_timeout):
+      self.logger.info('%s : Nothing received from %s for %.1f s. Closing connection.', self.parent_name(), self.peer_name(), idle)
+      self.transport.abort()
+      return
+    
+    if self.parent.ping_interval and (self.parent.ping_frame is not None) and (now - max(self.last_activity, self.last_ping) >= self.parent.ping_interval):
+      self.last_ping = now
+      self.send_data(self.encode(self.parent.ping_frame))
+    
+    self.schedule_idle_check()
+
+
+  #----------------------------------------------- Name of the peer (for logs)
+  
+  def peer_name(self):
+    peer = self.transport.get_extra_info('peername') if self.transport is not None else None
+    return '%s:%s' % peer[:2] if peer else '<unknown peer>'
+
+
+  #----------------------------------------------- Name of the parent (for logs)
+  
+  def parent_name(self):
+    return getattr(self.parent, 'server_name', None) or getattr(self.parent, 'taskname', '')
 
 
 ################################################################################
@@ -52,13 +701,48 @@ class cTCPServer():
 
   #----------------------------------------------------------------- Constructor
   
-  def __init__(self, loop, name, local_address, local_port):  
+  def __init__(self, loop, name, local_address, local_port, framer=None,
+               write_high_water=None, write_low_water=None, overflow_policy=OVERFLOW_BLOCK, max_pending=65536,
+               max_clients=None, max_per_ip=None, accept_rate=None, accept_burst=None, reuse_port=False,
+               keepalive=None, idle_timeout=None, ping_interval=None, ping_frame=None, pong_frame=b'PONG', metrics=None,
+               logger=None):  
   
-    self.loop = loop                                  # AsyncIO running loop
+    self.loop = loop or GetEventLoop()                # AsyncIO running loop (None : GetEventLoop())
+    self.logger = logger or Logger                    # Standard logging.Logger
     self.server_name = name
     self.tcp_local_address = local_address            # TCP server will bind to that IP
     self.tcp_local_port = local_port                  # TCP server will listen on that port
-    self.clients = cTCPConnectedClients()             # List of clients connected to this server
+    self.clients = cTCPConnectedClients(self.logger)  # List of clients connected to this server
+    self.framer = framer                              # Framer factory (one framer per connection), None = raw data
+    self.write_high_water = write_high_water          # Write buffer limits for each client (None = AsyncIO defaults)
+    self.write_low_water = write_low_water
+    self.overflow_policy = overflow_policy            # Default overflow policy for each client (see cTCPProtocol)
+    self.max_pending = max_pending                    # Max bytes queued for each client while its writing is paused
+    
+    self.max_clients = max_clients                    # Max number of connected clients (None = no limit)
+    self.max_per_ip = max_per_ip                      # Max number of clients from the same source IP (None = no limit)
+    self.accept_bucket = cTokenBucket(accept_rate, accept_burst) if accept_rate else None     # Max accepts per second
+    self.pending_accepts = 0                          # Accepted, but connection_made() not called yet
+    self.rejector = cTCPRejectProtocol()              # Shared by all rejected connections
+    self.rejected_connections = {'max_clients': 0, 'max_per_ip': 0, 'accept_rate': 0}
+    
+    self.reuse_port = reuse_port                      # SO_REUSEPORT : several processes can listen on the same port
+    
+    self.keepalive = keepalive                        # TCP keepalive (idle, interval, count) in seconds, None = system default
+    self.idle_timeout = idle_timeout                  # Close clients not sending anything for that time (s)
+    self.ping_interval = ping_interval                # Send ping_frame to clients not sending anything for that time (s)
+    self.ping_frame = ping_frame                      # Ping payload (e.g. b'PING'), None = no ping / pong
+    self.pong_frame = pong_frame
+    
+    self.metrics = metrics                            # cMetrics registry, None = no metrics
+    self.tcp_metrics = None
+    if metrics is not None:
+      self.tcp_metrics = cTCPMetrics(metrics, server=name)
+      metrics.Gauge('tcp_clients', self.clients.Count, server=name)
+    
+    self.protocol_class = cTCPServerProtocol          # Replace with your derived cTCPServerProtocol
+    self.canceled = False
+    self.stop_event = None                            # Set to stop serving (created in serve(), on the running loop)
 
   
 
@@ -70,23 +754,79 @@ class cTCPServer():
     self.loop.create_task(self.serve(), name=name)
 
 
+  #---------------------------------------------------- Request server to stop
+  # (Same as canceling the server task)
+  
+  def cancel_server(self):
+    self.canceled = True
+    if self.stop_event is not None:
+      self.stop_event.set()
+
+
   #---------------------------------------------------------------- Stop Server
   
   async def stop_server (self):
-    print ('%s : Closing transport for all connected clients...' % self.server_name)
+    self.logger.info('%s : Closing transport for all connected clients...', self.server_name)
     self.clients.DisconnectAll()
     
-    print ('%s : Closing server task...' % self.server_name)
+    self.logger.info('%s : Closing server task...', self.server_name)
     self.server.close()
     await self.server.wait_closed()        
 
   
   #-------------------------------------------------------- Create AsyncIO server
-  # If you derive cTCPServer, you'll have to override this one with your own 
-  # derived cTCPServerProtocol 
+  # If you derive cTCPServer, set self.protocol_class to your own derived
+  # cTCPServerProtocol (or override this one, using self.protocol_factory)
   
   async def create_server(self):
-    self.server = await self.loop.create_server( lambda: cTCPServerProtocol(parent=self), self.tcp_local_address, self.tcp_local_port)
+    self.server = await self.loop.create_server(self.protocol_factory, self.tcp_local_address, self.tcp_local_port, reuse_port=self.reuse_port or None)
+
+
+  #------------------------------------------- Protocol factory for new clients
+  # Over-limit connections get the shared reject protocol : nothing is 
+  # allocated for them. (Source IP is not known yet : see admit_client_ip)
+  
+  def protocol_factory(self):
+    
+    if (self.max_clients is not None) and (len(self.clients) + self.pending_accepts >= self.max_clients):
+      return self.reject('max_clients')
+    
+    if (self.accept_bucket is not None) and not self.accept_bucket.Take():
+      return self.reject('accept_rate')
+    
+    self.pending_accepts = self.pending_accepts + 1
+    return self.protocol_class(parent=self)
+    
+  
+  #------------------------------------------ Count a rejected connection
+  # Returns the shared reject protocol
+  
+  def reject(self, reason):
+    self.rejected_connections[reason] += 1
+    if self.tcp_metrics is not None:
+      self.tcp_metrics.rejects[reason].value += 1
+    return self.rejector
+    
+  
+  #------------------------------------------------------- Server statistics
+  
+  def stats(self):
+    stats = {'clients': len(self.clients)}
+    for reason, count in self.rejected_connections.items():
+      stats['rejected_' + reason] = count
+    return stats
+
+
+  #--------------------------------------- Check quota of a new client source IP
+  # Called first by cTCPServerProtocol.connection_made()
+  
+  def admit_client_ip(self, ip):
+    
+    self.pending_accepts = max(0, self.pending_accepts - 1)
+    if (self.max_per_ip is not None) and (len(self.clients.GetByIP(ip)) >= self.max_per_ip):
+      self.reject('max_per_ip')
+      return False
+    return True
 
 
   #--------------------------------------------------- Starting / stopping server
@@ -96,26 +836,27 @@ class cTCPServer():
     # Starting TCP server
      
     self.canceled = False
+    self.stop_event = asyncio.Event()
     self.started = False
     while not self.started:
 
       try:    
-        print ("%s : Starting TCP server at %s:%d " % (self.server_name, self.tcp_local_address, self.tcp_local_port) )
+        self.logger.info("%s : Starting TCP server at %s:%d", self.server_name, self.tcp_local_address, self.tcp_local_port)
         await self.create_server()
               
-        print ("%s : TCP server started on port %d " % (self.server_name, self.tcp_local_port) )  
+        self.logger.info("%s : TCP server started on port %d", self.server_name, self.tcp_local_port)
         self.started = True
     
       except OSError : 
-        print("%s : Unable to start server on port %d; port may be already in use." % (self.server_name, self.tcp_local_port))
+        self.logger.error("%s : Unable to start server on port %d; port may be already in use.", self.server_name, self.tcp_local_port)
                             
       except:
-        print("%s : Unhandled exception when starting TCP server. " % self.server_name)
+        self.logger.exception("%s : Unhandled exception when starting TCP server.", self.server_name)
         raise          
     
       if self.started : break
          
-      print("%s : Retrying in 10 seconds..." % self.server_name)
+      self.logger.info("%s : Retrying in 10 seconds...", self.server_name)
       await asyncio.sleep(10) 
           
     
@@ -123,21 +864,20 @@ class cTCPServer():
     
     try:
       await self.server.start_serving()
-      while not self.canceled:
-        await asyncio.sleep(1)
+      await self.stop_event.wait()                     # No polling : wakes up only on cancel_server()
               
     except asyncio.CancelledError : 
-      print("%s : Server canceled." % self.taskname)
+      self.logger.info("%s : Server canceled.", self.server_name)
       self.canceled = True
                                                
     except:
-      print("%s : Unhandled exception when serving. " % self.server_name)
+      self.logger.exception("%s : Unhandled exception when serving.", self.server_name)
       raise
 
     finally:
-      print ("%s : Stopping TCP server..." % self.server_name)
+      self.logger.info("%s : Stopping TCP server...", self.server_name)
       await (self.stop_server())       
-      print ("%s : TCP Server stopped." % self.server_name)
+      self.logger.info("%s : TCP Server stopped.", self.server_name)
 
 
 #===============================================================================
@@ -145,15 +885,17 @@ class cTCPServer():
 # (A new instance is created for every incoming connection)
 #===============================================================================
 
-class cTCPServerProtocol(asyncio.Protocol):
+class cTCPServerProtocol(cTCPProtocol):
 
   #----------------------------------------------------------------- Constructor
           
   def __init__(self, parent):    
-    self.parent = parent                           # Parent cTCPServer object                             
+    super().__init__(parent)                       # Parent cTCPServer object                             
     self.server_name = self.parent.server_name
     self.client_name = '<No client details available>'
-    self.transport = None
+    self.client_ip = '0.0.0.0'
+    self.client_port = 0
+    self.registered = False                        # Is in the list of connected clients
  
   #---------------------------------------------------------- Display procedures
   
@@ -168,12 +910,7 @@ class cTCPServerProtocol(asyncio.Protocol):
   
   def connection_made(self, transport):
     
-    self.transport = transport
     peername = transport.get_extra_info('peername')                           # peername is a tuple
-    print('%s : Incoming connection from %s' % (self.server_name, peername))
-    # print ('Self is :')
-    # print (self)
-    
     try:
       ip,port = peername
     except:
@@ -181,58 +918,68 @@ class cTCPServerProtocol(asyncio.Protocol):
       port = 0
     self.client_ip = ip
     self.client_port = port  
+    
+    # Check source IP quota before allocating anything for this client
+    if not self.parent.admit_client_ip(ip):
+      transport.abort()
+      return
+    
+    super().connection_made(transport)
           
     # Add to the list of the connected clients      
     already_client = self.parent.clients.IsMember(ip, port)
     if already_client is None:
-      print ('%s : Connection accepted from %s:%s' %(self.server_name, ip, port))
+      if self.logger.isEnabledFor(logging.DEBUG):
+        self.logger.debug('%s : Connection accepted from %s:%s (%d clients)', self.server_name, ip, port, len(self.parent.clients) + 1)
       self.parent.clients.AddMember (ip, port, self)   
+      self.registered = True
+      if self.metrics is not None:
+        self.metrics.accepts.value += 1
     else: 
-      print ("ERROR - Incoming connection from an already connected client") 
+      self.logger.error("%s : Incoming connection from an already connected client %s:%s", self.server_name, ip, port)
       # TODO : reuse existing connexion / replace transport (or delete / add)
-    
-    # Debug : print list of connected clients  
-    print ("%s : %s" % (self.server_name, self.parent.clients))  
+    # (Never log the full list of clients here : O(clients) for each accept)
 
 
 
-  #---------------------------------------------- Callback when data is received
+  #------------------------------------- Callback when a full frame is received
+  # (Override with your own method)
+  # frame is a memoryview, only valid during the call : use bytes(frame) to keep it.
+  # Without framer, frame is the raw data chunk received.
 
-  def data_received(self, data):
-
-    # print('%f : Data received from %s' % (self.taskname, self.peername)) 
-    
-    # decoded = data.decode()
-    # print(decoded)
-    
-    # text = DumpBufferHexa (data)
-    # print(text)
+  def frame_received(self, frame):
 
-    # Do something with received data
+    # Do something with received frame
     
-    print ("%s : Data received from client :" % (self.server_name)) 
-    # print (self)
-    # print (data)
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug("%s : Frame received from client %s:%s (%d bytes)", self.server_name, self.client_ip, self.client_port, len(frame))
     
   
   #-------------------------------------------- Callback when connection is lost
   
   def connection_lost(self, exc):        # exc is an exception; can be none
     
+    super().connection_lost(exc)
+    if not self.registered:                        # Rejected or duplicate connection
+      return
+    
     # Check / remove from the list of connected clients    
-    print('%s : Client %s:%d disconnected' % (self.server_name, self.client_ip, self.client_port))
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug('%s : Client %s:%d disconnected', self.server_name, self.client_ip, self.client_port)
     self.parent.clients.RemoveMember (self.client_ip, self.client_port)   
-  
-    # Debug : print list of connected clients
-    # print ("%s : %s" % (self.server_name, self.parent.clients))  
+    self.registered = False
     
 
-  #--------------------------------------------------------- Send data to client
 
-  def send_data(self, data):
-    # print('%f : Sending data to %s' % (self.taskname, self.peername)) 
-    self.transport.write(data)    
-    
+#===============================================================================
+# Protocol given to rejected connections (over limits) : closes immediately.
+# One instance is shared by all rejected connections.
+#===============================================================================
+
+class cTCPRejectProtocol(asyncio.Protocol):
+  
+  def connection_made(self, transport):
+    transport.abort()
 
 
 #===============================================================================
@@ -241,14 +988,19 @@ class cTCPServerProtocol(asyncio.Protocol):
 
 # Connected clients are stored in a dict :
 #  Key is a tuple (source_ip, source_port)
-#  Data is cTCPserverProtocol object          
+#  Data is cTCPConnectedClient object          
+# Secondary indexes give the clients of one source IP, or having one tag,
+# without scanning the whole dict.
                                                    
 class cTCPConnectedClients(object):
    
   #----------------------------------------------------------------- Constructor
   
-  def __init__(self):   
+  def __init__(self, logger=None):   
+    self.logger = logger or Logger
     self.clients = {}                            # Dict of the connected clients
+    self.by_ip = {}                              # ip -> set of cTCPConnectedClient
+    self.by_tag = {}                             # tag -> set of cTCPConnectedClient
                                                                                         
 
   #---------------------------------------- Get dictionnary of connected clients
@@ -256,6 +1008,27 @@ class cTCPConnectedClients(object):
   def Get(self):
     return self.clients
   
+  
+  #-------------------------------------------------- Number of connected clients
+  
+  def Count(self):
+    return len(self.clients)
+  
+  def __len__(self):
+    return len(self.clients)
+
+
+  #--------------------------------------------- Clients connected from one IP
+  
+  def GetByIP(self, ip):
+    return self.by_ip.get(ip, ())
+
+
+  #-------------------------------------------------- Clients having one tag
+  
+  def GetByTag(self, tag):
+    return self.by_tag.get(tag, ())
+  
 
   #---------------------------------------------------------- Display procedures
   
@@ -278,23 +1051,21 @@ class cTCPConnectedClients(object):
   #--------------------------------- Is (ip,port) already a connected client ? 
 
   def IsMember (self, ip, port) :
-
-    key = '%s:%d' % (ip, port)
-    if key in self.clients :               # Is it a member of the list?            
-      result  = self.clients[key]          # Get the object
-    else:
-      result = None
-      
-    return result
+    return self.clients.get((ip, port))
         
 
   #----------------------------- Add a client to the list of connected clients
   
   def AddMember (self, ip, port, client_protocol ):
     
-    key = '%s:%d' % (ip, port)
     client = cTCPConnectedClient (client_protocol, ip, port)    # Instantiate new client tracking object
-    self.clients[key] = client                                  # Create it in the clients list         
+    self.clients[(ip, port)] = client                           # Create it in the clients list         
+    
+    same_ip = self.by_ip.get(ip)
+    if same_ip is None:
+      self.by_ip[ip] = {client}
+    else:
+      same_ip.add(client)
 
     return client
 
@@ -303,21 +1074,100 @@ class cTCPConnectedClients(object):
    
   def RemoveMember (self, ip, port):
  
-    to_remove = self.IsMember (ip, port)
-    if to_remove is not None:
-      key = '%s:%d' % (ip, port)
-      del self.clients[key]
+    client = self.clients.pop((ip, port), None)
+    if client is not None:
+      self.Unindex(self.by_ip, ip, client)
+      for tag in client.tags:
+        self.Unindex(self.by_tag, tag, client)
+    return client
+
+
+  #------------------------------------ Remove a client from a secondary index
+  
+  def Unindex (self, index, key, client):
+    clients = index.get(key)
+    if clients is not None:
+      clients.discard(client)
+      if not clients:
+        del index[key]
 
   #------------------------------------------------------ Disconnect all clients
   
   def DisconnectAll (self):
-    print("Disconnecting all connected  clients :")
-    if self.clients == {}:
-      print("  <No client connected")
+    self.logger.info("Disconnecting all connected clients (%d)", len(self.clients))
+    debug = self.logger.isEnabledFor(logging.DEBUG)
+    for c in self.clients.values():
+      if debug:
+        self.logger.debug("  %s", c)
+      c.transport.close()
+
+
+  #-------------------------------------------------- Add tags to a client
+  # Tags are free strings (group names) used by Multicast()
+  
+  def AddTag (self, ip, port, *tags):
+    client = self.IsMember (ip, port)
+    if client is not None:
+      if not client.tags:
+        client.tags = set()                      # Shared empty tuple until the first tag
+      for tag in tags:
+        client.tags.add(tag)
+        self.by_tag.setdefault(tag, set()).add(client)
+    return client
+
+
+  #--------------------------------------------- Remove tags from a client
+  
+  def RemoveTag (self, ip, port, *tags):
+    client = self.IsMember (ip, port)
+    if client is not None and client.tags:
+      for tag in tags:
+        client.tags.discard(tag)
+        self.Unindex(self.by_tag, tag, client)
+    return client
+
+
+  #--------------------------------------- Send the same data to all clients
+  # Data is encoded once (str -> UTF-8) and the same buffer is given to all
+  # transports. Clients whose write buffer is full (writing paused) are skipped,
+  # nothing is queued for them.
+  # filter : optional function(client) returning True to send to that client.
+  # clients : optional subset of clients to send to (default : all).
+  # Returns a tuple (sent, skipped)
+  
+  def Broadcast (self, data, filter=None, clients=None):
+    
+    if isinstance(data, str):
+      data = data.encode()
+    if clients is None:
+      clients = self.clients.values()
+    
+    sent = 0
+    skipped = 0
+    for client in clients:
+      if (filter is not None) and not filter(client):
+        continue
+      protocol = client.protocol
+      if protocol.paused:
+        skipped = skipped + 1
+      elif protocol.send_data(data):
+        sent = sent + 1
+    return sent, skipped
+
+
+  #------------------------------- Send the same data to clients having a tag
+  # tags : one tag, or a list of tags (clients having any of them)
+  # Returns a tuple (sent, skipped), like Broadcast()
+  
+  def Multicast (self, data, tags):
+    
+    if isinstance(tags, str):
+      clients = self.by_tag.get(tags, ())
     else:
-      for c in self.clients:
-        print ("  %s" % (self.clients[c]))
-        self.clients[c].transport.close()
+      clients = set()
+      for tag in tags:
+        clients.update(self.by_tag.get(tag, ()))
+    return self.Broadcast(data, clients=clients)
                
     
 
@@ -326,6 +1176,8 @@ class cTCPConnectedClients(object):
 #===============================================================================
 
 class cTCPConnectedClient(object):
+  
+  __slots__ = ('protocol', 'transport', 'ip', 'port', 'tags')      # No per-instance __dict__ (many short-lived instances)
         
   #----------------------------------------------------------------- Constructor
   
@@ -334,6 +1186,7 @@ class cTCPConnectedClient(object):
     self.transport = self.protocol.transport
     self.ip = client_ip
     self.port = client_port
+    self.tags = ()                                  # Groups this client belongs to (see Multicast)
 
 
   #---------------------------------------------------------- Display procedures
@@ -353,6 +1206,204 @@ class cTCPConnectedClient(object):
     return s
     
 
+################################################################################
+#                                                                              #
+#                          METRICS EXPOSITION SERVER                           #
+#                                                                              # 
+################################################################################
+
+#===============================================================================
+# Minimal HTTP server exposing a metrics registry (for Prometheus scraping)
+#   GET /metrics : Prometheus text format
+#   GET /json    : JSON snapshot
+#===============================================================================
+
+class cMetricsServer(cTCPServer):
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, loop, name, local_address, local_port, registry, **kwargs):
+    kwargs.setdefault('framer', lambda: cTCPFramerDelimiter(b'\r\n\r\n', max_frame=8192))
+    kwargs.setdefault('idle_timeout', 10)
+    super().__init__(loop, name, local_address, local_port, **kwargs)
+    self.registry = registry                          # cMetrics registry to expose
+    self.protocol_class = cMetricsServerProtocol
+
+
+#===============================================================================
+# Protocol : one HTTP request, one answer, then close
+#===============================================================================
+
+class cMetricsServerProtocol(cTCPServerProtocol):
+
+  #---------------------------------------------------- HTTP request received
+  
+  def frame_received(self, frame):
+    
+    try:
+      method, path = bytes(frame).split(b'\r\n', 1)[0].split()[:2]
+    except ValueError:
+      method, path = b'', b''
+    
+    if method != b'GET':
+      status, ctype, body = '405 Method Not Allowed', 'text/plain', 'Method not allowed\n'
+    elif path.startswith(b'/metrics'):
+      status, ctype, body = '200 OK', 'text/plain; version=0.0.4', self.parent.registry.Prometheus()
+    elif path.startswith(b'/json'):
+      status, ctype, body = '200 OK', 'application/json', json.dumps(self.parent.registry.Snapshot(), indent=1)
+    else:
+      status, ctype, body = '404 Not Found', 'text/plain', 'Not found\n'
+    
+    body = body.encode()
+    header = 'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (status, ctype, len(body))
+    self.send_data(header.encode() + body)
+    self.transport.close()                           # Closed when the answer is sent
+
+
+################################################################################
+#                                                                              #
+#                        MULTI-PROCESS TCP SERVER                              #
+#                                                                              # 
+################################################################################
+
+# N worker processes each run their own AsyncIO loop and cTCPServer, all bound
+# to the same port with SO_REUSEPORT : the kernel load-balances the incoming
+# connections between them (Linux).
+#
+# Each worker stops gracefully on SIGTERM / SIGINT / SIGHUP (AsyncIOShutdown).
+# Workers publish their cTCPServer.stats() in shared memory; the parent reads
+# them with Stats() without any IPC on the workers' event loops.
+#
+# The server class must be importable by the workers (defined at module level),
+# because workers are started with the 'spawn' method.
+
+CLUSTER_STATS = ('clients', 'rejected_max_clients', 'rejected_max_per_ip', 'rejected_accept_rate')
+
+
+#===============================================================================
+# Worker process entry point
+#===============================================================================
+
+def TCPServerWorker(index, server_class, name, local_address, local_port, server_kwargs, shared_stats, report_interval):
+  
+  logger = Logger.getChild('worker%d' % index)
+  loop = NewEventLoop()
+  asyncio.set_event_loop(loop)
+  
+  server_kwargs.setdefault('logger', logger)
+  server = server_class(loop, '%s #%d' % (name, index), local_address, local_port, reuse_port=True, **server_kwargs)
+  SetShutdownSignals(loop, logger)
+  server.start_server()
+  loop.create_task(TCPServerWorkerReport(server, index, shared_stats, report_interval), name='%s #%d stats' % (name, index))
+  
+  try:
+    loop.run_forever()
+  finally:
+    loop.close()
+
+
+#===============================================================================
+# Worker task : copy the server statistics to shared memory
+#===============================================================================
+
+async def TCPServerWorkerReport(server, index, shared_stats, report_interval):
+  
+  base = index * len(CLUSTER_STATS)
+  while True:
+    stats = server.stats()
+    for i, field in enumerate(CLUSTER_STATS):
+      shared_stats[base + i] = stats.get(field, 0)
+    await asyncio.sleep(report_interval)
+
+
+#===============================================================================
+# Multi-process TCP server
+#===============================================================================
+
+class cTCPServerCluster():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, loop, name, local_address, local_port, workers=None, server_class=cTCPServer, server_kwargs=None, report_interval=1.0,
+               logger=None):
+    
+    self.loop = loop or GetEventLoop()                # AsyncIO loop of the parent process
+    self.logger = logger or Logger                    # Workers use the module logger (a logger can't be sent to a spawned process)
+    self.server_name = name
+    self.tcp_local_address = local_address
+    self.tcp_local_port = local_port
+    self.workers = workers or multiprocessing.cpu_count()
+    self.server_class = server_class                  # cTCPServer or derived class, run in each worker
+    self.server_kwargs = server_kwargs or {}          # Extra parameters for the server class
+    self.report_interval = report_interval            # Workers update their stats every <report_interval> s
+    
+    self.context = multiprocessing.get_context('spawn')        # Never fork a running AsyncIO loop
+    self.shared_stats = self.context.Array('d', self.workers * len(CLUSTER_STATS), lock=False)
+    self.processes = []
+    self.STOP_TIMEOUT = 10                            # Seconds to wait for a graceful worker stop
+  
+  
+  #------------------------------------------------------------ Start workers
+  
+  def start_server(self, name=None):
+    
+    if name is None:
+      name = "TCP cluster at %s:%d" % (self.tcp_local_address, self.tcp_local_port)
+    for index in range(self.workers):
+      p = self.context.Process(target=TCPServerWorker, name='%s #%d' % (self.server_name, index),
+                               args=(index, self.server_class, self.server_name, self.tcp_local_address, self.tcp_local_port,
+                                     self.server_kwargs, self.shared_stats, self.report_interval))
+      p.start()
+      self.processes.append(p)
+    self.logger.info('%s : Started %d worker processes on port %d', self.server_name, self.workers, self.tcp_local_port)
+    self.task = self.loop.create_task(self.supervise(), name=name)
+
+
+  #------------------------------------------------------- Supervision task
+  # Waits until canceled (e.g. by AsyncIOShutdown), then stops the workers.
+  
+  async def supervise(self):
+    try:
+      await asyncio.Event().wait()
+    except asyncio.CancelledError:
+      self.logger.info('%s : Cluster canceled.', self.server_name)
+    finally:
+      await self.stop_server()
+  
+  
+  #------------------------------------------- Stop workers (gracefully)
+  
+  async def stop_server(self):
+    
+    for p in self.processes:
+      if p.is_alive():
+        p.terminate()                                 # SIGTERM : AsyncIOShutdown in the worker
+    for p in self.processes:
+      await self.loop.run_in_executor(None, p.join, self.STOP_TIMEOUT)
+      if p.is_alive():
+        self.logger.warning('%s : Worker %s did not stop, killing it.', self.server_name, p.name)
+        p.kill()
+        await self.loop.run_in_executor(None, p.join)
+    self.processes = []
+    self.logger.info('%s : All workers stopped.', self.server_name)
+  
+  
+  #------------------------------------------------------------ Statistics
+  # Returns aggregated stats, and the list of stats of each worker
+  
+  def Stats(self):
+    
+    n = len(CLUSTER_STATS)
+    per_worker = []
+    total = dict.fromkeys(CLUSTER_STATS, 0)
+    for index in range(self.workers):
+      stats = {field: int(self.shared_stats[index * n + i]) for i, field in enumerate(CLUSTER_STATS)}
+      per_worker.append(stats)
+      for field in CLUSTER_STATS:
+        total[field] = total[field] + stats[field]
+    return total, per_worker
+
+
 ################################################################################
 #                                                                              #
 #                          ASYNCIO TCP CLIENT                                  #
@@ -368,12 +1419,29 @@ class cTCPClient():
 
   #----------------------------------------------------------------- Constructor
   
-  def __init__(self, loop, name, tcp_address, tcp_port, source_address='', source_port=0):
+  def __init__(self, loop, name, tcp_address, tcp_port, source_address='', source_port=0, framer=None,
+               write_high_water=None, write_low_water=None, overflow_policy=OVERFLOW_BLOCK, max_pending=65536,
+               keepalive=None, idle_timeout=None, ping_interval=None, ping_frame=None, pong_frame=b'PONG', metrics=None,
+               logger=None):
     
-    self.loop = loop
+    self.loop = loop or GetEventLoop()               # None : loop from GetEventLoop()
+    self.logger = logger or Logger                   # Standard logging.Logger
     self.taskname = name
-    self.tcp_address = tcp_address
+    self.tcp_address = tcp_address                   # Can be IP or FQDN
+    self.tcp_ip = tcp_address                        # Resolved before each connection (shared DNS cache)
     self.tcp_port = tcp_port
+    self.framer = framer                             # Framer factory (one framer per connection), None = raw data
+    self.write_high_water = write_high_water         # Write buffer limits (None = AsyncIO defaults)
+    self.write_low_water = write_low_water
+    self.overflow_policy = overflow_policy           # What to do when server does not read (see cTCPProtocol)
+    self.max_pending = max_pending                   # Max bytes queued while writing is paused
+    self.keepalive = keepalive                       # TCP keepalive (idle, interval, count) in seconds, None = system default
+    self.idle_timeout = idle_timeout                 # Reconnect if nothing is received for that time (s)
+    self.ping_interval = ping_interval               # Send ping_frame when nothing is received for that time (s)
+    self.ping_frame = ping_frame                     # Ping payload (e.g. b'PING'), None = no ping / pong
+    self.pong_frame = pong_frame
+    self.metrics = metrics                           # cMetrics registry, None = no metrics
+    self.tcp_metrics = cTCPMetrics(metrics, client=name) if metrics is not None else None
     
     self.tcp_source_address = source_address         
     self.tcp_source_port = source_port               
@@ -381,6 +1449,14 @@ class cTCPClient():
     self.local_addr = (source_address, source_port)  # Tuple required by loop.create_connection()
 
     self.PORT_RETRIES = 128          # Max attempts of source_port increment in case of previous socket locked in MAX_RETRY
+    self.RETRY_DELAY_MIN = 0.05      # First reconnection delay (seconds), doubled on each failed attempt...
+    self.RETRY_DELAY_MAX = 30.0      # ... up to this value
+    
+    self.transport = None
+    self.connected = False
+    self.canceled = False
+    self.disconnected = None         # asyncio.Event set by the protocol when connection is lost
+    self.connections = 0             # Number of successful connections
   
   
   #-------------------------------------------------------- Create AsyncIO task
@@ -389,8 +1465,8 @@ class cTCPClient():
   
   async def create_connection(self):
     #loop = asyncio.get_running_loop()
-    print ("%s : TCP Client - Creating connection to %s:%d from %s:%d" %(self.taskname, self.tcp_address, self.tcp_port, self.tcp_source_address, self.tcp_source_port))
-    self.transport, self.protocol = await self.loop.create_connection( lambda: cTCPClientProtocol(parent=self), self.tcp_address, self.tcp_port, local_addr=self.local_addr)
+    self.logger.debug("%s : TCP Client - Creating connection to %s:%d from %s:%d", self.taskname, self.tcp_address, self.tcp_port, self.tcp_source_address, self.tcp_source_port)
+    self.transport, self.protocol = await self.loop.create_connection( lambda: cTCPClientProtocol(parent=self), self.tcp_ip, self.tcp_port, local_addr=self.local_addr)
 
 
   #------------------------------------------------------ Schedule AsyncIO task
@@ -401,6 +1477,15 @@ class cTCPClient():
     self.loop.create_task(self.connect(), name=name)
     
     
+  #---------------------------------------- Delay before next connection attempt
+  # Exponential backoff with jitter : spreads reconnections when many clients
+  # lose their server at the same time.
+  
+  def retry_delay(self, attempt):
+    delay = min(self.RETRY_DELAY_MAX, self.RETRY_DELAY_MIN * (2 ** min(attempt, 32)))
+    return random.uniform(delay / 2, delay)
+    
+    
   #------------------------------------------------------- Connection management
   
   async def connect (self):
@@ -409,130 +1494,146 @@ class cTCPClient():
   
     self.connected = False
     self.canceled = False
+    self.disconnected = asyncio.Event()
+    attempt = 0
     while not (self.canceled):
       
       try:
-        print ("%s : TCP Client - Connecting to %s:%d... " % (self.taskname, self.tcp_address, self.tcp_port) )
+        self.logger.info("%s : TCP Client - Connecting to %s:%d...", self.taskname, self.tcp_address, self.tcp_port)
+        self.disconnected.clear()
+        started = self.loop.time()
+        self.tcp_ip = await SharedDNSCache.Resolve(self.tcp_address) or self.tcp_address     # Cached : only the first connection waits
         await self.create_connection()
         self.connected = True
+        self.connections = self.connections + 1
+        if self.tcp_metrics is not None:
+          self.tcp_metrics.connect_time.Record(self.loop.time() - started)
+          self.tcp_metrics.connects.value += 1
+          if self.connections > 1:
+            self.tcp_metrics.reconnects.value += 1
         
       except ConnectionRefusedError:
-        print("%s : TCP client - Connection refused." % self.taskname)
+        self.logger.info("%s : TCP client - Connection refused.", self.taskname)
         
       except asyncio.CancelledError : 
-        print("%s : TCP Client - Connection canceled - Stopping." % self.taskname)
+        self.logger.info("%s : TCP Client - Connection canceled - Stopping.", self.taskname)
         self.canceled = True
         self.connected = False
           
       except TimeoutError :
-        print("%s : TCP Client - Unable to connect to %s : Timeout." % (self.taskname, self.tcp_address))
+        self.logger.info("%s : TCP Client - Unable to connect to %s : Timeout.", self.taskname, self.tcp_address)
            
       except OSError :
-        print("%s : TCP Client - OS error (possibly wrong source IP or source port)." % (self.taskname))
+        self.logger.warning("%s : TCP Client - OS error (possibly wrong source IP or source port).", self.taskname)
         self.connected = False 
         self.PORT_RETRIES = self.PORT_RETRIES - 1
         if self.PORT_RETRIES > 0:
           self.tcp_source_port = self.tcp_source_port + 1   
-          print("%s : TCP Client - Incrementing source port. Will retry from %s:%d)." % (self.taskname, self.tcp_source_address, self.tcp_source_port))  
+          self.logger.info("%s : TCP Client - Incrementing source port. Will retry from %s:%d.", self.taskname, self.tcp_source_address, self.tcp_source_port)
         else:
           self.tcp_source_port = self.tcp_source_port_origin              
-          print("%s : TCP Client - Reverting back to original source port. Will retry from %s:%d)." % (self.taskname, self.tcp_source_address, self.tcp_source_port))  
+          self.logger.info("%s : TCP Client - Reverting back to original source port. Will retry from %s:%d.", self.taskname, self.tcp_source_address, self.tcp_source_port)
         self.local_addr = (self.tcp_source_address, self.tcp_source_port)
       
       except:
-        print("%s : TCP Client - Unknown exception. " % self.taskname)
+        self.logger.exception("%s : TCP Client - Unknown exception.", self.taskname)
         raise
 
+      if (not self.connected) and (not self.canceled) and (self.tcp_metrics is not None):
+        self.tcp_metrics.connect_failures.value += 1
              
       if self.connected :        
         
         # We are connected. We do nothing here. Just wait for callbacks or external signals
         
         try:
-          print ("%s : TCP Client - Connected, entering reception loop" % self.taskname)
-          while self.connected:
-            await asyncio.sleep(1)
-            # print('Connected : %s' % (self.connected))
+          self.logger.info("%s : TCP Client - Connected, entering reception loop", self.taskname)
+          attempt = 0
+          await self.disconnected.wait()             # Set by connection_lost(), no polling
         
         except asyncio.CancelledError : 
-          print("%s : TCP Client - Task canceled"  % self.taskname)
+          self.logger.info("%s : TCP Client - Task canceled", self.taskname)
           self.canceled = True
                 
         except asyncio.TimeoutError :
-          print("%s : TCP Client - Timeout" % self.taskname)    
+          self.logger.info("%s : TCP Client - Timeout", self.taskname)
           self.connected = False
           
         except asyncio.InvalidStateError:
-          print("%s : TCP Client - Invalid State"  % self.taskname)
+          self.logger.warning("%s : TCP Client - Invalid State", self.taskname)
           self.canceled = True
           
         except:
-          print ("%s : TCP Client - Unknown exception" % self.taskname)
+          self.logger.exception("%s : TCP Client - Unknown exception", self.taskname)
           raise
               
               
       if not self.canceled  :      
          
         # Connection was lost, but not canceled. We'll retry later.
-            
-        print ("%s : TCP Client - Retry in 1 second" % self.taskname)
+        
+        delay = self.retry_delay(attempt)
+        attempt = attempt + 1
+        self.logger.info("%s : TCP Client - Retry in %.3f seconds", self.taskname, delay)
         try :
-          await asyncio.sleep(1)                     
+          await asyncio.sleep(delay)                     
         except asyncio.CancelledError : 
-          print("%s : TCP Client - Retry canceled." % self.taskname)
+          self.logger.info("%s : TCP Client - Retry canceled.", self.taskname)
           self.canceled = True
     
     # end while
     
-    print ("%s : TCP Client - Closing transport." % self.taskname)
-    self.transport.close()  
+    self.logger.info("%s : TCP Client - Closing transport.", self.taskname)
+    if self.transport is not None:
+      self.transport.close()  
   
 
 #===============================================================================
 # TCP Client Protocol class
 #===============================================================================
 
-class cTCPClientProtocol(asyncio.Protocol):
+class cTCPClientProtocol(cTCPProtocol):
 
   
   #----------------------------------------------------------------- Constructor
   
   def __init__(self, parent):
-    self.parent = parent
+    super().__init__(parent)
     self.taskname = parent.taskname
     self.tcp_address = parent.tcp_address
     self.tcp_port = parent.tcp_port
-    self.transport = None
 
 
   #------------------------------------------------------------- Connection Made
   
   def connection_made(self, transport):
-    self.transport = transport
+    super().connection_made(transport)
     # transport.write(self.message.encode())
     # print('Data sent: {!r}'.format(self.message))
 
 
-  #---------------------------------------------- Callback when data is received
+  #------------------------------------- Callback when a full frame is received
+  # (Override with your own method)
+  # frame is a memoryview, only valid during the call : use bytes(frame) to keep it.
+  # Without framer, frame is the raw data chunk received.
   
-  def data_received(self, data):
-    
-    print('%s : Data received:' % self.taskname) 
+  def frame_received(self, frame):
     
-    # print (data.decode())  
-    # print (DumpBufferHexa (data))
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug('%s : Frame received (%d bytes)', self.taskname, len(frame))
 
-    self.buffer = self.buffer + data       # Incomplete message may be in the buffer from previous call; just add to it
-      
-    # Do what you want with self.buffer
+    # Do what you want with frame
     pass
       
     
   #-------------------------------------------- Callback when connection is lost
   
   def connection_lost(self, exc):
-    print('%s : The server closed the connection' % self.taskname)
+    super().connection_lost(exc)
+    self.logger.info('%s : The server closed the connection', self.taskname)
     self.parent.connected = False 
+    if self.parent.disconnected is not None:
+      self.parent.disconnected.set()               # Wakes up cTCPClient.connect()
     
 
 ################################################################################
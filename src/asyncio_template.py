@@ -205,10 +205,11 @@ if __name__ == "__main__":
   logger.info ('%s program starting. Use Ctrl+C or send signal to stop.' % (__appname__))
   
   
-  # ---- Get current event loop or create a new one
+  # ---- Get current event loop or create a new one (uvloop if installed)
   
-  loop = asyncio.get_event_loop ()
-  # loop = asyncio.new_event_loop ()
+  loop = GetEventLoop ()
+  # loop = GetEventLoop (fast=False)             # Standard asyncio loop (debugging)
+  logger.info ('Event loop : %s' % (EventLoopName (loop)))
   
   
   # ---- Instantiate AsyncIO classes
@@ -35,10 +35,98 @@ VersionDate = "23/05/2020"
 #===============================================================================
 
 import asyncio
+import heapq
+import itertools
+import logging
 import platform
 import signal 
+import threading
+import time
+import weakref
 
 
+# ---- Optional third-party module (pip install uvloop)
+
+try:
+  import uvloop
+except ImportError:
+  uvloop = None
+
+
+#===============================================================================
+# Logging
+#===============================================================================
+
+# Like asyncio_tcp_toolbox : classes take a standard logging.Logger, and use
+# this module logger when none is given.
+
+Logger = logging.getLogger('asyncio_toolbox')
+
+
+
+################################################################################
+#                                                                              #
+#                                EVENT LOOP                                    #
+#                                                                              # 
+################################################################################
+
+# All the toolbox classes take their loop from GetEventLoop() when they are
+# given loop=None, and applications should create their loop with it too :
+#
+#   loop = GetEventLoop()                  # uvloop if installed, else asyncio
+#   server = cTCPServer(loop, 'AMI', '0.0.0.0', 5038)
+#
+# The loop is also set as the current loop of the thread, so libraries calling
+# asyncio.get_event_loop() by themselves (gmqtt) use the same loop.
+# Set FastEventLoop = False (or call GetEventLoop(fast=False)) to force the
+# standard asyncio loop, e.g. to compare or debug.
+
+FastEventLoop = True
+
+
+#===============================================================================
+# Create a new event loop : uvloop when available, else standard asyncio
+#===============================================================================
+
+def NewEventLoop(fast=None):
+  
+  if fast is None:
+    fast = FastEventLoop
+  if fast and (uvloop is not None):
+    return uvloop.new_event_loop()
+  return asyncio.new_event_loop()
+
+
+#===============================================================================
+# Get the running loop, or the current one, or create and set a new one
+#===============================================================================
+
+def GetEventLoop(fast=None):
+  
+  try:
+    return asyncio.get_running_loop()
+  except RuntimeError:
+    pass
+  loop = getattr(CurrentLoop, 'loop', None)
+  if (loop is None) or loop.is_closed():
+    loop = NewEventLoop(fast)
+    CurrentLoop.loop = loop
+    asyncio.set_event_loop(loop)
+  return loop
+
+CurrentLoop = threading.local()                  # Loop created by GetEventLoop() in each thread
+
+
+#===============================================================================
+# Name of the implementation of a loop (for logs and benchmarks)
+#===============================================================================
+
+def EventLoopName(loop):
+  
+  if (uvloop is not None) and isinstance(loop, uvloop.Loop):
+    return 'uvloop'
+  return 'asyncio'
+
 
 ################################################################################
 #                                                                              #
@@ -83,6 +171,136 @@ async def AsyncIOShutdown(loop, logger, signal=None):
   loop.stop()
 
 
+################################################################################
+#                                                                              #
+#                              RATE LIMITING                                   #
+#                                                                              # 
+################################################################################
+
+#===============================================================================
+# Token bucket : allows <rate> events per second, with bursts up to <burst>
+#===============================================================================
+
+class cTokenBucket():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, rate, burst=None):
+    self.rate = rate                                      # Tokens added per second
+    self.burst = burst if burst is not None else max(1, rate)     # Bucket size
+    self.tokens = self.burst
+    self.last = time.monotonic()
+    
+    
+  #------------------------------------------------------------ Refill bucket
+  
+  def Refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+    
+    
+  #-------------------------------- Take tokens; returns False if not enough
+  
+  def Take(self, count=1):
+    self.Refill()
+    if self.tokens >= count:
+      self.tokens = self.tokens - count
+      return True
+    return False
+
+
+################################################################################
+#                                                                              #
+#                                 TIMERS                                       #
+#                                                                              # 
+################################################################################
+
+#===============================================================================
+# Shared timer heap : many timers, a single loop.call_at() armed at a time
+#===============================================================================
+
+# Used for per-connection timeouts : thousands of connections cost one heap
+# entry each, instead of one sleeping task each. Callbacks due within the same
+# <resolution> are run together, to limit loop wakeups.
+
+class cTimerHeap():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, loop, resolution=0.1, logger=None):
+    self.loop = loop
+    self.resolution = resolution
+    self.logger = logger or Logger
+    self.heap = []                                # Entries [when, seq, callback, args]
+    self.counter = itertools.count()              # Tie-breaker for entries with the same time
+    self.handle = None                            # Current loop.call_at() handle
+    self.handle_when = None
+
+
+  #----------------------------------------------- Schedule callback(*args)
+  # Returns an entry, to be given to Cancel()
+  
+  def Schedule(self, when, callback, *args):
+    entry = [when, next(self.counter), callback, args]
+    heapq.heappush(self.heap, entry)
+    if (self.handle_when is None) or (when < self.handle_when):
+      self.Arm(when)
+    return entry
+
+
+  #------------------------------------------------------------ Cancel a timer
+  # (Entry stays in the heap, it is just ignored when due)
+  
+  def Cancel(self, entry):
+    entry[2] = None
+    entry[3] = None
+    
+    
+  #--------------------------------------------- Arm the loop timer for <when>
+  
+  def Arm(self, when):
+    if self.handle is not None:
+      self.handle.cancel()
+    when = when + self.resolution                 # Also run what will be due shortly after
+    self.handle = self.loop.call_at(when, self.Run)
+    self.handle_when = when
+    
+    
+  #--------------------------------------------------------- Run due callbacks
+  
+  def Run(self):
+    self.handle = None
+    self.handle_when = None
+    now = self.loop.time()
+    heap = self.heap
+    while heap and heap[0][0] <= now:
+      when, seq, callback, args = heapq.heappop(heap)
+      if callback is not None:
+        try:
+          callback(*args)
+        except Exception:
+          self.logger.exception('Timer : exception in callback %s', callback)
+    while heap and heap[0][2] is None:            # Drop canceled entries from the top
+      heapq.heappop(heap)
+    if heap:
+      self.Arm(heap[0][0])
+
+
+#===============================================================================
+# Get the timer heap shared by everything running on a loop
+#===============================================================================
+
+SharedTimers = weakref.WeakKeyDictionary()
+
+def GetSharedTimer(loop):
+  timer = SharedTimers.get(loop)
+  if timer is None:
+    timer = cTimerHeap(loop)
+    SharedTimers[loop] = timer
+  return timer
+
+
 ################################################################################
 #                                                                              #
 #                              M A I N                                         #
@@ -37,11 +37,330 @@ VersionDate = "09/11/2020"
 # standard Python imports
 
 import asyncio
+import collections
+import errno
+import logging
+import socket
+import struct
+import sys
+import weakref
 
 
 # Toolbox library imports (get those files and put them in the same folder as your app)
 
-from string_toolbox import DumpBufferHexa
+from string_toolbox import cLazyHexDump
+from asyncio_toolbox import cTokenBucket, GetSharedTimer, GetEventLoop
+from network_toolbox import SharedDNSCache, GetIPInterfaceList
+
+
+#===============================================================================
+# Logging
+#===============================================================================
+
+# Like asyncio_tcp_toolbox : classes take a standard logging.Logger, and use
+# this module logger when none is given.
+
+Logger = logging.getLogger('asyncio_udp_toolbox')
+
+
+#===============================================================================
+# Packet trace : hex dump of selected packets (DEBUG level)
+#===============================================================================
+
+# Tracing can stay enabled in production : only packets from / to the traced
+# peers, and / or 1 packet in <sample>, are dumped, and the dump is only built
+# if the DEBUG record is really emitted. When nothing is traced, the cost for
+# each packet is one attribute test :
+#
+#   if self.trace.active:
+#     self.trace.Log('RX', data, addr)
+
+class cPacketTrace():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, logger, name, sample=0, peers=None):
+    self.logger = logger
+    self.name = name
+    self.count = 0                                 # Packets since the last sampled one
+    self.Set(sample, peers)
+    
+    
+  #----------------------------------------------------- Change what is traced
+  # sample : trace 1 packet in <sample> (1 = all, 0 = none)
+  # peers  : addresses (ip, port) always traced
+  
+  def Set(self, sample=0, peers=None):
+    self.sample = sample
+    self.peers = set(peers or ())
+    self.active = bool(sample or self.peers)
+    
+  def AddPeer(self, addr):
+    self.peers.add(addr)
+    self.active = True
+    
+  def RemovePeer(self, addr):
+    self.peers.discard(addr)
+    self.active = bool(self.sample or self.peers)
+  
+  
+  #------------------------------------------------ Is this packet traced ?
+  
+  def Wanted(self, addr):
+    if addr in self.peers:
+      return True
+    if self.sample:
+      self.count += 1
+      if self.count >= self.sample:
+        self.count = 0
+        return True
+    return False
+  
+  
+  #------------------------------------------------------- Trace a packet
+  
+  def Log(self, direction, data, addr):
+    if self.Wanted(addr) and self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug('%s : %s packet %s %s (length : %d bytes)\n%s\n----', self.name, direction,
+                        'from' if direction == 'RX' else 'to', addr, len(data), cLazyHexDump(data))
+
+
+################################################################################
+#                                                                              #
+#                               UDP SEND QUEUE                                 #
+#                                                                              # 
+################################################################################
+
+# Datagrams sent during the same loop iteration are queued, and flushed by a
+# single callback (shared by all the queues of the loop), by batches of up to
+# <batch> datagrams per queue :
+#
+# - Python has no sendmmsg(). Where the kernel supports UDP GSO (Linux 4.18+),
+#   consecutive datagrams of the same size to the same address are sent with
+#   one sendmsg() (UDP_SEGMENT) : the kernel splits them. Otherwise, one
+#   sendto() per datagram.
+# - Optional pacing : at most <rate> datagrams per second (token bucket).
+# - When the socket buffer is full (EAGAIN), sending resumes when the socket
+#   is writable. When the queue is full, the oldest datagram is dropped (for
+#   real-time streams, a late packet is worth less than a new one).
+#
+# Nothing is printed : drops, EAGAIN and errors are counted (see stats()).
+#
+# The queue waits for EAGAIN with loop.add_writer(), which the loop refuses on
+# the fd of a transport : servers and clients give it a dup() of their socket.
+#
+# The gain comes from sockets carrying many datagrams per loop iteration (e.g.
+# all the streams to a gateway on one socket). For a socket sending a single
+# datagram now and then, the direct path (send_batch=None) is cheaper.
+
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)         # Linux only
+UDP_MAX_SEGMENTS = 64
+UDP_MAX_GSO_PAYLOAD = 65000
+UDP_GSO_UNSUPPORTED = {errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP, errno.EIO}     # Errors disabling GSO
+
+
+#===============================================================================
+# Flush all the queues with pending datagrams, in one loop callback
+#===============================================================================
+
+class cUDPSendFlusher():
+
+  def __init__(self, loop):
+    self.loop = loop
+    self.pending = []                                # Queues to flush
+    self.handle = None
+    
+  def Add(self, queue):
+    self.pending.append(queue)
+    if self.handle is None:
+      self.handle = self.loop.call_soon(self.Run)
+  
+  def Run(self):
+    self.handle = None
+    pending, self.pending = self.pending, []
+    for queue in pending:
+      queue.Flush()
+
+
+SendFlushers = weakref.WeakKeyDictionary()
+
+def GetSendFlusher(loop):
+  flusher = SendFlushers.get(loop)
+  if flusher is None:
+    flusher = cUDPSendFlusher(loop)
+    SendFlushers[loop] = flusher
+  return flusher
+
+
+#===============================================================================
+# Send queue (one per socket)
+#===============================================================================
+
+
+class cUDPSendQueue():
+
+  #----------------------------------------------------------------- Constructor
+  # sock : non-blocking socket (addr may be None for a connected socket)
+  
+  def __init__(self, loop, sock, batch=64, rate=None, burst=None, max_queue=1024, gso=True, logger=None, name='UDP'):
+    self.loop = loop
+    self.sock = sock
+    self.batch = batch                               # Max datagrams sent per flush
+    self.bucket = cTokenBucket(rate, burst or batch) if rate else None     # Pacing, None = as fast as possible
+    self.max_queue = max_queue                       # Max queued datagrams (then the oldest is dropped)
+    self.gso = gso and hasattr(sock, 'sendmsg') and (socket.SOCK_DGRAM == sock.type)
+    self.logger = logger or Logger
+    self.name = name
+    
+    self.queue = collections.deque()                 # (data, addr)
+    self.flusher = GetSendFlusher(loop)
+    self.scheduled = False                           # Flush requested (flusher or timer)
+    self.timer = None                                # Pacing : call_later handle
+    self.writing = False                             # Waiting for the socket to be writable
+    
+    self.sent = 0                                    # Statistics
+    self.bytes_sent = 0
+    self.dropped = 0                                 # Queue full
+    self.eagain = 0                                  # Socket buffer full
+    self.errors = 0                                  # Other errors (datagram lost)
+    self.syscalls = 0
+    
+    
+  #------------------------------------------------------- Queue a datagram
+  
+  def Send(self, data, addr=None):
+    queue = self.queue
+    if len(queue) >= self.max_queue:
+      queue.popleft()
+      self.dropped += 1
+    queue.append((data, addr))
+    if not (self.scheduled or self.writing):
+      self.scheduled = True
+      self.flusher.Add(self)
+  
+  
+  #----------------------------------------------------- Send queued datagrams
+  
+  def Flush(self):
+    
+    self.scheduled = False
+    self.timer = None
+    queue = self.queue
+    count = min(self.batch, len(queue))
+    bucket = self.bucket
+    if bucket is not None:
+      bucket.Refill()
+      count = min(count, int(bucket.tokens))
+    
+    sent = 0
+    while sent < count:
+      try:
+        sent += self.SendSome(count - sent)
+      except (BlockingIOError, InterruptedError):
+        self.eagain += 1
+        self.writing = True
+        self.loop.add_writer(self.sock.fileno(), self.Writable)
+        break
+      except OSError as e:
+        data, addr = queue.popleft()                 # Lost (unreachable, too big...)
+        sent += 1
+        self.errors += 1
+        if self.logger.isEnabledFor(logging.DEBUG):
+          self.logger.debug('%s : Unable to send to %s (%s)', self.name, addr, e)
+      
+    if bucket is not None:
+      bucket.tokens -= sent
+    
+    if queue and not self.writing:
+      self.scheduled = True
+      if (bucket is not None) and (bucket.tokens < 1):
+        self.timer = self.loop.call_later((1 - bucket.tokens) / bucket.rate, self.Flush)
+      else:
+        self.flusher.Add(self)
+  
+  
+  #-------------------------------------- Send the first datagram(s) of the queue
+  # Returns the number of datagrams sent (raises OSError if none was)
+  
+  def SendSome(self, count):
+    
+    queue = self.queue
+    data, addr = queue[0]
+    
+    if self.gso and (count > 1):
+      size = len(data)
+      n = 1
+      limit = min(count, UDP_MAX_SEGMENTS, UDP_MAX_GSO_PAYLOAD // max(1, size))
+      while (n < limit) and (n < len(queue)):
+        d, a = queue[n]
+        if (a != addr) or (len(d) != size):
+          break
+        n += 1
+      if n > 1:
+        try:
+          buf = b''.join([queue[i][0] for i in range(n)])
+          control = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', size))]
+          if addr is None:
+            self.sock.sendmsg([buf], control)
+          else:
+            self.sock.sendmsg([buf], control, 0, addr)
+        except OSError as e:
+          if e.errno not in UDP_GSO_UNSUPPORTED:     # EAGAIN, ICMP errors... : normal error path
+            raise
+          self.gso = False                           # Not supported here : one sendto() per datagram from now on
+          self.logger.info('%s : UDP GSO not available (%s)', self.name, e)
+          return 0
+        self.syscalls += 1
+        self.sent += n
+        self.bytes_sent += len(buf)
+        for i in range(n):
+          queue.popleft()
+        return n
+    
+    if addr is None:
+      self.sock.send(data)
+    else:
+      self.sock.sendto(data, addr)
+    self.syscalls += 1
+    self.sent += 1
+    self.bytes_sent += len(data)
+    queue.popleft()
+    return 1
+  
+  
+  #-------------------------------------------- Socket writable again (EAGAIN)
+  
+  def Writable(self):
+    self.loop.remove_writer(self.sock.fileno())
+    self.writing = False
+    self.Flush()
+  
+  
+  #------------------------------------------ Stop sending (queue is discarded)
+  
+  def Close(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    self.scheduled = False
+    if self.writing:
+      self.loop.remove_writer(self.sock.fileno())
+      self.writing = False
+    self.dropped += len(self.queue)
+    self.queue.clear()
+  
+  
+  #-------------------------------------------------------------- Statistics
+  
+  def stats(self):
+    return {'queued'  : len(self.queue),
+            'sent'    : self.sent,
+            'bytes'   : self.bytes_sent,
+            'dropped' : self.dropped,
+            'eagain'  : self.eagain,
+            'errors'  : self.errors,
+            'syscalls': self.syscalls}
 
 
 ################################################################################
@@ -61,17 +380,26 @@ class cUDPClient (asyncio.DatagramProtocol):
   
   #----------------------------------------------------------------- Constructor
   
-  def __init__(self, _name, _server, _port, _loop, _logger):                       
+  def __init__(self, _name, _server, _port, _loop, _logger, trace_sample=0, trace_peers=None,
+               send_batch=None, send_rate=None, send_max_queue=1024):                       
    
     # ip addresses and sockets
     self.taskname = _name
     self.server_address = _server                                            # Can be IP or FQDN
-    self.server_ip = _server   # Not working, netifaces does not install under Windows  CheckUpdateHost (self.server_address, self._logger)     # Is always IP. 0.0.0.0 if DNS resolution failed.
+    self.server_ip = SharedDNSCache.Lookup(_server)     # Always IP, None until resolved (shared DNS cache, refreshed in background)
     self.server_port = _port
        
-    self.loop = _loop                # AsyncIO loop object 
+    self.loop = _loop or GetEventLoop()   # AsyncIO loop object (None : GetEventLoop())
     self.logger = _logger            # Logger object
-    self.debug =  True               # Global flag for more verbose output   
+    self.trace = cPacketTrace(_logger, _name, trace_sample, trace_peers)     # Packet hex dumps (DEBUG level), see cPacketTrace
+    
+    self.transport = None
+    self.send_batch = send_batch     # Send through a cUDPSendQueue (batches of send_batch datagrams), None = direct
+    self.send_rate = send_rate       # Max datagrams per second sent by the queue, None = no pacing
+    self.send_max_queue = send_max_queue
+    self.send_queue = None
+    self.send_errors = 0             # Datagrams not sent (direct path)
+    self.unresolved = 0              # Datagrams not sent : server address not resolved yet
     
     
   #-------------------------------------------------------------- When connected
@@ -79,24 +407,46 @@ class cUDPClient (asyncio.DatagramProtocol):
   def connection_made(self, transport):
     self.logger.info('UDP connection made')
     self.transport = transport
+    SharedDNSCache.Subscribe(self.server_address, self.server_resolved, self.loop)
+    if self.send_batch:
+      sock = transport.get_extra_info('socket').dup()     # Same socket, usable for sendmsg()
+      self.send_queue = cUDPSendQueue(self.loop, sock, batch=self.send_batch, rate=self.send_rate,
+                                      max_queue=self.send_max_queue, logger=self.logger, name=self.taskname)
     # self._system_maintenance = self._loop.create_task(self.maintenance_loop())     # (No maintenance loop in the basic client)
 
 
+  #--------------------------------------------------------- When disconnected
+  
+  def connection_lost(self, exc):
+    SharedDNSCache.Unsubscribe(self.server_address, self.server_resolved)
+    if self.send_queue is not None:
+      self.send_queue.Close()
+      self.send_queue.sock.close()
+      self.send_queue = None
+
+
+  #------------------------------------------ Server address resolved / changed
+  
+  def server_resolved(self, host, ip):
+    if ip != self.server_ip:
+      self.logger.info('%s : %s resolved to %s', self.taskname, host, ip)
+      self.server_ip = ip
+    
+
   #------------------------------------------------- Datagram received by client 
 
   def datagram_received(self, _data, _sockaddr):
     
-    if self.debug :
-      self.logger.debug('RX packet from %s (length : %d bytes)\n%s\n----', _sockaddr, len(_data), DumpBufferHexa(_data))
+    if self.trace.active:
+      self.trace.Log('RX', _data, _sockaddr)
 
     # Validate that we receveived this packet from the right master - security check !
     if _sockaddr != (self.server_ip, self.server_port):
-      self.logger.warning ('Unexpected RX packet from %s:%s' % (_sockaddr))
+      self.logger.warning ('Unexpected RX packet from %s:%s', _sockaddr[0], _sockaddr[1])
       
     else : 
       
       # Process _data here
-      print('rx')
       pass
     
  
@@ -104,17 +454,857 @@ class cUDPClient (asyncio.DatagramProtocol):
     
   def send_server(self, _packet):
 
-    # if True : # self.debug:  
-      # self.logger.debug('TX Packet to %s:%s (length : %d bytes)\n%s\n----',self.server_ip, self.server_port, len(_packet), DumpBufferHexa(_packet))
-      # print('TX Packet to %s:%s (length : %d bytes)\n%s\n----',self.server_ip, self.server_port, len(_packet), DumpBufferHexa(_packet))
+    if self.server_ip is None:
+      self.unresolved += 1
+      return
+    
+    if self.trace.active:
+      self.trace.Log('TX', _packet, (self.server_ip, self.server_port))
+    
+    if self.send_queue is not None:
+      self.send_queue.Send(_packet, (self.server_ip, self.server_port))
+      return
          
     try:   
-      print ("Send_Server")  
       self.transport.sendto(_packet, (self.server_ip, self.server_port))
+    except Exception as e:
+      self.send_errors += 1
+      if self.logger.isEnabledFor(logging.DEBUG):
+        self.logger.debug('%s : Unable to send UDP packet (%s)', self.taskname, e)
+
+
+
+
+################################################################################
+#                                                                              #
+#                            DATAGRAM BUFFER POOL                              #
+#                                                                              # 
+################################################################################
+
+# Fixed-size slabs of one preallocated bytearray, handed out as cUDPBuffer
+# objects (also preallocated). The receive path fills them with recv_into,
+# and the consumer keeps the buffer as long as needed, then releases it :
+#
+#   def OnAudio(buf, addr):                       # cUDPServer(..., pool=cUDPBufferPool(2048, 1024))
+#     payload = buf.view[12:len(buf)]             # RTP payload : memoryview, no copy
+#     level = GetAudioLevel(payload)              # numpy.frombuffer() inside : no copy either
+#     buf.Release()
+#
+# Nothing is allocated per datagram, except the source address given by the
+# socket. A buffer not released is lost for the pool : when the pool is empty,
+# the server stops reading (datagrams wait in the socket buffer, then are
+# dropped by the kernel) until a buffer is released.
+
+
+#===============================================================================
+# One buffer of the pool
+#===============================================================================
+
+class cUDPBuffer():
+
+  __slots__ = ('pool', 'view', 'length', 'addr', 'used')
+
+  def __init__(self, pool, view):
+    self.pool = pool
+    self.view = view                             # memoryview of the whole slab
+    self.length = 0                              # Size of the datagram
+    self.addr = None                             # Source address
+    self.used = False
+    
+  def __len__(self):
+    return self.length
+  
+  @property
+  def data(self):                                # memoryview of the datagram (new view object)
+    return self.view[:self.length]
+  
+  def Release(self):
+    self.pool.Release(self)
+
+
+#===============================================================================
+# Pool
+#===============================================================================
+
+class cUDPBufferPool():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, size=2048, count=1024):
+    self.size = size                             # Bytes per buffer (bigger datagrams are truncated)
+    self.count = count
+    self.arena = bytearray(size * count)
+    arena = memoryview(self.arena)
+    self.buffers = [cUDPBuffer(self, arena[i * size:(i + 1) * size]) for i in range(count)]
+    self.free = self.buffers[::-1]               # Stack of free buffers
+    self.waiters = []                            # Callbacks when a buffer is released (pool was empty)
+    
+    self.exhausted = 0                           # Statistics : Get() on an empty pool
+    self.min_free = count                        # Lowest number of free buffers
+    
+    
+  #------------------------------------------------- Get a buffer (or None)
+  
+  def Get(self):
+    free = self.free
+    if not free:
+      self.exhausted += 1
+      return None
+    buf = free.pop()
+    buf.used = True
+    if len(free) < self.min_free:
+      self.min_free = len(free)
+    return buf
+  
+  
+  #------------------------------------------------------ Give a buffer back
+  
+  def Release(self, buf):
+    if not buf.used:
+      raise ValueError('UDP buffer released twice')
+    buf.used = False
+    buf.addr = None
+    self.free.append(buf)
+    if self.waiters:
+      waiters, self.waiters = self.waiters, []
+      for callback in waiters:
+        callback()
+  
+  
+  #------------------------------- Call callback() when a buffer is released
+  
+  def Wait(self, callback):
+    self.waiters.append(callback)
+  
+  
+  #-------------------------------------------------------------- Statistics
+  
+  def Available(self):
+    return len(self.free)
+  
+  def Stats(self):
+    return {'buffers': self.count, 'free': len(self.free), 'min_free': self.min_free, 'exhausted': self.exhausted}
+
+
+################################################################################
+#                                                                              #
+#                             ASYNCIO UDP SERVER                               #
+#                                                                              # 
+################################################################################
+
+# One socket receives datagrams from any number of peers. Each datagram is
+# dispatched to the handler registered for its source address, or to
+# datagram_received() (override it in a derived class) :
+#
+#   server = cUDPServer(loop, 'RTP', '0.0.0.0', 4000, batch=64)
+#   server.set_peer_handler(('10.0.0.5', 4000), OnRadio1)
+#   server.start_server()
+#
+# Two receive paths :
+#
+# - batch=None : standard AsyncIO DatagramProtocol. One recvfrom() per loop
+#   wakeup, and a new bytes object for each datagram.
+#
+# - batch=N : the server reads the non-blocking socket itself, and drains up
+#   to N datagrams per wakeup (like recvmmsg, which Python does not provide)
+#   with recvfrom_into() into N preallocated buffers. Handlers get a
+#   memoryview of the buffer.
+#
+#   IMPORTANT : like TCP frames, this memoryview is only valid during the
+#   handler call. It is released just after. Use bytes(data) to keep it.
+#
+# - pool=cUDPBufferPool(...) : same as batch=N (64 by default), but each
+#   datagram is received with recvfrom_into() in a buffer of the pool, and
+#   handlers get the cUDPBuffer. They own it, and must Release() it (now or
+#   later) : no copy is needed to keep it.
+#
+# Source addresses are the ones given by the socket : (ip, port) for IPv4,
+# (ip, port, flowinfo, scope_id) for IPv6. Register handlers with IP
+# addresses, not host names.
+
+
+#===============================================================================
+# UDP Server class
+#===============================================================================
+
+class cUDPServer():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, loop, name, local_address, local_port, batch=None, max_datagram=2048, pool=None,
+               receive_buffer=None, reuse_port=False, send_batch=None, send_rate=None, send_max_queue=1024, logger=None):
+    
+    self.loop = loop or GetEventLoop()                # AsyncIO running loop (None : GetEventLoop())
+    self.logger = logger or Logger                    # Standard logging.Logger
+    self.server_name = name
+    self.udp_local_address = local_address            # UDP server will bind to that IP
+    self.udp_local_port = local_port                  # UDP server will listen on that port
+    self.batch = batch                                # Max datagrams read per wakeup, None = standard AsyncIO path
+    self.max_datagram = max_datagram                  # Size of each receive buffer (bigger datagrams are truncated)
+    self.pool = pool                                  # cUDPBufferPool : receive in pooled buffers, released by handlers
+    if (pool is not None) and not batch:
+      self.batch = batch = 64
+    self.reading = False                              # Socket registered in the loop (batched / pool paths)
+    self.receive_buffer = receive_buffer              # SO_RCVBUF in bytes, None = system default
+    self.reuse_port = reuse_port                      # SO_REUSEPORT : several processes can listen on the same port
+    self.send_batch = send_batch                      # Send through a cUDPSendQueue (batches of send_batch datagrams), None = direct
+    self.send_rate = send_rate                        # Max datagrams per second sent by the queue, None = no pacing
+    self.send_max_queue = send_max_queue
+    self.send_queue = None
+    
+    self.handlers = {}                                # Source address -> handler(data, addr)
+    self.trace = cPacketTrace(self.logger, name)      # Packet hex dumps (DEBUG level), see cPacketTrace
+    
+    self.transport = None                             # Standard path
+    self.sock = None                                  # Socket (both paths)
+    
+    if pool is not None:                              # Pool path
+      self.received = [None] * batch
+    elif batch:                                       # Batched path : everything is allocated once
+      self.slabs = [bytearray(max_datagram) for _ in range(batch)]
+      self.views = [memoryview(slab) for slab in self.slabs]
+      self.sizes = [0] * batch
+      self.addrs = [None] * batch
+    
+    self.packets_in = 0                               # Statistics
+    self.bytes_in = 0
+    self.packets_out = 0
+    self.bytes_out = 0
+    self.send_errors = 0                              # Datagrams not sent (socket buffer full...)
+    self.wakeups = 0                                  # Number of batched reads
+    
+    self.canceled = False
+    self.stop_event = None                            # Set to stop serving (created in serve(), on the running loop)
+
+    
+  #--------------------------------------------------------- Per peer handlers
+  
+  def set_peer_handler(self, addr, handler):
+    self.handlers[addr] = handler
+    
+  def remove_peer_handler(self, addr):
+    self.handlers.pop(addr, None)
+    
+    
+  #------------------------------------- Datagram from a peer without handler
+  # (Override in a derived class)
+  
+  def datagram_received(self, data, addr):
+    if isinstance(data, cUDPBuffer):                  # Pool path : the handler owns the buffer
+      data.Release()
+  
+  
+  #----------------------------------------------------------- Socket errors
+  # (e.g. ICMP port unreachable after sending to a closed port)
+  
+  def error_received(self, exc):
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug('%s : Socket error (%s)', self.server_name, exc)
+    
+    
+  #-------------------------------------------------- Dispatch one datagram
+  # (Standard path)
+  
+  def dispatch(self, data, addr):
+    self.packets_in += 1
+    self.bytes_in += len(data)
+    if self.trace.active:
+      self.trace.Log('RX', data, addr)
+    try:
+      self.handlers.get(addr, self.datagram_received)(data, addr)
+    except Exception:
+      self.logger.exception('%s : Exception in handler for %s', self.server_name, addr)
+  
+  
+  #------------------------------------ Drain the socket, then dispatch
+  # (Batched path, called by the loop when the socket is readable)
+  
+  def read_batch(self):
+    
+    sock = self.sock
+    sizes = self.sizes
+    addrs = self.addrs
+    
+    count = 0
+    for slab in self.slabs:
+      try:
+        sizes[count], addrs[count] = sock.recvfrom_into(slab)
+      except (BlockingIOError, InterruptedError):
+        break
+      except OSError as e:
+        self.error_received(e)
+        break
+      count += 1
+    
+    self.wakeups += 1
+    self.packets_in += count
+    handlers = self.handlers
+    default = self.datagram_received
+    views = self.views
+    trace = self.trace
+    for i in range(count):
+      addr = addrs[i]
+      data = views[i][:sizes[i]]
+      self.bytes_in += sizes[i]
+      if trace.active:
+        trace.Log('RX', data, addr)
+      try:
+        handlers.get(addr, default)(data, addr)
+      except Exception:
+        self.logger.exception('%s : Exception in handler for %s', self.server_name, addr)
+      finally:
+        data.release()
+      addrs[i] = None                                 # Don't keep old addresses alive
+  
+  
+  #------------------------------------ Drain the socket into pooled buffers
+  # (Pool path, called by the loop when the socket is readable)
+  
+  def read_pool(self):
+    
+    sock = self.sock
+    pool = self.pool
+    received = self.received
+    
+    count = 0
+    while count < self.batch:
+      buf = pool.Get()
+      if buf is None:                                 # Pool empty : wait for a release
+        self.pause_reading()
+        pool.Wait(self.resume_reading)
+        break
+      try:
+        buf.length, buf.addr = sock.recvfrom_into(buf.view)
+      except (BlockingIOError, InterruptedError):
+        pool.Release(buf)
+        break
+      except OSError as e:
+        pool.Release(buf)
+        self.error_received(e)
+        break
+      received[count] = buf
+      count += 1
+    
+    self.wakeups += 1
+    self.packets_in += count
+    handlers = self.handlers
+    default = self.datagram_received
+    trace = self.trace
+    for i in range(count):
+      buf = received[i]
+      received[i] = None
+      addr = buf.addr
+      self.bytes_in += buf.length
+      if trace.active:
+        trace.Log('RX', buf.data, addr)
+      try:
+        handlers.get(addr, default)(buf, addr)
+      except Exception:
+        self.logger.exception('%s : Exception in handler for %s', self.server_name, addr)
+  
+  
+  #------------------------------------------ Stop / resume reading the socket
+  
+  def pause_reading(self):
+    if self.reading:
+      self.loop.remove_reader(self.sock.fileno())
+      self.reading = False
+  
+  def resume_reading(self):
+    if (not self.reading) and (self.sock is not None):
+      self.loop.add_reader(self.sock.fileno(), self.read_pool if self.pool is not None else self.read_batch)
+      self.reading = True
+  
+  
+  #------------------------------------------------------- Send a datagram
+  # Returns False if the datagram was not sent
+  
+  def sendto(self, data, addr):
+    if self.trace.active:
+      self.trace.Log('TX', data, addr)
+    if self.send_queue is not None:
+      self.send_queue.Send(data, addr)
+      return True
+    try:
+      if self.transport is not None:
+        self.transport.sendto(data, addr)
+      else:
+        self.sock.sendto(data, addr)
+    except (BlockingIOError, InterruptedError, OSError) as e:
+      self.send_errors += 1
+      if self.logger.isEnabledFor(logging.DEBUG):
+        self.logger.debug('%s : Unable to send to %s (%s)', self.server_name, addr, e)
+      return False
+    self.packets_out += 1
+    self.bytes_out += len(data)
+    return True
+  
+  
+  #------------------------------------------------------- Server statistics
+  
+  def stats(self):
+    stats = {'packets_in' : self.packets_in,
+             'bytes_in'   : self.bytes_in,
+             'packets_out': self.packets_out,
+             'bytes_out'  : self.bytes_out,
+             'send_errors': self.send_errors,
+             'peers'      : len(self.handlers)}
+    if self.pool is not None:
+      stats.update(('pool_' + k, v) for k, v in self.pool.Stats().items())
+    if self.send_queue is not None:
+      stats.update(('send_' + k, v) for k, v in self.send_queue.stats().items())
+    return stats
+  
+  
+  #----------------------------------------------------------- Create socket
+  
+  def create_socket(self):
+    family = socket.AF_INET6 if ':' in self.udp_local_address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+      sock.setblocking(False)
+      if self.reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      if self.receive_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+      sock.bind((self.udp_local_address, self.udp_local_port))
     except:
-      print('EXCEPTION sending UDP packet')   
+      sock.close()
+      raise
+    return sock
+  
+  
+  #------------------------------------------------------ Create AsyncIO endpoint
+  
+  async def create_endpoint(self):
+    self.sock = self.create_socket()
+    if self.send_batch:
+      sock = self.sock.dup()                          # Own fd : add_writer() is refused on a transport's fd
+      self.send_queue = cUDPSendQueue(self.loop, sock, batch=self.send_batch, rate=self.send_rate,
+                                      max_queue=self.send_max_queue, logger=self.logger, name=self.server_name)
+    if self.batch:
+      self.resume_reading()
+    else:
+      self.transport, protocol = await self.loop.create_datagram_endpoint(lambda: cUDPServerProtocol(self), sock=self.sock)
+    
+    
+  #--------------------------------------------------------- Start server task
+  
+  def start_server(self, name=None):
+    if name==None:
+      name="UDP server at %s:%d" %(self.udp_local_address, self.udp_local_port)
+    self.loop.create_task(self.serve(), name=name)
+  
+  
+  #---------------------------------------------------- Request server to stop
+  # (Same as canceling the server task)
+  
+  def cancel_server(self):
+    self.canceled = True
+    if self.stop_event is not None:
+      self.stop_event.set()
+
+    
+  #---------------------------------------------------------------- Stop Server
+  
+  def stop_server(self):
+    if self.send_queue is not None:
+      self.send_queue.Close()
+      self.send_queue.sock.close()
+      self.send_queue = None
+    if self.transport is not None:
+      self.transport.close()
+      self.transport = None
+    elif self.sock is not None:
+      self.pause_reading()
+      self.sock.close()
+    self.sock = None
+  
+  
+  #--------------------------------------------------- Starting / stopping server
+  
+  async def serve(self):
+    
+    self.canceled = False
+    self.stop_event = asyncio.Event()
+    
+    while True:
+      try:
+        self.logger.info("%s : Starting UDP server at %s:%d", self.server_name, self.udp_local_address, self.udp_local_port)
+        await self.create_endpoint()
+        self.logger.info("%s : UDP server started on port %d (%s)", self.server_name, self.udp_local_port,
+                         ('pooled buffers, ' if self.pool is not None else '') + 'batches of %d' % self.batch if self.batch else 'standard receive path')
+        break
+      except OSError:
+        self.logger.error("%s : Unable to start server on port %d; port may be already in use.", self.server_name, self.udp_local_port)
+      self.logger.info("%s : Retrying in 10 seconds...", self.server_name)
+      await asyncio.sleep(10)
+    
+    try:
+      await self.stop_event.wait()
+    except asyncio.CancelledError:
+      self.logger.info("%s : Server canceled.", self.server_name)
+      self.canceled = True
+    finally:
+      self.stop_server()
+      self.logger.info("%s : UDP Server stopped.", self.server_name)
+
+
+#===============================================================================
+# Protocol of the standard receive path
+#===============================================================================
+
+class cUDPServerProtocol(asyncio.DatagramProtocol):
+
+  def __init__(self, parent):
+    self.parent = parent
+    self.datagram_received = parent.dispatch        # No extra call level
+    
+  def error_received(self, exc):
+    self.parent.error_received(exc)
+
+
+################################################################################
+#                                                                              #
+#                           MULTI-PEER UDP ENDPOINT                            #
+#                                                                              # 
+################################################################################
+
+# One socket for thousands of peers (SIP / RTP endpoints, field radios...),
+# instead of one cUDPClient and one socket per peer :
+#
+#   endpoint = cUDPEndpoint(loop, 'RADIOS', '0.0.0.0', 4000, batch=64, idle_timeout=60,
+#                           allow={'10.0.0.5', '10.0.0.6'}, callback=OnRadioPacket)
+#   endpoint.start_server()
+#   ...
+#   def OnRadioPacket(peer, data):             # peer : cUDPPeer, data : as in cUDPServer
+#     peer.Send(answer)
+#
+# - Peers are cUDPPeer records in a dict keyed by the source address : one
+#   lookup per datagram. Each record has counters, last seen time, a callback
+#   and a free <context> attribute for the application.
+# - Source IPs are checked against the allow-list (a set, None = allow all)
+#   only for the first datagram of a peer. Datagrams from unknown peers are
+#   also dropped when accept_unknown is False (only AddPeer() peers) or when
+#   max_peers is reached.
+# - Idle peers (nothing received for idle_timeout s) are evicted, with one
+#   entry per peer in the shared timer heap (re-checked when due : receiving
+#   a datagram only updates last_seen). Peers added with AddPeer(static=True)
+#   are never evicted.
+
+
+#===============================================================================
+# Peer record
+#===============================================================================
+
+class cUDPPeer():
 
+  __slots__ = ('endpoint', 'addr', 'callback', 'context', 'static', 'timer',
+               'packets_in', 'bytes_in', 'packets_out', 'bytes_out', 'first_seen', 'last_seen')
 
+  def __init__(self, endpoint, addr, callback, context=None, static=False):
+    self.endpoint = endpoint
+    self.addr = addr                             # Source address, as given by the socket
+    self.callback = callback                     # callback(peer, data)
+    self.context = context                       # Free for the application
+    self.static = static                         # Never evicted
+    self.timer = None                            # Idle check, in the shared timer heap
+    self.packets_in = 0
+    self.bytes_in = 0
+    self.packets_out = 0
+    self.bytes_out = 0
+    self.first_seen = self.last_seen = endpoint.loop.time()
+    
+    
+  #--------------------------------------------------- Datagram from this peer
+  # (Registered as the cUDPServer handler of this address)
+  
+  def Receive(self, data, addr):
+    self.packets_in += 1
+    self.bytes_in += len(data)
+    self.last_seen = self.endpoint.loop.time()
+    self.callback(self, data)
+    
+  
+  #------------------------------------------------------ Send to this peer
+  
+  def Send(self, data):
+    self.packets_out += 1
+    self.bytes_out += len(data)
+    return self.endpoint.sendto(data, self.addr)
+  
+  
+  #--------------------------------------------------------------- Display
+  
+  def __str__(self):
+    return '%s:%s (in %d, out %d)' % (self.addr[0], self.addr[1], self.packets_in, self.packets_out)
+
+  def Stats(self):
+    return {'packets_in' : self.packets_in,
+            'bytes_in'   : self.bytes_in,
+            'packets_out': self.packets_out,
+            'bytes_out'  : self.bytes_out,
+            'first_seen' : self.first_seen,
+            'last_seen'  : self.last_seen}
+
+
+#===============================================================================
+# Endpoint class
+#===============================================================================
+
+class cUDPEndpoint(cUDPServer):
+
+  #----------------------------------------------------------------- Constructor
+  # Other parameters : see cUDPServer
+  
+  def __init__(self, loop, name, local_address, local_port, callback=None, allow=None, accept_unknown=True,
+               max_peers=None, idle_timeout=None, **kwargs):
+    super().__init__(loop, name, local_address, local_port, **kwargs)
+    self.peers = {}                                   # addr -> cUDPPeer
+    self.callback = callback or self.peer_datagram_received       # Default callback for new peers
+    self.allow = set(allow) if allow is not None else None        # Allowed source IPs, None = all
+    self.accept_unknown = accept_unknown              # Create peers for unknown (allowed) addresses
+    self.max_peers = max_peers                        # None = no limit
+    self.idle_timeout = idle_timeout                  # Evict peers silent for that time (s), None = never
+    
+    self.rejected = 0                                 # Datagrams from unknown / not allowed addresses
+    self.evicted = 0
+    
+    
+  #------------------------------------------------------ Allow-list (source IPs)
+  
+  def Allow(self, ip):
+    if self.allow is None:
+      self.allow = set()
+    self.allow.add(ip)
+    
+  def Disallow(self, ip):
+    if self.allow is not None:
+      self.allow.discard(ip)
+    for peer in [p for p in self.peers.values() if (p.addr[0] == ip) and not p.static]:
+      self.RemovePeer(peer.addr, 'disallowed')
+  
+  def IsAllowed(self, ip):
+    return (self.allow is None) or (ip in self.allow)
+  
+  
+  #------------------------------------------------------------ Peer table
+  
+  def GetPeer(self, addr):
+    return self.peers.get(addr)
+  
+  def AddPeer(self, addr, callback=None, context=None, static=False):
+    peer = self.peers.get(addr)
+    if peer is None:
+      peer = cUDPPeer(self, addr, callback or self.callback, context, static)
+      self.peers[addr] = peer
+      self.handlers[addr] = peer.Receive
+      if self.idle_timeout and not static:
+        peer.timer = GetSharedTimer(self.loop).Schedule(peer.last_seen + self.idle_timeout, self.check_idle, peer)
+      self.peer_added(peer)
+    return peer
+  
+  def RemovePeer(self, addr, reason='removed'):
+    peer = self.peers.pop(addr, None)
+    if peer is None:
+      return None
+    self.handlers.pop(addr, None)
+    if peer.timer is not None:
+      GetSharedTimer(self.loop).Cancel(peer.timer)
+      peer.timer = None
+    self.peer_removed(peer, reason)
+    return peer
+  
+  
+  #----------------------------------------------- Check idle peer (timer)
+  
+  def check_idle(self, peer):
+    peer.timer = None
+    if self.peers.get(peer.addr) is not peer:
+      return
+    deadline = peer.last_seen + self.idle_timeout
+    if self.loop.time() >= deadline:
+      self.evicted += 1
+      self.RemovePeer(peer.addr, 'idle')
+    else:
+      peer.timer = GetSharedTimer(self.loop).Schedule(deadline, self.check_idle, peer)
+  
+  
+  #--------------------------------------- Datagram from an unknown address
+  # (Peers have their own handler : this is only called for the first datagram)
+  
+  def datagram_received(self, data, addr):
+    if (not self.accept_unknown) or (not self.IsAllowed(addr[0])) or \
+       ((self.max_peers is not None) and (len(self.peers) >= self.max_peers)):
+      self.rejected += 1
+      if isinstance(data, cUDPBuffer):
+        data.Release()
+      if self.logger.isEnabledFor(logging.DEBUG):
+        self.logger.debug('%s : Datagram from %s:%s rejected', self.server_name, addr[0], addr[1])
+      return
+    self.AddPeer(addr).Receive(data, addr)
+    
+    
+  #-------------------------------------------------- Hooks (override them)
+  
+  def peer_datagram_received(self, peer, data):      # Default callback
+    if isinstance(data, cUDPBuffer):
+      data.Release()
+  
+  def peer_added(self, peer):
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug('%s : New peer %s:%s', self.server_name, peer.addr[0], peer.addr[1])
+  
+  def peer_removed(self, peer, reason):
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug('%s : Peer %s removed (%s)', self.server_name, peer, reason)
+  
+  
+  #------------------------------------------------------------- Statistics
+  
+  def stats(self):
+    stats = super().stats()
+    stats.update({'peers': len(self.peers), 'rejected': self.rejected, 'evicted': self.evicted})
+    return stats
+  
+  
+  #--------------------------------------------------------------- Stop
+  
+  def stop_server(self):
+    for addr in list(self.peers):
+      self.RemovePeer(addr, 'stopped')
+    super().stop_server()
+
+
+################################################################################
+#                                                                              #
+#                            UDP MULTICAST ENDPOINT                            #
+#                                                                              # 
+################################################################################
+
+# One socket receives one or more IPv4 multicast groups, joined on one or
+# more interfaces, and delivers them like cUDPServer (same receive paths, per
+# source handlers or datagram_received) :
+#
+#   mc = cUDPMulticast(loop, 'AUDIO', ['239.1.1.1', '239.1.1.2'], 5004, interfaces=None, batch=64)
+#   mc.start_server()
+#   mc.send_group(frame, '239.1.1.1')
+#
+# interfaces : local IP addresses of the interfaces to join on. None = all the
+# interfaces given by network_toolbox.GetIPInterfaceList() (or the default
+# interface if the list is not available).
+# Sent datagrams leave through <egress> (local IP, None = system choice), with
+# <ttl> (1 = local network) and <loopback> (local copy of sent datagrams).
+
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)   # Linux only
+
+class cUDPMulticast(cUDPServer):
+
+  #----------------------------------------------------------------- Constructor
+  # Other parameters : see cUDPServer
+  
+  def __init__(self, loop, name, groups, port, interfaces=None, egress=None, ttl=1, loopback=True, **kwargs):
+    super().__init__(loop, name, '0.0.0.0', port, **kwargs)
+    self.groups = [groups] if isinstance(groups, str) else list(groups)     # Multicast groups
+    self.interfaces = interfaces                      # Local IPs to join on, None = all
+    self.egress = egress                              # Local IP of the interface used for sending
+    self.ttl = ttl
+    self.loopback = loopback
+    self.joined = set()                               # (group, interface)
+    
+    
+  #------------------------------------------ Interfaces used for the joins
+  
+  def join_interfaces(self):
+    if self.interfaces is not None:
+      return list(self.interfaces)
+    interfaces = [ip for (ip, mask, broadcast) in GetIPInterfaceList()]
+    return interfaces or ['0.0.0.0']                  # 0.0.0.0 : default interface
+  
+  
+  #----------------------------------------------------------- Create socket
+  # Bound to the port on all addresses : one socket for all the groups
+  
+  def create_socket(self):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      sock.setblocking(False)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)       # Other apps can receive the same groups
+      if self.reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      if self.receive_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 if self.loopback else 0)
+      if sys.platform.startswith('linux'):
+        sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)         # Only the groups joined by this socket
+      if self.egress:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.egress))
+      sock.bind(('', self.udp_local_port))
+      self.sock = sock
+      self.joined = set()
+      for group in self.groups:
+        self.join_group(group)
+    except:
+      sock.close()
+      self.sock = None
+      raise
+    return sock
+  
+  
+  #------------------------------------------------- Join / leave a group
+  # (IGMP join on each interface; also usable while running)
+  
+  def join_group(self, group, interfaces=None):
+    if group not in self.groups:
+      self.groups.append(group)
+    if self.sock is None:
+      return
+    for interface in interfaces or self.join_interfaces():
+      if (group, interface) in self.joined:
+        continue
+      mreq = socket.inet_aton(group) + socket.inet_aton(interface)
+      try:
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.joined.add((group, interface))
+        self.logger.info('%s : Joined %s on %s', self.server_name, group, interface)
+      except OSError as e:
+        self.logger.warning('%s : Unable to join %s on %s (%s)', self.server_name, group, interface, e)
+  
+  def leave_group(self, group):
+    if group in self.groups:
+      self.groups.remove(group)
+    if self.sock is None:
+      return
+    for (g, interface) in [j for j in self.joined if j[0] == group]:
+      mreq = socket.inet_aton(g) + socket.inet_aton(interface)
+      try:
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq)
+      except OSError:
+        pass
+      self.joined.discard((g, interface))
+  
+  
+  #---------------------------------------------------------------- Stop Server
+  # (Memberships end with the socket)
+  
+  def stop_server(self):
+    super().stop_server()
+    self.joined = set()
+  
+  
+  #--------------------------------------------------- Send to a group
+  
+  def send_group(self, data, group=None):
+    return self.sendto(data, (group or self.groups[0], self.udp_local_port))
+  
+  
+  #--------------------------------------------------------------- Statistics
+  
+  def stats(self):
+    stats = super().stats()
+    stats['joined'] = len(self.joined)
+    return stats
 
 
 ################################################################################
@@ -49,12 +49,13 @@ import math
       
 #===============================================================================
 # Simple maximum absolute value of a buffer
+# (bytes, bytearray or memoryview of 160 int16 samples, e.g. a pooled UDP buffer)
 #===============================================================================
       
 def GetAudioLevel (audio):
   
-  audio16 = struct.unpack("<160h", audio)       # Unpacks buffer in an array of int16
-  audio_max = max(numpy.absolute(audio16))     
+  audio16 = numpy.frombuffer(audio, dtype='<i2', count=160)     # int16 view of the buffer (no copy)
+  audio_max = max(int(audio16.max()), -int(audio16.min()))     # (No abs() : -32768 does not fit in int16)
   return audio_max
 
 
@@ -37,7 +37,9 @@ VersionDate = "15/05/2021"
 # Python standard imports
 
 import asyncio
+import math
 import queue
+import time
 import numpy as np
 
 
@@ -102,11 +104,17 @@ class cCircularBuffer():
     
   #---------------------------------------------------------- Add data to buffer
   # Add data in the buffer at the pointer position
+  # (NumPy array, raw buffer of <dtype> elements or sequence of values, copied :
+  # can be released after)
   # TODO : check if data is numpy array 
   # TODO : try/except
   
   def AddData(self, data):
     
+    if isinstance(data, (bytes, bytearray, memoryview)):
+      data = np.frombuffer(data, dtype=self.dtype)         # Raw buffer (e.g. pooled UDP buffer) : no copy
+    elif not isinstance(data, np.ndarray):
+      data = np.asarray(data, dtype=self.dtype)            # List, tuple...
     l = len(data)
     if l == self.blocksize:
       beg = self.pointer
@@ -144,6 +152,245 @@ class cCircularBuffer():
 
 
 
+################################################################################
+#                                                                              #
+#                                JITTER BUFFER                                 #
+#                                                                              # 
+################################################################################
+
+#===============================================================================
+# Jitter buffer for audio streams (RTP-like : sequence number + timestamp)
+#===============================================================================
+
+# The network side calls Put() for each packet, with the sequence number and
+# timestamp extracted by the caller. The playout side calls Get() once per
+# frame time, and always gets a frame : received, concealed or silence.
+#
+#   jb = cJitterBuffer(dtype=np.int16, blocksize=160, clock_rate=8000)
+#   jb.Put(seq, timestamp, payload)          # From datagram_received()
+#   frame = jb.Get()                         # Every 20 ms ; jb.state tells what it is
+#
+# - Frames are stored in a fixed NumPy ring (slots x blocksize) : memory does
+#   not depend on the stream, and nothing is allocated per packet.
+# - Packets are reordered by sequence number (16 bits, wrapping, by default).
+#   Late packets (already played) and duplicates are counted and dropped.
+# - Playout delay adapts to the interarrival jitter (estimated as in RFC 3550) :
+#   the buffer grows on underrun, and skips a frame when it holds more than
+#   needed.
+# - Missing frames are replaced by conceal(out, previous, count), which fills
+#   <out> (a preallocated row). Default : previous frame attenuated by 2 for
+#   each consecutive loss, then silence.
+#
+# The frame returned by Get() is a view of the ring : it is only valid until
+# the next Get() / Put().
+
+JB_BUFFERING = 'buffering'                         # Waiting for the playout delay : silence
+JB_OK        = 'ok'                                # Received frame
+JB_LOST      = 'lost'                              # Missing frame (later frames received) : concealed
+JB_UNDERRUN  = 'underrun'                          # Nothing to play : concealed, delay grows by one frame
+
+JB_PUT_OK        = 'ok'
+JB_PUT_LATE      = 'late'                          # Already played (or skipped) : dropped
+JB_PUT_DUPLICATE = 'duplicate'
+JB_PUT_RESYNC    = 'resync'                        # Too far ahead : older frames dropped
+
+
+class cJitterBuffer():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, dtype=np.int16, blocksize=160, slots=32, clock_rate=8000, frame_time=0.02,
+               min_delay=2, max_delay=None, seq_bits=16, conceal=None, conceal_max=3):
+    
+    self.dtype      = np.dtype(dtype)                      # Data type of one sample
+    self.blocksize  = blocksize                            # Samples in a frame
+    self.slots      = slots                                # Frames stored in the ring
+    self.clock_rate = clock_rate                           # Timestamp units per second
+    self.frame_time = frame_time                           # Seconds per frame
+    self.min_delay  = min_delay                            # Playout delay limits (frames)
+    self.max_delay  = max_delay or (slots - 2)
+    self.seq_mask   = (1 << seq_bits) - 1 if seq_bits else None      # None : sequence numbers don't wrap
+    self.conceal    = conceal or self.ConcealFade          # Loss concealment hook
+    self.conceal_max = conceal_max                         # Consecutive losses before silence (default hook)
+    
+    self.rowbytes   = blocksize * self.dtype.itemsize
+    self.raw        = bytearray((slots + 1) * self.rowbytes)             # Last row : concealment / silence
+    self.buffer     = np.frombuffer(self.raw, dtype=self.dtype).reshape(slots + 1, blocksize)
+    self.out        = self.buffer[slots]
+    self.rows       = [self.buffer[i] for i in range(slots + 1)]         # Row views, created once
+    self.slot_seq   = [-1] * slots                         # Extended sequence number in each slot
+    
+    self.Reset()
+    
+    
+  #------------------------------------------------------ Back to initial state
+  
+  def Reset(self):
+    for i in range(self.slots):
+      self.slot_seq[i] = -1
+    self.out.fill(0)
+    self.state = JB_BUFFERING
+    self.started = False
+    self.play = 0                                          # Extended sequence number of the next frame to play
+    self.highest = -1                                      # Highest extended sequence number received
+    self.previous = self.slots                             # Row of the last frame returned
+    self.losses = 0                                        # Consecutive concealed frames
+    
+    self.timestamp = None                                  # Extended RTP timestamp of the last packet
+    self.transit = None                                    # Jitter estimation (RFC 3550, seconds)
+    self.jitter = 0.0
+    self.target = self.min_delay                           # Current playout delay (frames)
+    
+    self.received = 0                                      # Statistics
+    self.late = 0
+    self.duplicates = 0
+    self.resyncs = 0
+    self.played = 0
+    self.lost = 0
+    self.underruns = 0
+    self.skipped = 0
+  
+  
+  #----------------------------------------------- Add a packet (network side)
+  # Returns JB_PUT_xxx
+  
+  def Put(self, seq, timestamp, payload, arrival=None):
+    
+    if arrival is None:
+      arrival = time.monotonic()
+    
+    # Extended sequence number
+    
+    if not self.started:
+      self.started = True
+      self.play = self.highest = seq
+      ext = seq
+    elif self.seq_mask is None:
+      ext = seq
+    else:
+      mask = self.seq_mask
+      delta = (seq - self.highest) & mask
+      if delta > (mask >> 1):
+        delta -= mask + 1
+      ext = self.highest + delta
+    
+    if ext < self.play:
+      self.late += 1
+      return JB_PUT_LATE
+    
+    status = JB_PUT_OK
+    if ext >= self.play + self.slots - 1:                  # (Never overwrite the frame just played)
+      self.play = ext - self.target + 1
+      self.resyncs += 1
+      status = JB_PUT_RESYNC
+    
+    slot = ext % self.slots
+    if self.slot_seq[slot] == ext:
+      self.duplicates += 1
+      return JB_PUT_DUPLICATE
+    
+    # Store the frame
+    
+    if isinstance(payload, np.ndarray):
+      self.buffer[slot] = payload
+    else:
+      start = slot * self.rowbytes
+      size = min(len(payload), self.rowbytes)
+      self.raw[start:start + size] = payload[:size] if size < len(payload) else payload
+      if size < self.rowbytes:
+        self.rows[slot][size // self.dtype.itemsize:] = 0
+    self.slot_seq[slot] = ext
+    if ext > self.highest:
+      self.highest = ext
+    self.received += 1
+    
+    # Interarrival jitter and playout delay
+    
+    if self.timestamp is None:
+      self.timestamp = timestamp
+    else:
+      delta = (timestamp - self.timestamp) & 0xFFFFFFFF     # 32-bit RTP timestamps wrap : signed difference
+      if delta >= 0x80000000:
+        delta -= 0x100000000
+      self.timestamp += delta
+    transit = arrival - self.timestamp / self.clock_rate
+    if self.transit is not None:
+      self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+    self.transit = transit
+    self.target = min(self.max_delay, self.min_delay + math.ceil(4 * self.jitter / self.frame_time))
+    
+    return status
+  
+  
+  #------------------------------------------- Next frame (playout side)
+  
+  def Get(self):
+    
+    if self.state == JB_BUFFERING:
+      if (not self.started) or (self.highest - self.play + 1 < self.target):
+        self.out.fill(0)
+        self.previous = self.slots
+        return self.out
+    
+    # Too much delay : skip a frame
+    
+    if self.highest - self.play + 1 > self.target + 2:
+      self.play += 1
+      self.skipped += 1
+    
+    slot = self.play % self.slots
+    if self.slot_seq[slot] == self.play:
+      self.play += 1
+      self.played += 1
+      self.losses = 0
+      self.previous = slot
+      self.state = JB_OK
+      return self.rows[slot]
+    
+    # Missing frame : lost (later frames are there), or underrun (nothing to play)
+    
+    self.losses += 1
+    if self.highest >= self.play:
+      self.play += 1
+      self.lost += 1
+      self.state = JB_LOST
+    else:
+      self.underruns += 1
+      self.state = JB_UNDERRUN
+      if self.losses > self.max_delay:                     # Stream stopped : wait for the playout delay again
+        self.state = JB_BUFFERING
+    self.conceal(self.out, self.rows[self.previous], self.losses)
+    self.previous = self.slots
+    return self.out
+  
+  
+  #------------------------------------------- Default loss concealment hook
+  # Fills <out> (in place, no allocation)
+  
+  def ConcealFade(self, out, previous, count):
+    if count > self.conceal_max:
+      out.fill(0)
+    else:
+      np.multiply(previous, 0.5, out=out, casting='unsafe')
+  
+  
+  #---------------------------------------------------------------- Statistics
+  
+  def Stats(self):
+    return {'received'  : self.received,
+            'played'    : self.played,
+            'lost'      : self.lost,
+            'late'      : self.late,
+            'duplicates': self.duplicates,
+            'underruns' : self.underruns,
+            'skipped'   : self.skipped,
+            'resyncs'   : self.resyncs,
+            'jitter_ms' : self.jitter * 1000,
+            'delay'     : self.target,
+            'buffered'  : max(0, self.highest - self.play + 1)}
+
+
+
 ################################################################################
 #                                                                              #
 #                              M A I N                                         #
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+#===============================================================================
+# Python3 Toolbox
+# (c) 2011-2022 by Toussaint OTTAVI, bc-109 Soft, t.ottavi@medi.fr
+#===============================================================================
+#
+# Metrics toolbox : counters, gauges and latency histograms, with snapshot
+# and Prometheus text exposition
+#
+#===============================================================================
+
+#===============================================================================
+#    This is free software: you can redistribute it and/or modify it
+#    under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+Name = "Python Toolbox - Metrics library"
+Version = "0.1"
+VersionDate = "30/12/2022"
+
+
+################################################################################
+#                                                                              #
+#                                 METRICS                                      #
+#                                                                              #
+################################################################################
+
+# A registry (cMetrics) holds named metrics, with optional labels :
+#
+#   metrics = cMetrics()
+#   rx = metrics.Counter('tcp_bytes_in_total', server='AMI')
+#   rx.value += len(data)                          # Hot path : one attribute increment
+#   metrics.Histogram('tcp_connect_seconds', client='TLM').Record(0.0032)
+#   metrics.Gauge('tcp_clients', lambda: len(clients), server='AMI')
+#
+# Classes using metrics take a registry, or None to disable them. When disabled,
+# the only cost on the hot path is a test on None.
+
+
+#===============================================================================
+# Counter (only increases)
+#===============================================================================
+
+class cCounter():
+
+  __slots__ = ('value',)
+
+  def __init__(self):
+    self.value = 0
+
+
+#===============================================================================
+# Gauge (value read from a function when a snapshot is made)
+#===============================================================================
+
+class cGauge():
+
+  __slots__ = ('function',)
+
+  def __init__(self, function):
+    self.function = function
+
+  @property
+  def value(self):
+    try:
+      return self.function()
+    except:
+      return 0
+
+
+#===============================================================================
+# Latency histogram (HDR-style : log-linear buckets, microsecond resolution)
+#===============================================================================
+
+# Values are stored in microseconds. Below 2^SUB_BITS us, one bucket per us;
+# above, each power of 2 is split in 2^(SUB_BITS-1) linear buckets, so the
+# relative error stays below 1 / 2^(SUB_BITS-1) (~3 % with SUB_BITS = 6)
+# and the histogram has a fixed size, whatever the number of values.
+
+HISTOGRAM_SUB_BITS = 6
+HISTOGRAM_MAX_SHIFT = 36                           # Up to ~2^42 us (50 days)
+
+class cHistogram():
+
+  #----------------------------------------------------------------- Constructor
+
+  def __init__(self):
+    self.half = 1 << (HISTOGRAM_SUB_BITS - 1)
+    self.buckets = [0] * ((HISTOGRAM_MAX_SHIFT + 2) * self.half)
+    self.count = 0
+    self.sum = 0.0                                 # Seconds
+    self.min = None
+    self.max = None
+
+
+  #------------------------------------------------ Record a value (seconds)
+
+  def Record(self, seconds):
+
+    us = int(seconds * 1000000)
+    if us < 0:
+      us = 0
+    shift = us.bit_length() - HISTOGRAM_SUB_BITS
+    if shift <= 0:
+      index = us
+    else:
+      index = min(shift * self.half + (us >> shift), len(self.buckets) - 1)
+    self.buckets[index] += 1
+
+    self.count = self.count + 1
+    self.sum = self.sum + seconds
+    if (self.min is None) or (seconds < self.min):
+      self.min = seconds
+    if (self.max is None) or (seconds > self.max):
+      self.max = seconds
+
+
+  #------------------------------------ Lowest value of a bucket (seconds)
+
+  def BucketValue(self, index):
+    if index < 2 * self.half:
+      return index / 1000000
+    shift = index // self.half - 1
+    return ((index - shift * self.half) << shift) / 1000000
+
+
+  #--------------------------------------------- Value at a percentile (0-100)
+
+  def Percentile(self, percent):
+    if self.count == 0:
+      return 0.0
+    target = max(1, int(self.count * percent / 100 + 0.5))
+    seen = 0
+    for index, n in enumerate(self.buckets):
+      seen = seen + n
+      if seen >= target:
+        return min(max(self.BucketValue(index), self.min), self.max)
+    return self.max
+
+
+  #---------------------------------------------------------------- Snapshot
+
+  def Snapshot(self):
+    return {'count': self.count,
+            'sum'  : self.sum,
+            'min'  : self.min or 0.0,
+            'max'  : self.max or 0.0,
+            'p50'  : self.Percentile(50),
+            'p90'  : self.Percentile(90),
+            'p99'  : self.Percentile(99)}
+
+
+#===============================================================================
+# Metrics registry
+#===============================================================================
+
+class cMetrics():
+
+  #----------------------------------------------------------------- Constructor
+
+  def __init__(self):
+    self.metrics = {}                              # (name, labels) -> cCounter / cGauge / cHistogram
+
+
+  #---------------------------------- Get (or create) a metric of a given type
+
+  def Get(self, metric_class, name, labels, *args):
+    key = (name, tuple(sorted(labels.items())))
+    metric = self.metrics.get(key)
+    if metric is None:
+      metric = metric_class(*args)
+      self.metrics[key] = metric
+    return metric
+
+  def Counter(self, name, **labels):
+    return self.Get(cCounter, name, labels)
+
+  def Histogram(self, name, **labels):
+    return self.Get(cHistogram, name, labels)
+
+  def Gauge(self, name, function, **labels):
+    return self.Get(cGauge, name, labels, function)
+
+
+  #------------------------------------------------- Metric name with labels
+  # (Label values escaped as the exposition format requires : \\, \" and \n)
+
+  def FullName(self, name, labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+      return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (k, self.Escape(v)) for (k, v) in labels))
+
+
+  def Escape(self, value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+  #------------------------------------------- Value in the exposition format
+  # (Integers exact, floats with all their digits : not '%g')
+
+  def Value(self, value):
+    if isinstance(value, int):
+      return '%d' % value
+    value = float(value)
+    if value != value:
+      return 'NaN'
+    if value in (float('inf'), float('-inf')):
+      return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+  #------------------------------------------- Snapshot of all metric values
+
+  def Snapshot(self):
+    snapshot = {}
+    for (name, labels), metric in self.metrics.items():
+      if isinstance(metric, cHistogram):
+        snapshot[self.FullName(name, labels)] = metric.Snapshot()
+      else:
+        snapshot[self.FullName(name, labels)] = metric.value
+    return snapshot
+
+
+  #------------------------------------------ Prometheus text exposition format
+  # Histograms are exposed as summaries (quantiles, _sum and _count)
+
+  def Prometheus(self):
+    lines = []
+    typed = set()
+    for (name, labels), metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+      if isinstance(metric, cHistogram):
+        kind = 'summary'
+      elif isinstance(metric, cGauge):
+        kind = 'gauge'
+      else:
+        kind = 'counter'
+      if name not in typed:
+        lines.append('# TYPE %s %s' % (name, kind))
+        typed.add(name)
+      if kind == 'summary':
+        for q in (50, 90, 99):
+          lines.append('%s %s' % (self.FullName(name, labels, (('quantile', q / 100),)), self.Value(metric.Percentile(q))))
+        lines.append('%s %s' % (self.FullName(name + '_sum', labels), self.Value(metric.sum)))
+        lines.append('%s %d' % (self.FullName(name + '_count', labels), metric.count))
+      else:
+        lines.append('%s %s' % (self.FullName(name, labels), self.Value(metric.value)))
+    return '\n'.join(lines) + '\n'
+
+
+################################################################################
+#                                                                              #
+#                              M A I N                                         #
+#                                                                              #
+################################################################################
+
+if __name__ == "__main__":
+  print ("%s - (c) Toussaint OTTAVI, bc-109 Soft, t.ottavi@medi.fr" %(Name))
+  print ("Version %s, date : %s" % (Version, VersionDate))
+  print ("This is a library, to be called from other modules. It does nothing by itself.")
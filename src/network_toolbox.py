@@ -33,9 +33,14 @@ VersionDate = "23/05/2020"
 # Imports 
 #===============================================================================
 
-from netifaces import interfaces, ifaddresses, AF_INET
+try:
+  from netifaces import interfaces, ifaddresses, AF_INET
+except ImportError:                  # netifaces does not install under Windows : no interface list, the rest works
+  interfaces = None
 
+import asyncio
 import socket
+import time
 
 
 ################################################################################
@@ -90,6 +95,8 @@ def GetDefaultIPAddress():
 
 def GetIPInterfaceList():
   ip_list = []
+  if interfaces is None:
+    return ip_list
   for interface in interfaces():                                            # need to import netifaces
     try:
       for link in ifaddresses(interface)[AF_INET]:
@@ -216,17 +223,218 @@ def FindFreeLocalPortTCPUDP(interface='127.0.0.1', start=50000, max_ports=1024 )
   return port
 
 
+################################################################################
+#                                                                              #
+#                                   DNS                                        #
+#                                                                              #
+################################################################################   
+
 #===============================================================================
-# Try to resolve hostname and update IP address
+# DNS cache, shared by the whole process (SharedDNSCache below)
 #===============================================================================
 
-from socket import gethostbyname
+# AsyncIO code never waits on DNS once a name has been resolved :
+#
+# - Resolve() (async) uses loop.getaddrinfo(), in the loop executor. Once a
+#   name is known, it returns the cached address immediately. When the entry
+#   is older than <ttl>, it is refreshed in the background, and the old
+#   address is used until then (also if the refresh fails : temporary DNS
+#   issue). Concurrent resolutions of the same name share one query.
+# - Lookup() never waits : cached address or None (starts a resolution).
+# - Subscribe() : callback(host, ip) when the address of a host is known or
+#   changes, and the host is refreshed every <ttl> s. Used by cUDPClient.
+# - ResolveSync() : blocking version, same cache (CheckUpdateHost).
+#
+# getaddrinfo() does not give the record TTL : <ttl> is a fixed setting.
+# IP addresses are returned as is, without cache.
+
+class cDNSCache():
+
+  #----------------------------------------------------------------- Constructor
+  
+  def __init__(self, ttl=300, negative_ttl=10, family=socket.AF_INET):
+    self.ttl = ttl                               # Refresh resolved names after that time (s)
+    self.negative_ttl = negative_ttl             # Retry failed names after that time (s)
+    self.family = family                         # AF_INET, AF_INET6, or AF_UNSPEC
+    self.entries = {}                            # host -> [ip or None, refresh time (time.monotonic)]
+    self.pending = {}                            # host -> task (resolution in progress)
+    self.subscribers = {}                        # host -> list of callback(host, ip)
+    self.timers = {}                             # host -> refresh timer (subscribed hosts)
+    
+    self.hits = 0                                # Statistics
+    self.misses = 0
+    self.queries = 0
+    self.failures = 0
+  
+  
+  #--------------------------------------------------- Is it an IP address ?
+  
+  def IsIP(self, host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+      try:
+        socket.inet_pton(family, host)
+        return True
+      except (OSError, ValueError):
+        pass
+    return False
+  
+  
+  #----------------------------------------- Cached address, never waits
+  # Returns None if unknown (a resolution is started if a loop is running)
+  
+  def Lookup(self, host):
+    entry = self.entries.get(host)
+    if entry is None:
+      if self.IsIP(host):
+        return host
+      self.misses += 1
+      self.Refresh(host)
+      return None
+    if time.monotonic() >= entry[1]:
+      self.Refresh(host)
+    self.hits += 1
+    return entry[0]
+  
+  
+  #--------------------------------------------------- Resolve (AsyncIO)
+  # Returns the IP address, or None if the name can't be resolved
+  
+  async def Resolve(self, host):
+    entry = self.entries.get(host)
+    if entry is not None:
+      if entry[0] is not None:
+        if time.monotonic() >= entry[1]:
+          self.Refresh(host)                     # Background : the old address is still used
+        self.hits += 1
+        return entry[0]
+      if time.monotonic() < entry[1]:            # Recent failure
+        self.hits += 1
+        return None
+    elif self.IsIP(host):
+      return host
+    self.misses += 1
+    task = self.pending.get(host) or self.Refresh(host)
+    return await asyncio.shield(task)
+  
+  
+  #---------------------------------- Start a background resolution of host
+  # Returns the task, or None if no loop is running
+  
+  def Refresh(self, host):
+    task = self.pending.get(host)
+    if task is not None:
+      return task
+    try:
+      loop = asyncio.get_running_loop()
+    except RuntimeError:
+      return None
+    task = loop.create_task(self.Query(loop, host), name='DNS %s' % host)
+    self.pending[host] = task
+    task.add_done_callback(lambda t: self.pending.pop(host, None))
+    return task
+  
+  
+  #-------------------------------------------------------- DNS query (AsyncIO)
+  
+  async def Query(self, loop, host):
+    self.queries += 1
+    try:
+      infos = await loop.getaddrinfo(host, None, family=self.family, type=socket.SOCK_DGRAM)
+      ip = infos[0][4][0]
+    except (OSError, UnicodeError, IndexError):
+      ip = None
+    return self.Store(host, ip)
+  
+  
+  #-------------------------------------------- Store a result and notify
+  # A failure keeps the previous address, if any. Returns the address to use.
+  
+  def Store(self, host, ip):
+    entry = self.entries.get(host)
+    previous = entry[0] if entry is not None else None
+    if ip is None:
+      self.failures += 1
+      self.entries[host] = [previous, time.monotonic() + self.negative_ttl]
+      return previous
+    self.entries[host] = [ip, time.monotonic() + self.ttl]
+    if ip != previous:
+      for callback in list(self.subscribers.get(host, ())):
+        callback(host, ip)
+    return ip
+  
+  
+  #------------------------------------------------ Resolve (blocking)
+  
+  def ResolveSync(self, host):
+    entry = self.entries.get(host)
+    if (entry is not None) and (time.monotonic() < entry[1]):
+      self.hits += 1
+      return entry[0]
+    if self.IsIP(host):
+      return host
+    self.misses += 1
+    self.queries += 1
+    try:
+      ip = socket.getaddrinfo(host, None, family=self.family, type=socket.SOCK_DGRAM)[0][4][0]
+    except (OSError, UnicodeError, IndexError):
+      ip = None
+    return self.Store(host, ip)
+  
+  
+  #-------------------------------------- Follow the address of a host (AsyncIO)
+  # callback(host, ip) is called when the address is known, then on changes
+  
+  def Subscribe(self, host, callback, loop):
+    if self.IsIP(host):
+      loop.call_soon(callback, host, host)
+      return
+    self.subscribers.setdefault(host, []).append(callback)
+    entry = self.entries.get(host)
+    if (entry is not None) and (entry[0] is not None):
+      loop.call_soon(callback, host, entry[0])
+    if host not in self.timers:
+      self.timers[host] = loop.call_soon(self.PeriodicRefresh, loop, host)
+  
+  def Unsubscribe(self, host, callback):
+    callbacks = self.subscribers.get(host)
+    if callbacks and (callback in callbacks):
+      callbacks.remove(callback)
+    if not callbacks:
+      self.subscribers.pop(host, None)
+      timer = self.timers.pop(host, None)
+      if timer is not None:
+        timer.cancel()
+  
+  def PeriodicRefresh(self, loop, host):
+    entry = self.entries.get(host)
+    now = time.monotonic()
+    if (entry is None) or (now >= entry[1]):
+      self.Refresh(host)
+      delay = self.negative_ttl                  # Checked again after the query
+    else:
+      delay = entry[1] - now
+    self.timers[host] = loop.call_later(max(1.0, delay), self.PeriodicRefresh, loop, host)
+  
+  
+  #-------------------------------------------------------------- Statistics
+  
+  def Stats(self):
+    return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+            'queries': self.queries, 'failures': self.failures}
+
+
+SharedDNSCache = cDNSCache()
+
+
+#===============================================================================
+# Try to resolve hostname and update IP address
+# (Blocking. Uses the shared DNS cache)
+#===============================================================================
 
 def CheckUpdateHost (host):
 
-  try:
-    ip = gethostbyname(host)
-  except:
+  ip = SharedDNSCache.ResolveSync(host)
+  if ip is None:
     print('Unable to resolve address (%s). This could be a temporary DNS issue.' %(host))    
     ip = '0.0.0.0'
     
@@ -383,6 +383,25 @@ def DumpBufferHexa(buf):
   return text
 
 
+#===============================================================================
+# Lazy hex dump, for logging : the dump is only built if the record is emitted
+#
+#   logger.debug('RX packet\n%s', cLazyHexDump(data))
+#
+# (If data is a memoryview, it must still be valid when the record is emitted)
+#===============================================================================
+
+class cLazyHexDump():
+
+  __slots__ = ('buf',)
+
+  def __init__(self, buf):
+    self.buf = buf
+
+  def __str__(self):
+    return DumpBufferHexa(self.buf)
+
+
 
 ################################################################################
 #                                                                              #
@@ -0,0 +1,6 @@
+# Toolbox modules import each other by name (flat src folder)
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import os
+import time
+
+import pytest
+
+from asyncio_mqtt_toolbox import cMQTTTopicRouter, cMQTTPublishQueue, cGMQTTClient, cMQTTBroker
+from network_toolbox import FindFreeLocalPortTCPUDP
+
+
+Logger = logging.getLogger('test')
+
+
+#---------------------------------------------------------------------- Helpers
+
+async def WaitFor(condition, timeout=5):
+  end = time.monotonic() + timeout
+  while not condition():
+    assert time.monotonic() < end, 'condition not reached'
+    await asyncio.sleep(0.005)
+
+
+async def StartBroker():
+  broker = cMQTTBroker(None, 'TEST', '127.0.0.1', FindFreeLocalPortTCPUDP('127.0.0.1'))
+  broker.start_server()
+  await WaitFor(lambda: getattr(broker, 'started', False))
+  return broker
+
+
+async def CancelAll():
+  for task in [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]:
+    task.cancel()
+  await asyncio.sleep(0.05)
+
+
+#---------------------------------------------------------------- Topic router
+
+def Handlers(router, topic):
+  return sorted(handler.__name__ for handler, is_async in router.Match(topic))
+
+def A(*args): pass
+def B(*args): pass
+def C(*args): pass
+
+
+@pytest.mark.parametrize('topic_filter, topic, matches', [
+  ('a/b', 'a/b', True),
+  ('a/b', 'a/b/c', False),
+  ('a/+', 'a/b', True),
+  ('a/+', 'a', False),
+  ('a/+', 'a/b/c', False),
+  ('+/+', '/b', True),                             # Empty levels are levels
+  ('a/#', 'a', True),                              # '#' also matches its parent level
+  ('a/#', 'a/b/c', True),
+  ('a/#', 'ab', False),
+  ('#', 'a/b', True),
+  ('+/b/#', 'x/b', True),
+  ('#', '$SYS/broker', False),                     # No wildcard match on '$' topics at the first level
+  ('+/broker', '$SYS/broker', False),
+  ('$SYS/#', '$SYS/broker', True),
+  ('$SYS/+', '$SYS/broker', True),
+])
+def test_router_match(topic_filter, topic, matches):
+  router = cMQTTTopicRouter(None, Logger)
+  router.Add(topic_filter, A)
+  assert Handlers(router, topic) == (['A'] if matches else [])
+
+
+def test_router_invalid_filters():
+  router = cMQTTTopicRouter(None, Logger)
+  for topic_filter in ('a/#/b', 'a#', 'a/b+', 'a/+b'):
+    with pytest.raises(ValueError):
+      router.Add(topic_filter, A)
+
+
+def test_router_overlapping_filters():
+  router = cMQTTTopicRouter(None, Logger)
+  router.Add('a/+', A)
+  router.Add('a/#', A)
+  router.Add('a/b', B)
+  assert Handlers(router, 'a/b') == ['A', 'A', 'B']   # Once per matching filter
+
+
+def test_router_remove_and_prune():
+  router = cMQTTTopicRouter(None, Logger)
+  router.Add('a/b/c', A)
+  router.Add('a/b/c', B)
+  router.Add('a/#', C)
+  assert router.Remove('a/b/c', A) == 1           # Handlers left on the filter
+  assert Handlers(router, 'a/b/c') == ['B', 'C']
+  assert router.Remove('a/b/c') == 0              # All the handlers
+  assert 'b' not in router.root.children['a'].children     # Empty branch pruned
+  assert Handlers(router, 'a/b/c') == ['C']
+  assert router.Remove('a/#', C) == 0
+  assert not router.root.children                 # Whole trie pruned
+  assert not router.filters
+  assert router.Remove('x/y', A) == 0             # Unknown filter
+
+
+def test_router_handler_errors_logged_with_traceback(caplog):
+  router = cMQTTTopicRouter(None, Logger)
+
+  def Sync(*args):
+    raise ValueError('sync')
+
+  async def Async(*args):
+    raise ValueError('async')
+
+  async def Run():
+    router.loop = asyncio.get_running_loop()
+    router.Add('a', Sync)
+    router.Add('a', Async)
+    router.Dispatch('a', b'')
+    await asyncio.sleep(0.01)
+
+  with caplog.at_level(logging.ERROR, logger='test'):
+    asyncio.run(Run())
+  assert router.errors == 2
+  assert sorted(str(record.exc_info[1]) for record in caplog.records) == ['async', 'sync']
+  assert all('[a]' in record.getMessage() for record in caplog.records)
+
+
+#------------------------------------------------------------- Publish queue
+
+def test_publish_queue_spill_file_stays_bounded(tmp_path):
+  path = str(tmp_path / 'spill')
+  queue = cMQTTPublishQueue(Logger, max_messages=100, spill_file=path)
+  for i in range(20000):
+    queue.Put('sensors/%d' % (i % 50), b'%05d' % i + b'x' * 90)
+  queue.Close()
+  assert len(queue) == 100
+  assert os.path.getsize(path) <= 2 * queue.record_bytes + 65536
+
+  loaded = cMQTTPublishQueue(Logger, max_messages=100, spill_file=path)
+  loaded.Close()
+  assert list(loaded.messages.values()) == list(queue.messages.values())
+  assert os.path.getsize(path) == loaded.record_bytes
+
+
+#----------------------------------------------------------- Client and broker
+
+def test_client_resubscribes_without_duplicates():
+
+  async def Run():
+    broker = await StartBroker()
+    received = []
+    client = cGMQTTClient(None, Logger, '127.0.0.1', 'SUB', port=broker.tcp_local_port)
+    client.Route('a/#', lambda topic, payload, qos, properties: received.append((topic, payload, qos)), qos=1)
+    client.Start()
+    assert await client.wait_connected(timeout=5)
+    await WaitFor(lambda: broker.router.filters['a/#'] == 1)
+
+    for _ in range(3):                             # Broker drops the connection
+      broker.sessions['SUB'].transport.abort()
+      await client.disconnected_event.wait()
+      assert await client.wait_connected(timeout=5)
+      await WaitFor(lambda: ('SUB' in broker.sessions) and broker.sessions['SUB'].subscriptions)
+
+    broker.Route('a/b', b'hello', 1)
+    await WaitFor(lambda: received)
+    subscriptions = list(client.client.subscriptions)
+    await CancelAll()
+    return subscriptions, received
+
+  subscriptions, received = asyncio.run(Run())
+  assert [sub.topic for sub in subscriptions] == ['a/#']
+  assert received == [('a/b', b'hello', 1)]
+
+
+#---------------------------------------------------------------- Client state
+
+def test_client_state_machine(caplog):
+
+  async def Run():
+    client = cGMQTTClient(None, Logger, client_id='STATE')
+    states = [client.state]
+    for state in ('CONNECTING', 'CONNECTED', 'DISCONNECTED', 'CONNECTING', 'FAILED', 'CONNECTING',
+                  'DISCONNECTED', 'FAILED'):                          # (Closed by the broker while connecting)
+      client.SetState(state)
+      states.append((client.state, client.connected_event.is_set(), client.disconnected_event.is_set()))
+    return client, states
+
+  with caplog.at_level(logging.WARNING, logger='test'):
+    client, states = asyncio.run(Run())
+  assert not caplog.records
+  assert states[2] == ('CONNECTED', True, False)
+  assert states[3] == ('DISCONNECTED', False, True)
+  assert client.connected == 'FAILED'
+
+  with caplog.at_level(logging.WARNING, logger='test'):
+    client.SetState('STOPPED')
+    client.SetState('CONNECTING')                  # Not allowed : logged, but applied
+  assert len(caplog.records) == 1
+  assert client.state == 'CONNECTING'
+
+
+def test_client_connection_refused_then_connected():
+
+  async def Run():
+    port = FindFreeLocalPortTCPUDP('127.0.0.1')
+    client = cGMQTTClient(None, Logger, '127.0.0.1', 'LATE', port=port)
+    client.Start()
+    await WaitFor(lambda: client.state == 'FAILED')
+    assert not await client.wait_connected(timeout=0.05)
+    broker = cMQTTBroker(None, 'TEST', '127.0.0.1', port)
+    broker.start_server()
+    connected = await client.wait_connected(timeout=10)
+    await CancelAll()
+    return connected, client
+
+  connected, client = asyncio.run(Run())
+  assert connected
+  assert client.reconnections >= 1
+  assert client.state == 'STOPPED'
+
+
+#------------------------------------------------- Broker : raw MQTT packets
+
+def Packet(kind, body):
+  from asyncio_mqtt_toolbox import MQTTEncodeLength
+  return bytes([kind]) + MQTTEncodeLength(len(body)) + body
+
+
+def String(text):
+  return len(text).to_bytes(2, 'big') + text.encode()
+
+
+def Connect(level, client_id):
+  body = String('MQTT') + bytes([level, 0x02, 0, 60]) + (b'\x00' if level == 5 else b'') + String(client_id)
+  return Packet(0x10, body)
+
+
+async def RawSession(port, level, client_id):
+  reader, writer = await asyncio.open_connection('127.0.0.1', port)
+  writer.write(Connect(level, client_id))
+  connack = await ReadPacket(reader)
+  return reader, writer, connack
+
+
+async def ReadPacket(reader):
+  header = await asyncio.wait_for(reader.readexactly(1), 2)
+  length = shift = 0
+  while True:
+    byte = await reader.readexactly(1)
+    header += byte
+    length |= (byte[0] & 0x7F) << shift
+    shift += 7
+    if not byte[0] & 0x80:
+      break
+  return header + await reader.readexactly(length)
+
+
+@pytest.mark.parametrize('level', [4, 5])
+def test_broker_packets(level):
+  v5 = b'\x00' if level == 5 else b''             # Empty properties
+
+  async def Run():
+    broker = await StartBroker()
+    port = broker.tcp_local_port
+    sub_r, sub_w, connack = await RawSession(port, level, 'SUB')
+    assert connack == (b'\x20\x07\x00\x00\x04\x24\x01\x25\x00' if level == 5 else b'\x20\x02\x00\x00')
+    pub_r, pub_w, _ = await RawSession(port, level, 'PUB')
+
+    # SUBSCRIBE : granted QoS 1, QoS 2 downgraded to 1, invalid filter refused
+    sub_w.write(Packet(0x82, b'\x00\x07' + v5 + String('s/+') + b'\x01' + String('t/#') + b'\x02' + String('u/#/x') + b'\x00'))
+    assert await ReadPacket(sub_r) == Packet(0x90, b'\x00\x07' + v5 + b'\x01\x01\x80')
+
+    # PUBLISH QoS 1 : PUBACK to the publisher, QoS 1 delivery to the subscriber
+    pub_w.write(Packet(0x32, String('s/a') + b'\x00\x09' + v5 + b'one'))
+    assert await ReadPacket(pub_r) == b'\x40\x02\x00\x09'
+    delivered = await ReadPacket(sub_r)
+    assert delivered[0] == 0x32
+    assert delivered.endswith(String('s/a') + delivered[7:9] + v5 + b'one')
+    assert broker.sessions['SUB'].inflight
+    sub_w.write(b'\x40\x02' + delivered[7:9])      # PUBACK from the subscriber
+
+    # PUBLISH QoS 0 : delivered at QoS 0
+    pub_w.write(Packet(0x30, String('t/b/c') + v5 + b'two'))
+    assert await ReadPacket(sub_r) == Packet(0x30, String('t/b/c') + v5 + b'two')
+    await WaitFor(lambda: not broker.sessions['SUB'].inflight)
+    lag = broker.Stats()['subscribers']['SUB']['ack_ms']
+
+    # UNSUBSCRIBE, then PINGREQ
+    sub_w.write(Packet(0xa2, b'\x00\x08' + v5 + String('s/+') + String('t/#')))
+    assert await ReadPacket(sub_r) == Packet(0xb0, b'\x00\x08' + (b'\x00\x00\x00' if level == 5 else b''))
+    assert not broker.router.filters
+    sub_w.write(b'\xc0\x00')
+    assert await ReadPacket(sub_r) == b'\xd0\x00'
+
+    # DISCONNECT : session removed
+    sub_w.write(b'\xe0\x00')
+    await WaitFor(lambda: 'SUB' not in broker.sessions)
+    for writer in (sub_w, pub_w):
+      writer.close()
+    await CancelAll()
+    return lag
+
+  lag = asyncio.run(Run())
+  assert lag['max'] > 0
+
+
+def test_broker_round_trip_qos_0_1():
+
+  async def Run():
+    broker = await StartBroker()
+    port = broker.tcp_local_port
+    received = []
+    sub = cGMQTTClient(None, Logger, '127.0.0.1', 'SUB', port=port)
+    sub.Route('data/+/0', lambda topic, payload, qos, properties: received.append((topic, payload, qos)), qos=0)
+    sub.Route('data/+/1', lambda topic, payload, qos, properties: received.append((topic, payload, qos)), qos=1)
+    sub.Route('data/#', lambda topic, payload, qos, properties: None, qos=0)     # (Overlap : one copy per session)
+    pub = cGMQTTClient(None, Logger, '127.0.0.1', 'PUB', port=port)
+    for client in (sub, pub):
+      client.Start()
+      assert await client.wait_connected(timeout=5)
+    await WaitFor(lambda: sum(broker.router.filters.values()) == 3)
+
+    pub.Publish('data/x/0', b'a', qos=0)
+    pub.Publish('data/x/1', b'b', qos=1)
+    await WaitFor(lambda: len(received) == 2)
+
+    broker.sessions['SUB'].transport.abort()       # Reconnect : subscriptions sent again
+    await sub.disconnected_event.wait()
+    assert await sub.wait_connected(timeout=5)
+    await WaitFor(lambda: sum(broker.router.filters.values()) == 3)
+    pub.Publish('data/y/1', b'c', qos=1)
+    await WaitFor(lambda: len(received) == 3)
+    await asyncio.sleep(0.05)                      # (No extra copies)
+    stats = broker.Stats()
+    await CancelAll()
+    return received, stats
+
+  received, stats = asyncio.run(Run())
+  assert sorted(received) == [('data/x/0', b'a', 0), ('data/x/1', b'b', 1), ('data/y/1', b'c', 1)]
+  assert stats['messages_in'] == 3
+  assert stats['messages_out'] == 3
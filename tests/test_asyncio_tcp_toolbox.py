@@ -0,0 +1,50 @@
+import logging
+import types
+
+from asyncio_tcp_toolbox import cTCPProtocol, OVERFLOW_DROP_OLDEST
+
+
+class cTransport():
+
+  def is_closing(self):
+    return False
+
+
+def PausedProtocol(max_pending):
+  parent = types.SimpleNamespace(loop=None, logger=logging.getLogger('test'), overflow_policy=OVERFLOW_DROP_OLDEST,
+                                 max_pending=max_pending, tcp_metrics=None)
+  protocol = cTCPProtocol(parent)
+  protocol.transport = cTransport()
+  protocol.paused = True
+  return protocol
+
+
+def test_drop_oldest_same_object_queued_twice():
+  protocol = PausedProtocol(max_pending=25)
+  frame = b'x' * 10                                # Same object for every client, as in Broadcast()
+  assert protocol.send_data(frame)
+  assert protocol.send_data(frame)
+  assert protocol.send_data(frame)                 # Evicts the first copy, the new one stays queued
+  assert protocol.pending_bytes == 20
+  assert len(protocol.pending) == 2
+  assert protocol.dropped_frames == 1
+
+
+def test_drop_oldest_data_bigger_than_queue():
+  protocol = PausedProtocol(max_pending=25)
+  protocol.send_data(b'a' * 10)
+  assert not protocol.send_data(b'b' * 30)
+  assert protocol.pending_bytes == 0
+  assert protocol.dropped_frames == 2
+
+
+def test_mqtt_framer_encode_round_trip():
+  from asyncio_tcp_toolbox import cTCPFramerMQTT, MQTTEncodeLength
+  framer = cTCPFramerMQTT(max_frame=4000000)
+  for size, length_bytes in ((0, 1), (127, 1), (128, 2), (16383, 2), (16384, 3), (2097152, 4)):
+    assert len(MQTTEncodeLength(size)) == length_bytes
+    packet = framer.Encode(b'p' * size)
+    assert packet[:1 + length_bytes] == b'\x30' + MQTTEncodeLength(size)
+    frames = []
+    framer.Feed(packet, lambda frame: frames.append(bytes(frame)))     # (Frames are views, valid during the call)
+    assert frames == [packet]
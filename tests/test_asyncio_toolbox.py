@@ -0,0 +1,24 @@
+import asyncio
+import logging
+
+from asyncio_toolbox import cTimerHeap
+
+
+def test_timer_heap_logs_callback_exception(caplog):
+  ran = []
+
+  def Fail():
+    raise ValueError('boom')
+
+  async def Run():
+    loop = asyncio.get_running_loop()
+    timers = cTimerHeap(loop, resolution=0)
+    timers.Schedule(loop.time(), Fail)
+    timers.Schedule(loop.time(), ran.append, 1)    # Still run after the failure
+    await asyncio.sleep(0.01)
+
+  with caplog.at_level(logging.ERROR, logger='asyncio_toolbox'):
+    asyncio.run(Run())
+  assert ran == [1]
+  assert len(caplog.records) == 1
+  assert caplog.records[0].exc_info[0] is ValueError
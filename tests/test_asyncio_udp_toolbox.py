@@ -0,0 +1,152 @@
+import asyncio
+import errno
+import socket
+
+import pytest
+
+from asyncio_udp_toolbox import cUDPServer, cUDPSendQueue
+
+
+#-------------------------------------- Socket raising EAGAIN on the first sends
+
+class cEAgainSocket():
+
+  def __init__(self, sock, count):
+    self.sock = sock
+    self.count = count                             # Sends refused with EAGAIN
+
+  def __getattr__(self, name):
+    return getattr(self.sock, name)
+
+  def refuse(self):
+    if self.count > 0:
+      self.count -= 1
+      raise BlockingIOError(11, 'Resource temporarily unavailable')
+
+  def sendto(self, *args):
+    self.refuse()
+    return self.sock.sendto(*args)
+
+  def sendmsg(self, *args):
+    self.refuse()
+    return self.sock.sendmsg(*args)
+
+
+def Receiver():
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.bind(('127.0.0.1', 0))
+  sock.settimeout(2)
+  return sock
+
+
+async def StartServer(**kwargs):
+  server = cUDPServer(None, 'TEST', '127.0.0.1', 0, send_batch=16, **kwargs)
+  await server.create_endpoint()
+  queue = server.send_queue
+  queue.sock = cEAgainSocket(queue.sock, 1)
+  return server
+
+
+#------------------------------------------------------------------------ Tests
+
+def test_send_queue_eagain_standard_path():
+  # Standard receive path : the transport owns the server socket
+
+  async def Run():
+    receiver = Receiver()
+    server = await StartServer()
+    queue = server.send_queue
+    server.sendto(b'hello', receiver.getsockname())
+    for i in range(100):
+      await asyncio.sleep(0.001)
+      if queue.sent:
+        break
+    stats = server.stats()
+    server.stop_server()
+    data, addr = receiver.recvfrom(2048)
+    receiver.close()
+    return stats, data
+
+  stats, data = asyncio.run(Run())
+  assert data == b'hello'
+  assert stats['send_eagain'] == 1
+  assert stats['send_sent'] == 1
+  assert stats['send_queued'] == 0
+
+
+def test_send_queue_eagain_stop_while_writing():
+
+  async def Run():
+    receiver = Receiver()
+    server = await StartServer(batch=8)
+    queue = server.send_queue
+    queue.sock.count = 1000000                     # Never writable
+    server.sendto(b'hello', receiver.getsockname())
+    await asyncio.sleep(0.01)
+    writing = queue.writing
+    server.stop_server()                           # Removes the writer
+    receiver.close()
+    return writing, queue.stats()
+
+  writing, stats = asyncio.run(Run())
+  assert writing
+  assert stats['dropped'] == 1
+
+
+def test_multicast_leave_group_after_stop():
+  from asyncio_udp_toolbox import cUDPMulticast
+
+  async def Run():
+    mc = cUDPMulticast(None, 'TEST', '239.255.0.1', 0, interfaces=['0.0.0.0'], batch=8)
+    await mc.create_endpoint()
+    mc.stop_server()
+    mc.join_group('239.255.0.2')                   # Not running : only recorded
+    mc.leave_group('239.255.0.1')
+    return mc
+
+  mc = asyncio.run(Run())
+  assert mc.groups == ['239.255.0.2']
+  assert not mc.joined
+
+
+#------------------------------------------ Socket failing its first sendmsg()
+
+class cFailingSocket(cEAgainSocket):
+
+  def __init__(self, sock, error):
+    super().__init__(sock, 0)
+    self.error = error
+
+  def sendmsg(self, *args):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise OSError(error, 'sendmsg failed')
+    return self.sock.sendmsg(*args)
+
+
+@pytest.mark.parametrize('error, gso', [(errno.ECONNREFUSED, True), (errno.EHOSTUNREACH, True), (errno.EIO, False)])
+def test_send_queue_gso_disabled_only_when_unsupported(error, gso):
+
+  async def Run():
+    receiver = Receiver()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    queue = cUDPSendQueue(asyncio.get_running_loop(), sock, batch=16)
+    assert queue.gso
+    queue.sock = cFailingSocket(sock, error)
+    for i in range(8):
+      queue.Send(b'%08d' % i, receiver.getsockname())
+    await asyncio.sleep(0.01)
+    queue.Close()
+    sock.close()
+    receiver.close()
+    return queue
+
+  queue = asyncio.run(Run())
+  assert queue.gso == gso
+  if gso:
+    assert queue.errors == 1                       # One datagram lost, the others batched
+    assert queue.sent == 7
+  else:
+    assert queue.errors == 0                       # Sent again one by one
+    assert queue.sent == 8
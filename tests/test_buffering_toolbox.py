@@ -0,0 +1,25 @@
+import numpy as np
+
+from buffering_toolbox import cCircularBuffer
+
+
+def test_circular_buffer_add_data_inputs():
+  buffer = cCircularBuffer(dtype=np.int16, blocksize=4, maxblocks=4)
+  buffer.AddData(np.array([1, 2, 3, 4], dtype=np.int16))
+  buffer.AddData([5, 6, 7, 8])
+  buffer.AddData((9, 10, 11, 12))
+  buffer.AddData(memoryview(np.array([13, 14, 15, 16], dtype=np.int16).tobytes()))
+  assert buffer.filled
+  assert buffer.GetData().tolist() == list(range(1, 17))
+
+
+def test_jitter_buffer_timestamp_wrap():
+  from buffering_toolbox import cJitterBuffer
+  buffer = cJitterBuffer(blocksize=160, clock_rate=8000, frame_time=0.02)
+  timestamp = 0xFFFFFFFF - 5 * 160
+  frame = bytes(320)
+  for i in range(20):                              # Regular arrivals across the wrap
+    buffer.Put(i, timestamp & 0xFFFFFFFF, frame, arrival=i * 0.02)
+    timestamp += 160
+  assert buffer.jitter < 0.001
+  assert buffer.target <= buffer.min_delay + 1
@@ -0,0 +1,19 @@
+from metrics_toolbox import cMetrics
+
+
+def test_prometheus_values_are_exact():
+  metrics = cMetrics()
+  metrics.Counter('bytes_total').value = 123456789012
+  metrics.Gauge('ratio', lambda: 0.1234567891)
+  metrics.Histogram('latency_seconds').Record(1.5)
+  text = metrics.Prometheus()
+  assert 'bytes_total 123456789012\n' in text
+  assert 'ratio 0.1234567891\n' in text
+  assert 'latency_seconds_sum 1.5\n' in text
+  assert 'latency_seconds_count 1\n' in text
+
+
+def test_prometheus_label_escaping():
+  metrics = cMetrics()
+  metrics.Counter('x_total', path='C:\\dir "a"\nnext').value = 1
+  assert metrics.Prometheus().splitlines()[1] == 'x_total{path="C:\\\\dir \\"a\\"\\nnext"} 1'